@@ -6,9 +6,7 @@ print('Starting up, this can take a few moments...')
 
 # Standard imports
 import asyncio
-import glob
 import logging
-import os
 import re
 import sys
 import traceback
@@ -77,11 +75,6 @@ if __name__ == '__main__':
         log.info('Changelog: https://github.com/svioletg/lydian-discord-bot/blob/main/docs/changelog.md')
     check_for_updates()
 
-# Clear out downloaded files
-log.info('Removing previously downloaded media files...')
-for t in [f for f in glob.glob('*.*') if Path(f).suffix in cfg.CLEANUP_EXTENSIONS]:
-    os.remove(t)
-
 # Establish bot user
 intents = discord.Intents.default()
 intents.messages = True
@@ -210,6 +203,9 @@ async def bot_thread():
         await bot.add_cog(cog_general.General(bot))
         log.debug('Adding cog: Voice')
         await bot.add_cog(vc_ref := cog_voice.Voice(bot))
+        # Clear out downloaded files in the background, so a large backlog doesn't hold up logging in
+        log.info('Removing previously downloaded media files...')
+        asyncio_tasks['cleanup'] = asyncio.create_task(vc_ref.file_cleaner.sweep(Path('.'), cfg.CLEANUP_EXTENSIONS))
         log.info('Logging in with token, please wait for a "Ready!" message before using any commands...')
         await bot.start(token)
 
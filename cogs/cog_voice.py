@@ -2,60 +2,189 @@
 
 # Standard imports
 import asyncio
+import io
 import logging
-import os
 import random
 import re
+import sqlite3
 import time
-from collections import deque
 from dataclasses import dataclass
+from enum import Enum
 from math import ceil
 from pathlib import Path
-from typing import Callable, Optional, Self, cast
+from typing import Callable, Optional, Self, Sequence, TypeVar, cast
 
 # External imports
 import requests
 import yt_dlp
-from discord import (Activity, ActivityType, Embed, FFmpegPCMAudio, Member,
-                     Message, PCMVolumeTransformer, User, VoiceClient,
-                     VoiceState)
+from fuzzywuzzy import fuzz
+from discord import (Activity, ActivityType, AudioSource, Embed,
+                     FFmpegPCMAudio, Member, Message,
+                     User, VoiceClient, VoiceState)
 from discord.ext import commands
+from discord.opus import OpusNotLoaded
 
 # Local imports
 from cogs.presence import BotPresence
 import utils.configuration as cfg
 from cogs.common import (EmojiStr, SilentCancel, command_aliases, edit_or_send,
-                         embedq, is_command_enabled, prompt_for_choice)
+                         embedq, guild_id, is_command_enabled, prompt_for_choice)
 from cogs.messages import CommonMsg
+from cogs.refresher import MessageRefresher
 from cogs.test_voice import VoiceTest
+from cogs.watchdog import StallWatchdog
 from utils import media
-from utils.miscutil import seconds_to_hms
+from utils.audio import (EFFECT_PRESETS, FRAME_LENGTH_SECONDS, AudioEffects,
+                         GaplessSource, JitterBuffer, OpusFrameFile,
+                         OpusRecorder, OpusReplaySource, TransformSource,
+                         seconds_to_frames, write_frame_file)
+from utils.cache import MetadataCache, stream_url_expiry, track_file_stem
+from utils.cleanup import FileCleaner
+from utils.ffmpeg import measure_loudness, probe_media, render_effects
+from utils.library import LibraryIndex
+from utils.miscutil import hms_to_seconds, seconds_to_hms
+from utils.playlists import SavedPlaylists
+from utils.singleflight import SingleFlight
 
 log = logging.getLogger('lydian')
 
+T = TypeVar('T')
+
 # Configure youtube dl
 ytdl = yt_dlp.YoutubeDL(media.ytdl_format_options)
 
 ffmpeg_options = media.ffmpeg_options
 
-class YTDLSource(PCMVolumeTransformer):
+# Concurrent requests for the same track, playlist, search, or download share one call instead of each making their own
+lookups = SingleFlight('lookup')
+downloads = SingleFlight('download')
+
+async def look_up(func: Callable[..., T], query: str) -> T:
+    """Runs a blocking lookup for a URL or search in the default executor, sharing it with any identical lookup already in progress."""
+    return await lookups.run_in_executor((func.__qualname__, media.canonical_url(query)), func, query)
+
+async def match_track(info: media.TrackInfo) -> media.TrackInfo | list[media.TrackInfo]:
+    """Matches a Spotify track to YouTube Music in the default executor, sharing the match with any identical one already in progress."""
+    return await lookups.run_in_executor(('match', media.canonical_url(info.url)), media.match_ytmusic_track, info)
+
+async def match_album(info: media.AlbumInfo, threshold: int) -> tuple[media.AlbumInfo, int] | None:
+    """Matches a Spotify album to YouTube Music in the default executor, sharing the match with any identical one already in progress."""
+    return await lookups.run_in_executor(('match album', media.canonical_url(info.url)), media.match_ytmusic_album, info, threshold)
+
+# How long to fade in for after seeking or resuming
+SEEK_FADE_IN_SECONDS: float = 0.1
+# How long to fade out for when skipping or stopping
+STOP_FADE_OUT_SECONDS: float = 0.1
+# How long to wait for a stream to buffer before starting to play it anyway
+STREAM_PREROLL_TIMEOUT_SECONDS: float = 10.0
+# Cached stream URLs are only used if they'll keep working for this long after the track would finish playing
+STREAM_URL_EXPIRY_MARGIN_SECONDS: float = 300.0
+# Tracks longer than this are never saved to the frame cache, as every frame has to be kept in memory until the track ends
+FRAME_CACHE_MAX_TRACK_SECONDS: int = 30 * 60
+# How closely a search has to match a track that's been played before for it to be queued without searching online
+PLAYED_MATCH_THRESHOLD: int = 90
+# How many recently played tracks autoplay avoids picking again
+AUTOPLAY_RECENT_TRACKS: int = 50
+# How often to check whether it's time to warm the cache with saved playlists
+PLAYLIST_WARM_CHECK_SECONDS: int = 10 * 60
+# Names that can't be used for saved playlists, since they're what -playlist takes to manage them
+PLAYLIST_ACTIONS: tuple[str, ...] = ('save', 'refresh', 'delete', 'list')
+
+class YTDLSource(TransformSource):
     """Creates an AudioSource using yt_dlp."""
-    def __init__(self, source, *, data, filepath: Path, volume: float=0.5):
+    def __init__(self, source, *, data, filepath: Path, volume: float=0.5, start_seconds: float=0.0,
+            effects: AudioEffects=AudioEffects(), rendered: bool=False, buffer: Optional[bytes]=None):
         super().__init__(source, volume)
+        self.base_volume = volume
+        self.effects = effects
+        # Whether `filepath` is a saved render with `effects` already applied, rather than a downloaded file
+        self.rendered = rendered
 
         self.data = data
         self.filepath = filepath
+        # The whole downloaded file, if it was downloaded into memory; `filepath` doesn't exist then
+        self.buffer = buffer
 
         self.title = data.get('title')
         self.url = data.get('url')
         self.ID = data.get('id') # pylint: disable=invalid-name
         self.src = data.get('extractor')
 
+        # Where in the track this source started, if it was opened partway through
+        self.start_seconds = start_seconds
+        self.frames_read: int = 0
+        # If this started out streaming while the track downloads in the background, finishes with the downloaded file's path
+        self.download: Optional[asyncio.Task[Path]] = None
+
+    def read(self) -> bytes:
+        data = super().read()
+        if data:
+            self.frames_read += 1
+        return data
+
+    def cleanup(self) -> None:
+        try:
+            super().cleanup()
+        except ValueError:
+            # When a file in memory is piped into FFmpeg, its stdin is closed once everything's been written;
+            # if the process hasn't exited by the time it's killed, discord.py fails to wait on it through the closed pipe
+            if self.buffer is None:
+                raise
+            log.debug('FFmpeg process reading from memory was already done with its input.')
+
+    @property
+    def elapsed_seconds(self) -> float:
+        """How far into the track playback is, based on how many frames have actually been sent to the voice client."""
+        frames = self.frames_read
+        if isinstance(self.original, JitterBuffer):
+            # Silence played while a stream catches up isn't part of the track
+            frames = max(frames - self.original.silent_frames, 0)
+        return self.start_seconds + (frames * FRAME_LENGTH_SECONDS * self.effects.speed)
+
+    @property
+    def track_id(self) -> str:
+        """Identifies this track across restarts, e.g. `youtube:dQw4w9WgXcQ`."""
+        return f'{self.src}:{self.ID}'
+
+    def set_gain(self, gain_db: float) -> None:
+        """Sets the volume to `gain_db` decibels above (or below, if negative) the base volume."""
+        self.volume = self.base_volume * (10 ** (gain_db / 20))
+
+    @staticmethod
+    def ffmpeg_options_for(start_seconds: float, effects: AudioEffects, seekable: bool=True) -> dict:
+        """Returns the FFmpeg options for starting playback `start_seconds` into the input, with the given effects applied.
+
+        @seekable: (`True`) Whether the input can be seeked. Piped input can't, so everything before `start_seconds` is decoded and thrown away.
+        """
+        options = dict(ffmpeg_options)
+        if start_seconds and seekable:
+            # Seeking on the input side jumps straight there (using range requests for URLs) instead of decoding everything before it
+            options['before_options'] = f'-ss {start_seconds}'
+        elif start_seconds:
+            # On the output side, this seeks in the audio after effects, which speed effects have stretched or squashed
+            options['options'] = f'{options['options']} -ss {start_seconds / effects.speed}'
+        if filter_graph := effects.ffmpeg_filter():
+            options['options'] = f'{options['options']} -af {filter_graph}'
+        return options
+
     @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False) -> Self:
-        """Creates a YTDLSource from a URL."""
+    async def from_url(cls, url, *, loop=None, stream=False, start_seconds: float=0.0, effects: AudioEffects=AudioEffects(),
+            bitrate: Optional[int]=None, early_start_bytes: int=0, memory_bytes: int=0) -> Self:
+        """Creates a YTDLSource from a URL.
+
+        @bitrate: (`None`) Bitrate of the voice channel this will play in, in bits per second, to pick a format suited to it.
+        @early_start_bytes: (`0`) If the file to download is bigger than this, play it by streaming instead, while it downloads
+            in the background through `download`. `0` always waits for the download to finish.
+        @memory_bytes: (`0`) If the file to download is known to be no bigger than this, download it into memory instead of to disk.
+            `0` always downloads to disk.
+
+        Raises `FileSizeLimitError` if the file is known to be over `maximum-file-size` before it would start streaming.
+        """
         loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+        downloader = ytdl if bitrate is None else media.ytdl_for_bitrate(bitrate)
+        download_first = not (stream or early_start_bytes or memory_bytes)
+        data = dict(await downloads.run((downloader, media.canonical_url(url), download_first),
+            lambda: loop.run_in_executor(None, lambda: downloader.extract_info(url, download=download_first))))
 
         try:
             if 'entries' in data: # type: ignore
@@ -64,10 +193,133 @@ class YTDLSource(PCMVolumeTransformer):
         except Exception as e:
             raise e
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data) # type: ignore
-        src = filename.split('-#-')[0] # pylint: disable=unused-variable
-        ID = filename.split('-#-')[1] # pylint: disable=unused-variable, invalid-name
-        return cls(FFmpegPCMAudio(filename, **ffmpeg_options), data=data, filepath=Path(filename)) # type: ignore
+        download: Optional[asyncio.Task[Path]] = None
+        if (not stream) and (not download_first):
+            # The chosen format's size is known before downloading it for most sources; assume it's small if it isn't
+            size: int = data.get('filesize') or data.get('filesize_approx') or 0 # type: ignore
+            if size > cfg.MAX_FILE_SIZE * 1024 * 1024:
+                # yt_dlp would refuse to download it, but streaming it while it downloads would play it all anyway
+                raise FileSizeLimitError(f'File is {size / (1024 * 1024):.1f} MB; the current limit is set to {cfg.MAX_FILE_SIZE} MB.')
+            if 0 < size <= memory_bytes:
+                buffer = await loop.run_in_executor(None, lambda: media.download_to_memory(data, memory_bytes)) # type: ignore
+                if buffer is not None:
+                    log.debug('Downloaded %.2f MB into memory.', len(buffer) / (1024 * 1024))
+                    return cls.from_memory(data, buffer, Path(downloader.prepare_filename(data)), start_seconds, effects) # type: ignore
+                log.debug('Couldn\'t download into memory; downloading to disk instead.')
+
+            if early_start_bytes and (size > early_start_bytes):
+                log.debug('File is large enough to start streaming while it downloads.')
+                stream = True
+                download = asyncio.create_task(cls.download_resolved(downloader, data, loop)) # type: ignore
+            else:
+                data = await cls.download_info(downloader, data, loop) # type: ignore
+
+        if not stream:
+            return cls.from_file(data, Path(downloader.prepare_filename(data)), start_seconds, effects) # type: ignore
+        player = await cls.from_stream_url(data, data['url'], loop=loop, start_seconds=start_seconds, effects=effects) # type: ignore
+        player.download = download
+        return player
+
+    @classmethod
+    async def from_stream_url(cls, data: dict, stream_url: str, *, loop=None, start_seconds: float=0.0,
+            effects: AudioEffects=AudioEffects()) -> Self:
+        """Creates a YTDLSource that streams from a direct media URL that's already been resolved, without going through yt_dlp.
+        If `downloads.stream-buffer-seconds` is set, the stream is buffered ahead, and this waits for it to pre-roll.
+        """
+        loop = loop or asyncio.get_event_loop()
+        source: AudioSource = FFmpegPCMAudio(stream_url, **cls.ffmpeg_options_for(start_seconds, effects))
+        if cfg.STREAM_BUFFER_SECONDS:
+            buffer = JitterBuffer(source, seconds_to_frames(cfg.STREAM_BUFFER_SECONDS), seconds_to_frames(cfg.STREAM_PREROLL_SECONDS))
+            if not await loop.run_in_executor(None, lambda: buffer.wait_for_preroll(STREAM_PREROLL_TIMEOUT_SECONDS)):
+                log.info('Stream is slow to buffer; starting playback anyway.')
+            source = buffer
+        return cls(source, data=data, filepath=Path(stream_url), start_seconds=start_seconds, effects=effects)
+
+    @staticmethod
+    async def download_info(downloader: yt_dlp.YoutubeDL, data: dict, loop: asyncio.AbstractEventLoop) -> dict:
+        """Downloads a track that's already been extracted, without extracting it again, and returns its info as downloaded.
+        Shares the download with any other one of the same track and format that's already in progress.
+        """
+        key = (downloader, media.canonical_url(data.get('webpage_url') or data.get('url', '')), True)
+        return dict(await downloads.run(key,
+            lambda: loop.run_in_executor(None, lambda: downloader.process_ie_result(dict(data), download=True))))
+
+    @classmethod
+    async def download_resolved(cls, downloader: yt_dlp.YoutubeDL, data: dict, loop: asyncio.AbstractEventLoop) -> Path:
+        """Downloads a track that's already been extracted, without extracting it again, and returns where it was saved."""
+        return Path(downloader.prepare_filename(await cls.download_info(downloader, data, loop)))
+
+    @staticmethod
+    async def download_url(url: str, loop: asyncio.AbstractEventLoop, bitrate: Optional[int]=None) -> Path:
+        """Extracts and downloads a track, and returns where it was saved."""
+        downloader = ytdl if bitrate is None else media.ytdl_for_bitrate(bitrate)
+        info = dict(await downloads.run((downloader, media.canonical_url(url), True),
+            lambda: loop.run_in_executor(None, lambda: downloader.extract_info(url, download=True))))
+        if 'entries' in info:
+            info = info['entries'][0] # type: ignore
+        return Path(downloader.prepare_filename(info))
+
+    @classmethod
+    def from_memory(cls, data: dict, buffer: bytes, filepath: Path, start_seconds: float=0.0,
+            effects: AudioEffects=AudioEffects()) -> Self:
+        """Creates a YTDLSource from a file that was downloaded into memory, piping it into FFmpeg.
+
+        @filepath: Where the file would have been downloaded to; only used to identify it.
+        """
+        return cls(FFmpegPCMAudio(io.BytesIO(buffer), pipe=True, **cls.ffmpeg_options_for(start_seconds, effects, seekable=False)),
+            data=data, filepath=filepath, start_seconds=start_seconds, effects=effects, buffer=buffer)
+
+    @classmethod
+    def from_file(cls, data: dict, filepath: Path, start_seconds: float=0.0, effects: AudioEffects=AudioEffects(),
+            rendered: bool=False) -> Self:
+        """Creates a YTDLSource from a file that's already been downloaded, without going through yt_dlp again.
+
+        @rendered: (`False`) The file already has `effects` applied, so FFmpeg shouldn't apply them again.
+        """
+        if rendered:
+            # Speed effects change where everything is in the rendered file
+            options = cls.ffmpeg_options_for(start_seconds / effects.speed, AudioEffects())
+        else:
+            options = cls.ffmpeg_options_for(start_seconds, effects)
+        return cls(FFmpegPCMAudio(str(filepath), **options),
+            data=data, filepath=filepath, start_seconds=start_seconds, effects=effects, rendered=rendered)
+
+class ReplaySource(OpusReplaySource):
+    """Replays a track from Opus packets that were already encoded, either recorded while it played in full,
+    or saved to the frame cache. Carries the track's info, so it can stand in for a `YTDLSource`.
+    """
+    def __init__(self, packets: Sequence[bytes], *, data: dict, filepath: Path, effects: AudioEffects, rendered: bool,
+            start_frame: int=0, buffer: Optional[bytes]=None):
+        """
+        @rendered: Whether `filepath` is a saved file that should be kept, rather than a download to delete once it's done.
+        @buffer: (`None`) The original player's file, if it was downloaded into memory.
+        """
+        super().__init__(packets, start_frame)
+
+        self.data = data
+        self.filepath = filepath
+        self.effects = effects
+        self.rendered = rendered
+        self.buffer = buffer
+
+        self.title = data.get('title')
+        self.url = data.get('url')
+        self.ID = data.get('id') # pylint: disable=invalid-name
+        self.src = data.get('extractor')
+
+    @classmethod
+    def from_player(cls, original: 'YTDLSource | ReplaySource', packets: Sequence[bytes], start_frame: int=0) -> Self:
+        """Creates a ReplaySource carrying over another player's info."""
+        return cls(packets, data=original.data, filepath=original.filepath, effects=original.effects, rendered=original.rendered,
+            start_frame=start_frame, buffer=original.buffer)
+
+    @property
+    def elapsed_seconds(self) -> float:
+        return super().elapsed_seconds * self.effects.speed
+
+    @property
+    def track_id(self) -> str:
+        return f'{self.src}:{self.ID}'
 
 @dataclass
 class QueueItem:
@@ -117,10 +369,31 @@ class MediaQueue(list[QueueItem]):
             self.append(to_queue)
             return start
 
+class PlayerState(Enum):
+    """The states that the `Voice` cog's player can be in. Changed only through `Voice.set_state()`."""
+    IDLE      = 'idle'      # Nothing is playing or being prepared
+    ADVANCING = 'advancing' # Moving on from the current item, and choosing the next one
+    RESOLVING = 'resolving' # Figuring out what to actually play for an item, e.g. matching Spotify tracks to YouTube
+    BUFFERING = 'buffering' # Downloading or opening the audio source
+    PLAYING   = 'playing'
+    PAUSED    = 'paused'
+
+# Which states each state is expected to be able to move to
+PLAYER_TRANSITIONS: dict[PlayerState, set[PlayerState]] = {
+    PlayerState.IDLE:      {PlayerState.ADVANCING},
+    PlayerState.ADVANCING: {PlayerState.RESOLVING, PlayerState.BUFFERING, PlayerState.IDLE},
+    PlayerState.RESOLVING: {PlayerState.BUFFERING, PlayerState.ADVANCING, PlayerState.IDLE},
+    PlayerState.BUFFERING: {PlayerState.PLAYING, PlayerState.PAUSED, PlayerState.ADVANCING, PlayerState.IDLE},
+    PlayerState.PLAYING:   {PlayerState.PAUSED, PlayerState.BUFFERING, PlayerState.ADVANCING, PlayerState.IDLE},
+    PlayerState.PAUSED:    {PlayerState.PLAYING, PlayerState.BUFFERING, PlayerState.ADVANCING, PlayerState.IDLE},
+}
+
 class AlbumLimitError(Exception):
     """Raised when a playlist exceeds its maximum length, set by user configuration."""
 class PlaylistLimitError(Exception):
     """Raised when a playlist exceeds its maximum length, set by user configuration."""
+class FileSizeLimitError(Exception):
+    """Raised when a track's file is bigger than the maximum file size, set by user configuration."""
 
 async def author_in_vc(ctx: commands.Context) -> bool:
     """Checks whether the command author is connected to a voice channel before allowing it to run.
@@ -149,62 +422,111 @@ class Voice(commands.Cog):
         self.bot = bot
         self.voice_client: Optional[VoiceClient] = None
         self.media_queue = MediaQueue()
-        self.play_history: deque[Optional[QueueItem]] = deque([None, None, None, None, None], maxlen=5)
         self.current_item: Optional[QueueItem] = None
         self.previous_item: Optional[QueueItem] = None
-        self.files_to_del: list[Path] = []
-        self.player: Optional[YTDLSource] = None
-
-        self.advance_lock: bool = False
-        self.after_advance_queue: Optional[Callable] = None
+        self.file_cleaner = FileCleaner()
+        self.metadata_cache = MetadataCache()
+        self.library_index: Optional[LibraryIndex] = LibraryIndex(Path(cfg.LIBRARY_DIRECTORY), cfg.LIBRARY_EXTENSIONS) \
+            if cfg.LIBRARY_DIRECTORY else None
+        self.library_scan: Optional[asyncio.Task] = None
+        self.saved_playlists = SavedPlaylists()
+        # Related tracks for autoplay to pick from once the queue runs out, and the task preparing the next one
+        self.autoplay_enabled: bool = cfg.AUTOPLAY_ENABLED
+        self.autoplay_pool: list[media.TrackInfo] = []
+        self.autoplay_task: Optional[asyncio.Task] = None
+        self.playlist_warming: Optional[asyncio.Task] = None
+        # The day saved playlists were last warmed on, so it's only done once per warming period
+        self.playlist_warmed_on: Optional[int] = None
+        # Loudness measurements and effect renders in progress, by track ID
+        self.loudness_tasks: dict[str, asyncio.Task] = {}
+        self.render_tasks: dict[tuple[str, str], asyncio.Task] = {}
+        self.frame_tasks: dict[tuple[str, str], asyncio.Task] = {}
+        # Downloads still running for players that started out streaming, by track ID
+        self.download_tasks: dict[str, asyncio.Task] = {}
+        # How much of `downloads.memory-budget-mb` is taken up by tracks downloaded into memory, in bytes
+        self.memory_used: int = 0
+        # Background FFmpeg jobs are run one at a time
+        self.ffmpeg_semaphore = asyncio.Semaphore(1)
+        self.player: Optional[YTDLSource | ReplaySource] = None
+        # What was actually given to the voice client to play; either the player itself, or something wrapping it
+        self.output: Optional[AudioSource] = None
+        # An item taken from the queue early, along with its ready-to-play player, for gapless playback
+        self.prefetched: Optional[tuple[QueueItem, YTDLSource]] = None
+        # Whether the next item is being prepared for gapless playback right now; it stays in the queue until it's ready
+        self.prefetching: bool = False
+        # Effects applied to every new player, set by name with -effect; changing them only affects tracks that start afterwards
+        self.effect_preset: str = 'none'
+        self.effects: AudioEffects = EFFECT_PRESETS[self.effect_preset]
+        # Opus packets of the current item, recorded while it played, to replay from if it's looping
+        self.loop_packets: Optional[list[bytes]] = None
+        # Track ID and effect preset of the current item, if its packets are being recorded to be saved to the frame cache
+        self.frame_recording: Optional[tuple[str, str]] = None
+        # Where playback was when the voice connection dropped, to pick back up from once it's connected again
+        self.resume_point: Optional[tuple[commands.Context, float]] = None
+
+        self.state: PlayerState = PlayerState.IDLE
+        self.player_lock = asyncio.Lock()
 
         self.skip_votes_placed: list[Member] = []
 
-        self.paused_at: float = 0.0
-        self.pause_duration: float = 0.0
-        self.audio_time_elapsed: float = 0.0
+        self.inactivity_timer: Optional[asyncio.TimerHandle] = None
 
         self.now_playing_msg: Optional[Message] = None
         self.queue_msg: Optional[Message] = None
+        self.message_refresher = MessageRefresher(cfg.NOW_PLAYING_REFRESH_SECONDS)
+        self.stall_watchdog = StallWatchdog(cfg.STALL_TIMEOUT_SECONDS, self.elapsed_seconds,
+            lambda: (self.state == PlayerState.PLAYING) and bool(self.voice_client) and self.voice_client.is_playing())
+
+    async def cog_load(self):
+        self.file_cleaner.start()
+        if self.library_index:
+            self.library_scan = asyncio.create_task(self.library_index.scan())
+        if cfg.PLAYLIST_WARM_CACHE and cfg.FRAME_CACHE:
+            self.playlist_warming = asyncio.create_task(self.warm_saved_playlists())
+
+    async def cog_unload(self):
+        await self.file_cleaner.stop()
+        await self.stall_watchdog.stop()
+        for task in [*self.loudness_tasks.values(), *self.render_tasks.values(), *self.frame_tasks.values(),
+                *self.download_tasks.values(), *([self.library_scan] if self.library_scan else []),
+                *([self.playlist_warming] if self.playlist_warming else []), *([self.autoplay_task] if self.autoplay_task else [])]:
+            task.cancel()
+        self.metadata_cache.close()
+        self.saved_playlists.close()
+        if self.library_index:
+            self.library_index.close()
 
     @commands.Cog.listener()
-    async def on_voice_state_update(self, member: Member, before: VoiceState, after: VoiceState): # pylint: disable=unused-argument
-        """Listener for the voice state update event. Currently handles inactivity timeouts and tracks how long audio has been playing."""
+    async def on_message(self, message: Message):
+        """Listener for the message event. Lets the message refresher know when its messages are getting buried."""
+        self.message_refresher.note_message(message)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member: Member, before: VoiceState, after: VoiceState):
+        """Listener for the voice state update event. Starts the inactivity timer upon joining voice,
+        and discards the voice client once the bot has really disconnected.
+        """
         if not (member.id == self.bot.user.id):
             return
         if before.channel is None:
-            # Disconnect after set amount of inactivity
-            if cfg.INACTIVITY_TIMEOUT_MINS == 0:
+            self.update_inactivity_timer()
+        elif after.channel is None:
+            if self.voice_client is None:
                 return
-            timeout_counter = 0
-            while True:
-                await asyncio.sleep(1)
-                timeout_counter += 1
-
-                if self.voice_client is None:
-                    break
-
-                if self.voice_client.is_playing() and not self.voice_client.is_paused():
-                    timeout_counter = 0
-                    self.audio_time_elapsed += 1
-
-                if timeout_counter == cfg.INACTIVITY_TIMEOUT_MINS * 60:
-                    log.info('Leaving voice due to inactivity...')
-                    await self.voice_client.disconnect()
-                if not self.voice_client.is_connected():
-                    log.debug('Voice doesn\'t look connected, waiting three seconds...')
-                    await asyncio.sleep(3)
-                    if not self.voice_client.is_connected():
-                        log.debug('Still disconnected. Discarding voice client reference...')
-                        # Delay discarding this reference until we're sure that we actually disconnected
-                        # Sometimes a brief network hiccup can be detected as not being connected to voice,
-                        # even though the bot is still present in Discord...
-                        # ...in which case, if we discard our reference to it too soon, everything voice-related breaks
-                        self.voice_client = None
-                        break
-                    else:
-                        log.debug('Voice looks connected again. Continuing as normal...')
-
+            log.debug('Voice doesn\'t look connected, waiting three seconds...')
+            await asyncio.sleep(3)
+            if self.voice_client and not self.voice_client.is_connected():
+                log.debug('Still disconnected. Discarding voice client reference...')
+                # Delay discarding this reference until we're sure that we actually disconnected
+                # Sometimes a brief network hiccup can be detected as not being connected to voice,
+                # even though the bot is still present in Discord...
+                # ...in which case, if we discard our reference to it too soon, everything voice-related breaks
+                self.voice_client = None
+                self.update_inactivity_timer()
+            else:
+                log.debug('Voice looks connected again. Continuing as normal...')
+                if self.resume_point:
+                    await self.advance_queue(self.resume_point[0])
 
     #region COMMANDS
     @commands.command(aliases=command_aliases('test'))
@@ -224,6 +546,8 @@ class Voice(commands.Cog):
         """Joins the same voice channel the command user is connected to."""
         author = cast(Member, ctx.author)
         await ctx.send(embed=embedq(f'Joining voice channel: {author.voice.channel.name}'))
+        if self.resume_point:
+            await self.advance_queue(ctx)
 
     @commands.command(aliases=command_aliases('leave'))
     @commands.check(is_command_enabled)
@@ -232,12 +556,18 @@ class Voice(commands.Cog):
         """Leaves the currently connected to voice channel."""
         if self.voice_client.is_connected():
             log.info('Clearing the queue...')
+            self.discard_prefetched()
+            self.reset_autoplay()
             self.media_queue.clear()
             self.current_item = None
             self.previous_item = None
+            self.resume_point = None
+            self.message_refresher.unregister(self.now_playing_msg)
             log.info('Leaving voice channel: %s', self.voice_client.channel.name)
             await self.voice_client.disconnect()
             self.voice_client = None
+            await self.stall_watchdog.stop()
+            self.update_inactivity_timer()
         else:
             log.debug('No channel to leave.')
 
@@ -255,7 +585,7 @@ class Voice(commands.Cog):
             return
 
         queue_length_seconds = seconds_to_hms(sum(item.info.length_seconds for item in self.media_queue) +
-            self.current_item.info.length_seconds - self.audio_time_elapsed)
+            self.current_item.info.length_seconds - self.elapsed_seconds())
 
         embed = embedq(title=f'{len(self.media_queue)} items in queue.\n*(Approx. time remaining: {queue_length_seconds})*',)
         start = (10 * page) - 10
@@ -275,20 +605,151 @@ class Voice(commands.Cog):
 
     @commands.command(aliases=command_aliases('history'))
     @commands.check(is_command_enabled)
-    async def history(self, ctx: commands.Context):
-        """Shows recently played tracks, up to the amount set in configuration."""
-        if not any(item is not None for item in self.play_history):
+    async def history(self, ctx: commands.Context, member: Optional[Member]=None):
+        """Shows recently played tracks, up to the amount set in configuration.
+
+        @member: Only show tracks queued by this user.
+        """
+        if not cfg.MAX_HISTORY_LENGTH:
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' Play history is turned off.', 'This can be edited in the bot\'s configuration.'))
+            return
+        rows = self.metadata_cache.get_history(guild_id(ctx), cfg.MAX_HISTORY_LENGTH, member.id if member else None)
+        if not rows:
             await ctx.send(embed=embedq(EmojiStr.cancel + ' Play history is empty.'))
             return
 
-        history_embed = embedq('Recently played:')
-        for n, item in enumerate(self.play_history):
-            if not item:
-                continue
-            history_embed.add_field(name=f'#{n + 1}. {item.info.title}', value=item.info.artist, inline=False)
+        history_embed = embedq('Recently played:' if not member else f'Recently played from {member.display_name}:')
+        for n, row in enumerate(rows):
+            history_embed.add_field(name=f'#{n + 1}. {row['title']}', value=row['artist'] or '\u200b', inline=False)
 
         await ctx.send(embed=history_embed)
 
+    @commands.command(aliases=command_aliases('toptracks'))
+    @commands.check(is_command_enabled)
+    async def toptracks(self, ctx: commands.Context, member: Optional[Member]=None):
+        """Shows the tracks played the most on this server, out of its stored play history.
+
+        @member: Only count tracks queued by this user.
+        """
+        if not cfg.MAX_HISTORY_LENGTH:
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' Play history is turned off.', 'This can be edited in the bot\'s configuration.'))
+            return
+        rows = self.metadata_cache.top_tracks(guild_id(ctx), cfg.MAX_HISTORY_LENGTH, member.id if member else None)
+        if not rows:
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' Play history is empty.'))
+            return
+
+        top_embed = embedq('Most played:' if not member else f'Most played from {member.display_name}:')
+        for n, row in enumerate(rows):
+            top_embed.add_field(name=f'#{n + 1}. {row['title']}',
+                value=f'{row['artist'] + ' — ' if row['artist'] else ''}{row['plays']} play(s)', inline=False)
+
+        await ctx.send(embed=top_embed)
+
+    @commands.command(aliases=command_aliases('replay'))
+    @commands.check(is_command_enabled)
+    @commands.check(author_in_vc)
+    async def replay(self, ctx: commands.Context, count: int=1):
+        """Queues the most recently played tracks again, in the order they were played.
+
+        @count: How many tracks to queue, up to the amount set in configuration.
+        """
+        if not cfg.MAX_HISTORY_LENGTH:
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' Play history is turned off.', 'This can be edited in the bot\'s configuration.'))
+            return
+        if not 1 <= count <= cfg.MAX_HISTORY_LENGTH:
+            await ctx.send(embed=embedq(f'{EmojiStr.cancel} Between 1 and {cfg.MAX_HISTORY_LENGTH} tracks can be replayed at once.'))
+            return
+        if not (rows := self.metadata_cache.get_history(guild_id(ctx), count)):
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' Play history is empty.'))
+            return
+
+        items = [QueueItem(media.TrackInfo.from_index(row), cast(Member, ctx.author)) for row in reversed(rows)]
+        await self.play_or_enqueue(ctx, items if len(items) > 1 else items[0])
+
+    @commands.command(aliases=command_aliases('library'))
+    @commands.check(is_command_enabled)
+    async def library(self, ctx: commands.Context):
+        """Rescans the local music library for new, changed, or removed files. Tracks in it are found by searching with -play."""
+        if self.library_index is None:
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' No local library is set up.', 'This can be edited in the bot\'s configuration.'))
+            return
+        if self.library_scan and (not self.library_scan.done()):
+            await ctx.send(embed=embedq('The library is already being scanned.'))
+            return
+
+        scan_msg = await ctx.send(embed=embedq('Scanning the library...', 'Files that haven\'t changed are skipped.'))
+        self.library_scan = asyncio.create_task(self.library_index.scan())
+        changed, removed = await self.library_scan
+        await scan_msg.edit(embed=embedq(f'Library scanned: {len(self.library_index)} tracks.',
+            f'{changed} added or updated, {removed} removed.'))
+
+    @commands.command(aliases=command_aliases('playlist'))
+    @commands.check(is_command_enabled)
+    async def playlist(self, ctx: commands.Context, action: str='list', name: Optional[str]=None, url: Optional[str]=None):
+        """Saves playlists for this server, already matched to what will be played, so they can be queued instantly.
+
+        @action: `save [name] [url]` to save a playlist, `refresh [name]` to update one from where it was saved from,
+            `delete [name]` to delete one, `list` to show every saved playlist, or the name of a saved playlist to queue it.
+        """
+        if action == 'list':
+            if not (playlists := self.saved_playlists.list_playlists(guild_id(ctx))):
+                await ctx.send(embed=embedq('No playlists have been saved yet.', 'Save one with -playlist save [name] [url].'))
+                return
+            list_embed = embedq('Saved playlists:', 'Queue one with -playlist [name].')
+            for row in playlists:
+                list_embed.add_field(name=row['name'], value=f'{row['tracks']} tracks — {row['url']}', inline=False)
+            await ctx.send(embed=list_embed)
+            return
+
+        if action == 'delete':
+            if name and self.saved_playlists.delete(guild_id(ctx), name):
+                await ctx.send(embed=embedq(f'{EmojiStr.confirm} Deleted the saved playlist "{name}".'))
+            else:
+                await ctx.send(embed=embedq(f'{EmojiStr.cancel} There\'s no saved playlist named "{name}".'))
+            return
+
+        if action in ('save', 'refresh'):
+            if (not name) or ((action == 'save') and (not url)):
+                await ctx.send(embed=embedq(f'{EmojiStr.cancel} A name and a playlist URL are needed.',
+                    'Use -playlist save [name] [url], or -playlist refresh [name].'))
+                return
+            if name in PLAYLIST_ACTIONS:
+                await ctx.send(embed=embedq(f'{EmojiStr.cancel} "{name}" can\'t be used as a playlist name.'))
+                return
+            if not cfg.ALLOW_MEDIALISTS:
+                await ctx.send(embed=embedq(EmojiStr.cancel + ' Queueing playlists/albums is disabled.',
+                    'This can be edited in the bot\'s configuration.'))
+                return
+            if action == 'refresh':
+                if (saved := self.saved_playlists.get(guild_id(ctx), name)) is None:
+                    await ctx.send(embed=embedq(f'{EmojiStr.cancel} There\'s no saved playlist named "{name}".'))
+                    return
+                url = saved['url']
+            # Tracks that were already in the playlist are kept as they were resolved last time
+            known = {row['origin_url']: row for row in self.saved_playlists.tracks(guild_id(ctx), name)}
+
+            save_msg = await ctx.send(embed=embedq(f'Fetching "{name}"...', 'Tracks are matched the first time only, so this can take a while.'))
+            try:
+                tracks, matched, missing = await self.resolve_playlist(cast(str, url), known)
+            except (media.MediaError, PlaylistLimitError, yt_dlp.utils.DownloadError) as e:
+                await save_msg.edit(embed=embedq(f'{EmojiStr.cancel} Couldn\'t save this playlist.', str(e)))
+                return
+            self.saved_playlists.save(guild_id(ctx), name, cast(str, url), ctx.author.id, tracks)
+            await save_msg.edit(embed=embedq(f'{EmojiStr.confirm} Saved "{name}" with {len(tracks)} tracks.',
+                f'{matched} new or changed' + (f', {missing} couldn\'t be matched and were left out.' if missing else '.') +
+                f' Queue it with -playlist {name}.'))
+            return
+
+        if not (rows := self.saved_playlists.tracks(guild_id(ctx), action)):
+            await ctx.send(embed=embedq(f'{EmojiStr.cancel} There\'s no saved playlist named "{action}".',
+                'See which ones are saved with -playlist list.'))
+            return
+        if not await author_in_vc(ctx):
+            return
+        await self.ensure_voice(ctx)
+        await self.play_or_enqueue(ctx, [QueueItem(media.TrackInfo.from_index(row), cast(Member, ctx.author)) for row in rows])
+
     @commands.command(aliases=command_aliases('move'))
     @commands.check(is_command_enabled)
     @commands.check(author_in_vc)
@@ -351,6 +812,28 @@ class Voice(commands.Cog):
                 return
         await ctx.send(embed=embedq(f'{EmojiStr.dice} Roulette mode is {'ON' if self.media_queue.roulette_mode else 'OFF'}.'))
 
+    @commands.command(aliases=command_aliases('autoplay'))
+    @commands.check(is_command_enabled)
+    @commands.check(author_in_vc)
+    async def autoplay(self, ctx: commands.Context, toggle: str=''):
+        """Toggles autoplay. If no argument is given, autoplay will be turned on if its currently off, and vice versa.
+        Alternatively, you can use "autoplay on" or "autoplay off" to toggle it explicitly.
+
+        If autoplay is enabled, tracks related to what's been playing will keep being played once the queue runs out.
+        """
+        if toggle not in ['on', 'off', '']:
+            await ctx.send(embed=embedq(f'{EmojiStr.cancel} Invalid option; must be either "on" or "off"'))
+            return
+        self.autoplay_enabled = {'on': True, 'off': False, '': not self.autoplay_enabled}[toggle]
+        log.info('Autoplay changed to %s.', self.autoplay_enabled)
+        if self.autoplay_enabled:
+            self.schedule_autoplay(ctx)
+        else:
+            if self.prefetched and self.is_autoplay_item(self.prefetched[0]):
+                self.discard_prefetched()
+            self.reset_autoplay()
+        await ctx.send(embed=embedq(f'{EmojiStr.radio} Autoplay is {'ON' if self.autoplay_enabled else 'OFF'}.'))
+
     @commands.command(aliases=command_aliases('remove'))
     @commands.check(is_command_enabled)
     @commands.check(author_in_vc)
@@ -372,6 +855,7 @@ class Voice(commands.Cog):
     async def clear(self, ctx: commands.Context):
         """Removes everything from the queue."""
         log.info('Clearing the queue...')
+        self.discard_prefetched()
         if self.media_queue:
             self.media_queue.clear()
             await ctx.send(embed=embedq(f'{EmojiStr.outbox} Queue is now empty.'))
@@ -401,7 +885,7 @@ class Voice(commands.Cog):
 
             if (not cfg.VOTE_TO_SKIP) or (len(self.skip_votes_placed) >= vote_requirement_real):
                 skip_msg = await edit_or_send(ctx, skip_msg, embed=embedq(EmojiStr.skip + ' Skipping...'))
-                self.voice_client.stop()
+                await self.fade_out_output()
                 await self.advance_queue(ctx, skipping=True)
                 skip_msg = await skip_msg.delete()
         else:
@@ -433,30 +917,90 @@ class Voice(commands.Cog):
     @commands.check(author_in_vc)
     async def pause(self, ctx: commands.Context):
         """Pauses the player."""
-        if self.voice_client.is_playing():
+        # Only touches the voice client, so this doesn't wait for the queue to finish advancing
+        if self.state == PlayerState.PLAYING:
             log.info('Pausing audio...')
             self.voice_client.pause()
-            self.paused_at = time.time()
-        elif self.voice_client.is_paused():
+            self.set_state(PlayerState.PAUSED)
+            self.update_inactivity_timer()
+        elif self.state == PlayerState.PAUSED:
             await ctx.send(embed=embedq('Already paused. Use `play` to unpause.'))
         else:
             await ctx.send(embed=embedq('Nothing to pause.'))
 
+    @commands.command(aliases=command_aliases('seek'))
+    @commands.check(is_command_enabled)
+    @commands.check(author_in_vc)
+    async def seek(self, ctx: commands.Context, timestamp: str):
+        """Jumps to a point in the current track.
+
+        @timestamp: Where to jump to, either as a number of seconds or formatted like 1:30 or 1:02:30.
+        """
+        try:
+            seconds = hms_to_seconds(timestamp)
+        except ValueError:
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' Invalid timestamp; use a number of seconds, or a format like 1:30.'))
+            return
+
+        if (self.current_item is None) or (self.state not in (PlayerState.PLAYING, PlayerState.PAUSED)):
+            await ctx.send(embed=embedq('Nothing is playing.'))
+            return
+        if self.current_item.info.is_live:
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' Can\'t seek in a live stream.'))
+            return
+        if self.current_item.info.length_seconds and (seconds >= self.current_item.info.length_seconds):
+            await ctx.send(embed=embedq(EmojiStr.cancel + ' That\'s past the end of the track.',
+                f'This track is {self.current_item.info.length_hms()} long.'))
+            return
+
+        if await self.seek_to(ctx, seconds):
+            await ctx.send(embed=embedq(f'{EmojiStr.arrow_r} Jumped to {seconds_to_hms(seconds)}.'))
+        else:
+            await ctx.send(embed=embedq('Couldn\'t seek in this track.'))
+
+    @commands.command(aliases=command_aliases('effect'))
+    @commands.check(is_command_enabled)
+    @commands.check(author_in_vc)
+    async def effect(self, ctx: commands.Context, preset: str=''):
+        """Sets an audio effect to apply to tracks from the next one onward. Shows the available effects if none is given.
+        Use "effect none" to turn effects off.
+
+        @preset: The name of the effect to use.
+        """
+        presets_text = ', '.join(f'`{name}`' for name in EFFECT_PRESETS)
+        if preset == '':
+            await ctx.send(embed=embedq(f'Current effect: {self.effect_preset}', f'Available effects: {presets_text}'))
+            return
+        if preset.lower() not in EFFECT_PRESETS:
+            await ctx.send(embed=embedq(EmojiStr.cancel + f' There\'s no effect called "{preset}".', f'Available effects: {presets_text}'))
+            return
+
+        self.effect_preset = preset.lower()
+        self.effects = EFFECT_PRESETS[self.effect_preset]
+        log.info('Effect changed to %s.', self.effect_preset)
+        # A track that's already been prepared would still have the old effect
+        self.discard_prefetched(requeue=True)
+        await ctx.send(embed=embedq(f'Effect set to {self.effect_preset}.', 'This will apply from the next track onward.'))
+
     @commands.command(aliases=command_aliases('stop'))
     @commands.check(is_command_enabled)
     @commands.check(author_in_vc)
-    async def stop(self, ctx: commands.Context): # pylint: disable=unused-argument
+    async def stop(self, ctx: commands.Context):
         """Stops the player, and clears the remaining queue."""
         log.info('Stopping player and clearing the queue...')
-        self.voice_client.stop()
+        self.resume_point = None
+        self.discard_prefetched()
+        self.reset_autoplay()
         self.media_queue.clear()
+        await self.fade_out_output()
+        await self.advance_queue(ctx, skipping=True)
 
     @commands.command(aliases=command_aliases('nowplaying'))
     @commands.check(is_command_enabled)
     async def nowplaying(self, ctx: commands.Context):
-        """Shows what's currently playing, if any exists."""
-        if self.voice_client.is_playing():
-            await ctx.send(embed=self.embed_now_playing())
+        """Shows what's currently playing, if any exists. Replaces the previous "Now playing" message, if there was one."""
+        if self.voice_client.is_playing() or self.voice_client.is_paused():
+            await self.send_now_playing(ctx)
         else:
             await ctx.send(embed=embedq('Nothing is playing.'))
 
@@ -472,40 +1016,19 @@ class Voice(commands.Cog):
         log.debug('Args: queries=%s', repr(queries))
 
         ctx.author = cast(Member, ctx.author)
-
-        async def play_or_enqueue(item: QueueItem | list[QueueItem]):
-            """Adds the given `QueueItem` to the media queue. If the queue is empty, the item will attempt to play immediately.
-            Otherwise, the item is appended to the queue.
-
-            @item: Either a single `QueueItem` or a list of `QueueItem`s to queue up.
-            """
-            log.info('Adding to queue...')
-            queue_was_empty = self.media_queue == []
-            item_index = self.media_queue.enqueue(item)
-
-            if isinstance(item, list):
-                item_index = cast(tuple[int, int], item_index)
-                self.queue_msg = await edit_or_send(ctx, self.queue_msg,
-                    embed=embedq(f'{EmojiStr.inbox} Added {len(item)} items to the queue, from #{item_index[0] + 1} to #{item_index[1] + 1}.'))
-
-            if (not self.voice_client.is_playing()) and (queue_was_empty):
-                log.info('Voice client is not playing and the queue is empty, going to try playing...')
-                starting_msg = await ctx.send(embed=embedq('Starting...'))
-                await self.advance_queue(ctx)
-                starting_msg = await starting_msg.delete()
-            else:
-                if isinstance(item, QueueItem):
-                    self.queue_msg = await edit_or_send(ctx, self.queue_msg,
-                        embed=embedq(f'{EmojiStr.inbox} Added {item.info.title} to the queue at spot #{cast(int, item_index) + 1}'))
+        # Audio files uploaded along with the command are queued like links to them
+        queries = (*queries, *(attachment.url for attachment in ctx.message.attachments
+            if (attachment.content_type or '').startswith(('audio/', 'video/', 'application/ogg'))))
 
         # Using -play alone with no args should resume the bot if we're paused, otherwise cancel
         if not queries:
-            if self.voice_client.is_paused():
+            if self.state == PlayerState.PAUSED:
                 log.debug('Player is paused; resuming...')
                 self.voice_client.resume()
+                self.set_state(PlayerState.PLAYING)
+                self.update_inactivity_timer()
                 await ctx.send(embed=embedq(f'{EmojiStr.play} Player is resuming.'))
-                self.pause_duration = time.time() - self.paused_at
-            elif (not self.voice_client.is_playing()) and (self.media_queue != []):
+            elif (self.state == PlayerState.IDLE) and (self.media_queue != []):
                 await ctx.send(embed=embedq(f'{EmojiStr.play} Starting queue...'))
                 await self.advance_queue(ctx, skipping=True)
             else:
@@ -534,17 +1057,34 @@ class Voice(commands.Cog):
             if plain_strings:
                 search_query: str = ' '.join(plain_strings)
                 log.debug('Using plain-text search: %s', search_query)
-                top = media.search_ytmusic_text(search_query)
+                # The local library is checked first, since it doesn't need the network
+                local: list[media.TrackInfo] = [media.TrackInfo.from_library(row)
+                    for row in self.library_index.search(search_query, limit=1)] if self.library_index else []
+                if local and cfg.USE_TOP_MATCH:
+                    log.debug('USE_TOP_MATCH on, queueing top library result...')
+                    await self.play_or_enqueue(ctx, QueueItem(local[0], ctx.author))
+                    return
+                if cfg.SEARCH_PLAY_HISTORY and (played := self.find_played_track(search_query)):
+                    log.debug('Queueing a close match among previously played tracks...')
+                    await self.play_or_enqueue(ctx, QueueItem(played, ctx.author))
+                    return
+                try:
+                    top = await look_up(media.search_ytmusic_text, search_query)
+                except requests.RequestException as e:
+                    if not local:
+                        raise
+                    log.warning('Couldn\'t search YouTube Music, only showing library results: %s', e)
+                    top = {'songs': [], 'videos': [], 'albums': []}
 
                 if cfg.USE_TOP_MATCH:
                     log.debug('USE_TOP_MATCH on.')
                     if top['songs']:
                         log.debug('Queueing top song...')
-                        await play_or_enqueue(QueueItem(top['songs'][0], ctx.author)) # pylint: disable=unsubscriptable-object
+                        await self.play_or_enqueue(ctx, QueueItem(top['songs'][0], ctx.author)) # pylint: disable=unsubscriptable-object
                         return
                     elif top['videos']:
                         log.debug('Queueing top video...')
-                        await play_or_enqueue(QueueItem(top['videos'][0], ctx.author)) # pylint: disable=unsubscriptable-object
+                        await self.play_or_enqueue(ctx, QueueItem(top['videos'][0], ctx.author)) # pylint: disable=unsubscriptable-object
                         return
                     else:
                         await ctx.send(embed=embedq(f'{EmojiStr.cancel} No close matches could be found.'))
@@ -565,8 +1105,8 @@ class Voice(commands.Cog):
 
                 choice_options, choice_embed = assemble_choices(
                     choice_embed,
-                    [top['songs'], top['videos'], top['albums']],
-                    ['song', 'video', 'album']
+                    [local, top['songs'], top['videos'], top['albums']],
+                    ['library', 'song', 'video', 'album']
                     )
 
                 choice_prompt = await ctx.send(embed=choice_embed)
@@ -576,7 +1116,7 @@ class Voice(commands.Cog):
                     return
 
                 choice = choice_options[choice]
-                await play_or_enqueue(QueueItem(choice, ctx.author) if not choice.contents else QueueItem.from_list(choice.contents, ctx.author))
+                await self.play_or_enqueue(ctx, QueueItem(choice, ctx.author) if not choice.contents else QueueItem.from_list(choice.contents, ctx.author))
                 return
             #endregion play: PLAIN TEXT
 
@@ -591,14 +1131,15 @@ class Voice(commands.Cog):
             # Does Spotify even use spotify.link URLs anymore? I can barely test this because I can't seem to get one now
             url_strings = [requests.get(u, timeout=1).url if u.startswith('https://spotify.link') else u for u in url_strings]
 
-            if len(url_strings) > 1 and any(re.findall(r"(playlist|album|sets)", link) for link in url_strings):
+            if len(url_strings) > 1 and any(re.findall(r"(playlist|album|sets)", link) for link in url_strings
+                    if not media.is_discord_attachment(link)):
                 log.debug('Cancelling play command: album/playlist URL present in a set of URLs.')
                 await ctx.send(embed=embedq(f'{EmojiStr.cancel} Albums or playlists must be queued on their own.',
                     'Multi-URL queueing is allowed only for single tracks.'))
                 return
 
             # Handle playlists, albums
-            if re.findall(r"(playlist|album|sets)", url_strings[0]):
+            if re.findall(r"(playlist|album|sets)", url_strings[0]) and (not media.is_discord_attachment(url_strings[0])):
                 if not cfg.ALLOW_MEDIALISTS:
                     await ctx.send(embed=embedq(EmojiStr.cancel + ' Queueing playlists/albums is disabled.',
                         'This can be edited in the bot\'s configuration.'))
@@ -606,32 +1147,15 @@ class Voice(commands.Cog):
                 log.debug('URL looks like a playlist or an album.')
                 # Because of the previous checks we know this has to only be one URL, no need to keep the list
                 url = url_strings[0]
-                media_list: Optional[media.PlaylistInfo | media.AlbumInfo] = None
-
-                if re.findall(r"https://(?:music\.|www\.|)youtube\.com/playlist\?list=", url):
-                    # Convert to a normal YouTube playlist URL because dealing with YTMusic playlists/albums are a hassle
-                    media_list = media.PlaylistInfo.from_ytdl(url.replace('music.', 'www.'))
-                elif url.startswith('https://open.spotify.com/album/'):
-                    if not media.sp:
-                        await ctx.send(embed=CommonMsg.spotify_functions_unavailable())
-                        return
-                    media_list = media.AlbumInfo.from_spotify_url(url)
-                elif url.startswith('https://open.spotify.com/playlist/'):
-                    if not media.sp:
-                        await ctx.send(embed=CommonMsg.spotify_functions_unavailable())
-                        return
-                    try:
-                        media_list = media.PlaylistInfo.from_spotify_url(url)
-                    except media.MediaError:
-                        await self.queue_msg.edit(embed=embedq(f'{EmojiStr.cancel} Couldn\'t retrieve playlist from Spotify.',
-                            'The playlist may be private, or the link may be invalid.'))
-                        return
-                elif re.findall(r"https://soundcloud\.com/\w+/sets/", url):
-                    media_list = media.soundcloud_set(url)
-                elif re.findall(r"https://\w+\.bandcamp\.com/album/", url):
-                    media_list = media.AlbumInfo.from_other(url)
-                else:
-                    media_list = media.PlaylistInfo.from_other(url)
+                if url.startswith('https://open.spotify.com/') and not media.sp:
+                    await ctx.send(embed=CommonMsg.spotify_functions_unavailable())
+                    return
+                try:
+                    media_list = await look_up(media.media_list_from_url, url)
+                except media.MediaError:
+                    await self.queue_msg.edit(embed=embedq(f'{EmojiStr.cancel} Couldn\'t retrieve playlist from Spotify.',
+                        'The playlist may be private, or the link may be invalid.'))
+                    return
 
                 # Final checks
                 if isinstance(media_list, media.AlbumInfo) and (len(media_list.contents) > cfg.MAX_ALBUM_LENGTH):
@@ -648,7 +1172,7 @@ class Voice(commands.Cog):
                     log.debug('Trying to match Spotify album to YouTube Music...')
                     await self.queue_msg.edit(embed=embedq('Trying to match this Spotify album with a YouTube Music equivalent...',
                         'This can take a few seconds...'))
-                    if match_result := media.match_ytmusic_album(media_list, threshold=50):
+                    if match_result := await match_album(media_list, threshold=50):
                         yt_album = match_result[0]
                         await self.queue_msg.edit(embed=embedq('A possible match was found. Queue this album?') \
                             .add_field(name=yt_album.album_name, value=yt_album.artist).set_thumbnail(url=yt_album.thumbnail))
@@ -663,7 +1187,7 @@ class Voice(commands.Cog):
                         return
 
                 # If we've reached here, something was successfully found and can be queued without issue
-                await play_or_enqueue(QueueItem.from_list(media_list.contents, ctx.author))
+                await self.play_or_enqueue(ctx, QueueItem.from_list(media_list.contents, ctx.author))
                 return
             else:
                 # Single track links
@@ -673,33 +1197,50 @@ class Voice(commands.Cog):
                     await self.queue_msg.edit(embed=embedq(f'Queueing item {n + 1} of {len(url_strings)}...', url))
                     if re.findall(r"https://(?:music\.|www\.|)youtube\.com/watch\?v=", url):
                         log.debug('Looks like a YouTube Music or YouTube URL, creating QueueItem...')
-                        to_queue.append(QueueItem(media.TrackInfo.from_pytube(url), ctx.author))
+                        to_queue.append(QueueItem(await look_up(media.TrackInfo.from_pytube, url), ctx.author))
                     elif url.startswith('https://open.spotify.com/track/'):
                         if not media.sp:
                             await ctx.send(embed=CommonMsg.spotify_functions_unavailable())
                             return
                         log.debug('Looks like a Spotify URL, creating QueueItem...')
-                        to_queue.append(QueueItem(media.TrackInfo.from_spotify_url(url), ctx.author))
+                        to_queue.append(QueueItem(await look_up(media.TrackInfo.from_spotify_url, url), ctx.author))
                     elif url.startswith('https://soundcloud.com/'):
                         log.debug('Looks like a SoundCloud URL, creating QueueItem...')
-                        to_queue.append(QueueItem(media.TrackInfo.from_soundcloud_url(url), ctx.author))
+                        to_queue.append(QueueItem(await look_up(media.TrackInfo.from_soundcloud_url, url), ctx.author))
+                    elif media.is_discord_attachment(url):
+                        log.debug('Looks like a Discord attachment, probing it...')
+                        if (probe := await probe_media(url)) is None:
+                            await ctx.send(embed=embedq(f'{EmojiStr.cancel} This file couldn\'t be read as audio.', url))
+                            continue
+                        if cfg.DURATION_LIMIT_SECONDS and (probe.duration > cfg.DURATION_LIMIT_SECONDS):
+                            await ctx.send(embed=embedq(f'{EmojiStr.cancel} This file is longer than the duration limit.',
+                                f'Current limit is set to {cfg.DURATION_LIMIT_HOURS} hour(s).'))
+                            continue
+                        to_queue.append(QueueItem(media.TrackInfo.from_probe(url, probe), ctx.author))
+                    elif direct := await look_up(media.TrackInfo.from_direct_url, url):
+                        log.debug('Looks like a direct link to audio, creating QueueItem...')
+                        to_queue.append(QueueItem(direct, ctx.author))
                     else:
                         log.debug('Creating QueueItem generically...')
-                        to_queue.append(QueueItem(media.TrackInfo.from_other(url), ctx.author))
-                await play_or_enqueue(to_queue if len(to_queue) > 1 else to_queue[0])
+                        to_queue.append(QueueItem(await look_up(media.TrackInfo.from_other, url), ctx.author))
+                if not to_queue:
+                    return
+                await self.play_or_enqueue(ctx, to_queue if len(to_queue) > 1 else to_queue[0])
                 return
             #endregion FROM URL
 
     @join.before_invoke
     @leave.before_invoke
     @play.before_invoke
+    @replay.before_invoke
     @skip.before_invoke
+    @seek.before_invoke
     @stop.before_invoke
     @nowplaying.before_invoke
     async def ensure_voice(self, ctx: commands.Context):
         """Cancels the command if a voice connection wasn't found, and the command isn't allowed to auto connect."""
         author = cast(Member, ctx.author)
-        auto_connect_commands = ['join', 'play']
+        auto_connect_commands = ['join', 'play', 'playlist', 'replay']
         if (not self.voice_client) and author.voice:
             if ctx.command.name in auto_connect_commands:
                 log.info('Joining voice channel: %s', author.voice.channel.name)
@@ -715,11 +1256,137 @@ class Voice(commands.Cog):
     #region END OF COMMANDS
     #endregion END OF COMMANDS
 
+    async def play_or_enqueue(self, ctx: commands.Context, item: QueueItem | list[QueueItem]):
+        """Adds the given `QueueItem` to the media queue. If the queue is empty, the item will attempt to play immediately.
+        Otherwise, the item is appended to the queue.
+
+        @item: Either a single `QueueItem` or a list of `QueueItem`s to queue up.
+        """
+        log.info('Adding to queue...')
+        if self.prefetched and self.is_autoplay_item(self.prefetched[0]):
+            # Queued tracks always play before autoplay picks anything
+            self.discard_prefetched()
+        item_index = self.media_queue.enqueue(item)
+
+        if isinstance(item, list):
+            item_index = cast(tuple[int, int], item_index)
+            self.queue_msg = await edit_or_send(ctx, self.queue_msg,
+                embed=embedq(f'{EmojiStr.inbox} Added {len(item)} items to the queue, from #{item_index[0] + 1} to #{item_index[1] + 1}.'))
+
+        if self.state == PlayerState.IDLE:
+            log.info('Player is idle, going to try playing...')
+            starting_msg = await ctx.send(embed=embedq('Starting...'))
+            await self.advance_queue(ctx)
+            starting_msg = await starting_msg.delete()
+        else:
+            if isinstance(item, QueueItem):
+                self.queue_msg = await edit_or_send(ctx, self.queue_msg,
+                    embed=embedq(f'{EmojiStr.inbox} Added {item.info.title} to the queue at spot #{cast(int, item_index) + 1}'))
+
+    async def resolve_playlist(self, url: str, known: dict[str, sqlite3.Row]) -> tuple[list[tuple[str, media.TrackInfo]], int, int]:
+        """Fetches the playlist or album at `url`, and resolves each of its tracks to what will be played, matching Spotify tracks
+        to YouTube Music without prompting. Returns each track along with its URL in the original playlist, how many tracks had to
+        be resolved, and how many couldn't be matched and were left out.
+
+        @known: Tracks resolved before, by their URL in the original playlist, as stored by `SavedPlaylists`; these are reused as-is.
+        """
+        media_list = await look_up(media.media_list_from_url, url)
+        if len(media_list.contents) > cfg.SAVED_PLAYLIST_LIMIT:
+            raise PlaylistLimitError(f'It has {len(media_list.contents)} tracks; the current limit is set to {cfg.SAVED_PLAYLIST_LIMIT}.')
+
+        tracks: list[tuple[str, media.TrackInfo]] = []
+        resolved = missing = 0
+        for track in media_list.contents:
+            if (row := known.get(track.url)) is not None:
+                tracks.append((track.url, media.TrackInfo.from_index(row)))
+                continue
+            resolved += 1
+            if track.source != media.SPOTIFY:
+                tracks.append((track.url, track))
+                continue
+            matches = await match_track(track)
+            if isinstance(matches, list):
+                if not matches:
+                    log.info('Couldn\'t match "%s" to YouTube Music; leaving it out of the playlist.', track.title)
+                    missing += 1
+                    continue
+                matches = matches[0]
+            tracks.append((track.url, matches))
+        log.debug('Resolved %s of %s playlist tracks; %s left out.', resolved, len(media_list.contents), missing)
+        return tracks, resolved - missing, missing
+
+    async def warm_saved_playlists(self) -> None:
+        """Saves the tracks of every saved playlist to the frame cache ahead of time, once a day, during the hours set by
+        `saved-playlists`. Only runs while nothing is playing, and stops as soon as something starts. Runs until the cog is unloaded.
+        """
+        def can_warm() -> bool:
+            start, end, now = cfg.PLAYLIST_WARM_FROM_HOUR, cfg.PLAYLIST_WARM_UNTIL_HOUR, time.localtime()
+            in_hours = (start <= now.tm_hour < end) if start <= end else (now.tm_hour >= start or now.tm_hour < end)
+            return in_hours and (self.state == PlayerState.IDLE) and (self.playlist_warmed_on != now.tm_yday)
+
+        while True:
+            if can_warm():
+                tracks = [row for row in self.saved_playlists.all_tracks() if row['source'] not in (media.DIRECT, media.LOCAL)]
+                log.info('Warming the cache with %s track(s) from saved playlists...', len(tracks))
+                for row in tracks:
+                    if not can_warm():
+                        log.info('Stopped warming the cache; it will continue next time.')
+                        break
+                    await self.warm_track(media.TrackInfo.from_index(row))
+                else:
+                    self.playlist_warmed_on = time.localtime().tm_yday
+                    log.info('Finished warming the cache.')
+            await asyncio.sleep(PLAYLIST_WARM_CHECK_SECONDS)
+
+    async def warm_track(self, info: media.TrackInfo) -> None:
+        """Downloads a track and saves it to the frame cache the way it'd be played right now, measuring its loudness first
+        so it's saved at the right volume. Does nothing if it's already in the frame cache.
+        """
+        if ((track := self.metadata_cache.find_track(media.canonical_url(info.url))) is not None) and \
+                self.metadata_cache.get_frame_file(track['track_id'], self.effect_preset):
+            return
+        try:
+            player = await YTDLSource.from_url(info.url, loop=self.bot.loop, stream=False, effects=self.effects, bitrate=self.channel_bitrate())
+        except yt_dlp.utils.DownloadError:
+            log.info('Couldn\'t download "%s" to warm the cache; skipping it.', info.title)
+            return
+
+        try:
+            if not player.filepath.is_file():
+                return
+            self.metadata_cache.store_track(player.track_id, title=player.title,
+                url=media.canonical_url(player.data.get('webpage_url') or info.url), duration=player.data.get('duration'))
+            length = seconds_to_frames((player.data.get('duration') or info.length_seconds) / player.effects.speed)
+            if not 0 < length <= seconds_to_frames(FRAME_CACHE_MAX_TRACK_SECONDS):
+                return
+            if cfg.LOUDNESS_NORMALIZATION and (self.metadata_cache.get_loudness(player.track_id) is None):
+                await self.analyze_loudness(player)
+            else:
+                self.apply_loudness(player)
+
+            recorder = OpusRecorder(player, length + seconds_to_frames(5))
+            def record():
+                while recorder.read():
+                    pass
+            async with self.ffmpeg_semaphore:
+                await asyncio.get_running_loop().run_in_executor(None, record)
+            if recorder.complete:
+                await self.write_frames(player.track_id, self.effect_preset, recorder.packets)
+        except OpusNotLoaded:
+            log.debug('Opus library isn\'t loaded; the cache can\'t be warmed.')
+        finally:
+            player.cleanup()
+            self.delete_player_file(player)
+
     def get_queued_by_text(self, member: Member) -> str:
         """Returns the nickname (if set, username otherwise) of who queued the current item if that is enabled,
         otherwise an empty string.
         """
-        return f'\nQueued by {member.nick or member.name}' if cfg.SHOW_USERS_IN_QUEUE else ''
+        if not cfg.SHOW_USERS_IN_QUEUE:
+            return ''
+        if member.id == self.bot.user.id:
+            return '\nPicked by autoplay'
+        return f'\nQueued by {member.nick or member.name}'
 
     def get_loop_icon(self) -> str:
         """Returns a looping emoji is looping is enabled, nothing otherwise."""
@@ -731,8 +1398,8 @@ class Voice(commands.Cog):
         @show_elapsed: Show the elapsed time alongside the track length, i.e. "1:02 / 2:56"
         """
         item = cast(QueueItem, self.current_item)
-        elapsed_hms: str = cast(str, seconds_to_hms(self.audio_time_elapsed))
-        length_hms: Optional[str] = item.info.length_hms(format_zero=False)
+        elapsed_hms: str = cast(str, seconds_to_hms(self.elapsed_seconds()))
+        length_hms: Optional[str] = 'LIVE' if item.info.is_live else item.info.length_hms(format_zero=False)
         submitter_text: str = self.get_queued_by_text(cast(Member, item.queued_by))
         loop_icon: str = self.get_loop_icon()
 
@@ -742,135 +1409,911 @@ class Voice(commands.Cog):
             description=f'Link: {item.info.url}{submitter_text}', color=cfg.EMBED_COLOR).set_thumbnail(url=item.info.thumbnail)
         return embed
 
-    async def advance_queue(self, ctx: commands.Context, skipping: bool=False):
+    def elapsed_seconds(self) -> float:
+        """Returns how far into the current track playback is, in seconds. Counted from audio frames, so time spent paused
+        or buffering is never included.
+        """
+        return self.player.elapsed_seconds if self.player else 0.0
+
+    def update_inactivity_timer(self) -> None:
+        """Schedules leaving voice once `inactivity-timeout` minutes have passed if nothing is playing,
+        or cancels that if something is. Should be called whenever playback starts, stops, pauses, or resumes.
+        """
+        if self.inactivity_timer:
+            self.inactivity_timer.cancel()
+            self.inactivity_timer = None
+        if (cfg.INACTIVITY_TIMEOUT_MINS == 0) or (self.voice_client is None) or self.voice_client.is_playing():
+            return
+        self.inactivity_timer = self.bot.loop.call_later(cfg.INACTIVITY_TIMEOUT_MINS * 60,
+            lambda: asyncio.create_task(self.leave_for_inactivity()))
+
+    async def leave_for_inactivity(self) -> None:
+        """Disconnects from voice, if nothing started playing since the inactivity timer was set."""
+        self.inactivity_timer = None
+        if self.voice_client and not self.voice_client.is_playing():
+            log.info('Leaving voice due to inactivity...')
+            await self.voice_client.disconnect()
+            self.stall_watchdog.cancel()
+
+    def has_listeners(self) -> bool:
+        """Returns whether anyone other than bots is connected to the bot's voice channel."""
+        return (self.voice_client is not None) and any(not member.bot for member in self.voice_client.channel.members)
+
+    async def send_now_playing(self, ctx: commands.Context) -> None:
+        """Sends a new "Now playing" message, deleting the previous one if it exists.
+        The new message will keep its elapsed time updated if `now-playing.refresh-interval` is set.
+        """
+        if self.now_playing_msg:
+            self.message_refresher.unregister(self.now_playing_msg)
+            self.now_playing_msg = await self.now_playing_msg.delete()
+
+        live: bool = cfg.NOW_PLAYING_REFRESH_SECONDS > 0
+        self.now_playing_msg = await ctx.send(embed=self.embed_now_playing(show_elapsed=live))
+        if live:
+            self.message_refresher.register(self.now_playing_msg, self.embed_now_playing,
+                is_viewed=lambda: (self.current_item is not None) and self.has_listeners())
+
+    def set_state(self, state: PlayerState) -> None:
+        """Moves the player into a new state, warning if it isn't a transition that's expected to happen."""
+        if (state != self.state) and (state not in PLAYER_TRANSITIONS[self.state]):
+            log.warning('Unexpected player state transition: %s -> %s', self.state.name, state.name)
+        log.debug('Player state: %s -> %s', self.state.name, state.name)
+        self.state = state
+        if state == PlayerState.IDLE:
+            # Nothing to watch until start_output() plays something again
+            self.stall_watchdog.cancel()
+
+    def add_to_history(self, ctx: commands.Context, item: Optional[QueueItem], player: Optional[YTDLSource | ReplaySource]) -> None:
+        """Adds a finished item to this server's play history, unless it was also the previous item (i.e. it was looping).
+        Discord attachments are left out, since their links stop working after a while.
+        """
+        if (not cfg.MAX_HISTORY_LENGTH) or (not item) or (not player) or (item == self.previous_item) \
+            or media.is_discord_attachment(item.info.url):
+            return
+        self.metadata_cache.add_history(guild_id(ctx), item.queued_by.id, player.track_id, source=item.info.source, url=item.info.url,
+            title=item.info.title, artist=item.info.artist, thumbnail=item.info.thumbnail, duration=item.info.length_seconds,
+            keep=cfg.STORED_HISTORY_LENGTH)
+
+    def pop_next_item(self, skipping: bool) -> tuple[Optional[QueueItem], Optional[YTDLSource | ReplaySource]]:
+        """Takes the next item that should be played out of the queue, along with its player if it was already prepared.
+        Returns `(None, None)` if there's nothing left. Respects looping and roulette mode.
+        """
+        if self.media_queue.is_looping and not skipping and self.current_item:
+            self.discard_prefetched(requeue=True)
+            return self.current_item, self.make_loop_replay()
+        if self.prefetched:
+            item, player = self.prefetched
+            self.prefetched = None
+            if isinstance(self.output, GaplessSource):
+                self.output.clear_next()
+            return item, player
+        if not self.media_queue:
+            if self.autoplay_enabled and self.autoplay_pool:
+                # Nothing was prepared in time, so this one will have to be downloaded now
+                return self.autoplay_item(self.autoplay_pool.pop(0)), None
+            return None, None
+        item_index = 0 if not self.media_queue.roulette_mode else random.randint(0, len(self.media_queue) - 1)
+        return self.media_queue.pop(item_index), None
+
+    def make_loop_replay(self) -> Optional[YTDLSource | ReplaySource]:
+        """Creates a player that repeats the current one without extracting or downloading anything again.
+
+        Replays from recorded Opus packets if the whole track was recorded, otherwise re-opens the file that was already
+        downloaded. Returns `None` if neither is available, in which case the item has to be downloaded again.
+        """
+        if isinstance(self.output, OpusRecorder) and self.output.complete:
+            self.loop_packets = self.output.packets
+        if not self.player:
+            return None
+        if isinstance(self.player, ReplaySource):
+            # Already playing from packets, likely from the frame cache
+            return ReplaySource.from_player(self.player, self.player.packets)
+        if self.loop_packets:
+            log.debug('Replaying looped track from memory.')
+            return ReplaySource.from_player(self.player, self.loop_packets)
+        if self.player.buffer is not None:
+            log.debug('Replaying looped track from its file in memory.')
+            player = YTDLSource.from_memory(self.player.data, self.player.buffer, self.player.filepath, effects=self.player.effects)
+            self.apply_loudness(player)
+            return player
+        if self.player.filepath.is_file():
+            log.debug('Replaying looped track from its downloaded file.')
+            player = YTDLSource.from_file(self.player.data, self.player.filepath, effects=self.player.effects, rendered=self.player.rendered)
+            self.apply_loudness(player)
+            return player
+        return None
+
+    def autoplay_item(self, info: media.TrackInfo) -> QueueItem:
+        """Creates a `QueueItem` for a track picked by autoplay, which is marked as queued by the bot itself."""
+        return QueueItem(info, cast(User, self.bot.user))
+
+    def is_autoplay_item(self, item: QueueItem) -> bool:
+        """Whether an item was picked by autoplay, rather than queued by someone."""
+        return item.queued_by.id == self.bot.user.id
+
+    def reset_autoplay(self) -> None:
+        """Forgets every related track autoplay had lined up, and stops preparing the next one."""
+        if self.autoplay_task:
+            self.autoplay_task.cancel()
+            self.autoplay_task = None
+        self.autoplay_pool.clear()
+
+    def needs_autoplay(self) -> bool:
+        """Whether autoplay should prepare the next track: it's on, something is playing, and nothing else is going to play after it."""
+        return self.autoplay_enabled and (not self.media_queue) and (not self.prefetched) and (not self.media_queue.is_looping) \
+            and (self.state in (PlayerState.PLAYING, PlayerState.PAUSED))
+
+    def schedule_autoplay(self, ctx: commands.Context) -> None:
+        """Starts preparing the next autoplay track in the background, if it's needed and isn't already being prepared."""
+        if self.needs_autoplay() and ((self.autoplay_task is None) or self.autoplay_task.done()):
+            self.autoplay_task = asyncio.create_task(self.prefetch_autoplay(ctx))
+
+    async def refill_autoplay_pool(self, ctx: commands.Context) -> None:
+        """Tops up the pool of related tracks once it's down to half of `autoplay.pool-size`, with tracks from YouTube Music's
+        radio for the current track, or the most recently played YouTube track if the current one isn't from YouTube.
+        Tracks played recently, already queued, or already in the pool are left out.
+        """
+        if len(self.autoplay_pool) > cfg.AUTOPLAY_POOL_SIZE // 2:
+            return
+        recent = self.metadata_cache.get_history(guild_id(ctx), AUTOPLAY_RECENT_TRACKS)
+        seeds = [self.current_item.info.url] if self.current_item else []
+        seeds += [row['url'] for row in recent if row['source'] == media.YOUTUBE]
+        if (video_id := next(filter(None, map(media.youtube_video_id, seeds)), None)) is None:
+            log.debug('Nothing from YouTube has played recently; autoplay has nothing to go off of.')
+            return
+
+        try:
+            related = await asyncio.get_running_loop().run_in_executor(None, media.related_ytmusic_tracks, video_id,
+                cfg.AUTOPLAY_POOL_SIZE + AUTOPLAY_RECENT_TRACKS)
+        except (requests.RequestException, KeyError) as e:
+            log.info('Couldn\'t get related tracks for autoplay: %s', e)
+            return
+        skip = {row['url'] for row in recent} | {item.info.url for item in self.media_queue} | \
+            {info.url for info in self.autoplay_pool} | ({self.current_item.info.url} if self.current_item else set())
+        new = [info for info in related if info.url not in skip][:cfg.AUTOPLAY_POOL_SIZE - len(self.autoplay_pool)]
+        self.autoplay_pool.extend(new)
+        log.debug('Added %s related track(s) to the autoplay pool; %s in total.', len(new), len(self.autoplay_pool))
+
+    async def prefetch_autoplay(self, ctx: commands.Context) -> None:
+        """Picks the next track from the autoplay pool and prepares its player, so it's ready as soon as the current track ends.
+        Gives way if something gets queued in the meantime.
+        """
+        await self.refill_autoplay_pool(ctx)
+        while self.needs_autoplay() and self.autoplay_pool:
+            item = self.autoplay_item(self.autoplay_pool.pop(0))
+            log.info('Preparing the next track for autoplay: %s', item.info.title)
+            # Downloading happens outside of the lock, so pausing, skipping, and advancing don't wait on it
+            if not ((await self.resolve_item(item, ctx, prompt=False)) and (player := await self.create_player(item, ctx))):
+                continue
+            async with self.player_lock:
+                if not self.needs_autoplay():
+                    # Something was queued or stopped while this was downloading
+                    self.release_player(player)
+                    self.autoplay_pool.insert(0, item.info)
+                    return
+                self.prefetched = (item, player)
+                if isinstance(self.output, GaplessSource):
+                    self.output.queue_next(player, self.expected_length_frames(item, player))
+                return
+
+    def discard_prefetched(self, requeue: bool=False) -> None:
+        """Throws away the prepared player for the next item, if there is one.
+
+        @requeue: (`False`) Put the item back at the front of the queue. Items picked by autoplay always go back into its pool instead.
+        """
+        if not self.prefetched:
+            return
+        item, player = self.prefetched
+        self.prefetched = None
+        if isinstance(self.output, GaplessSource):
+            self.output.clear_next()
+        player.cleanup()
+        self.delete_player_file(player)
+        if self.is_autoplay_item(item):
+            # Autoplay tracks go back to where they were picked from, never into the queue
+            self.autoplay_pool.insert(0, item.info)
+        elif requeue:
+            self.media_queue.insert(0, item)
+
+    def release_player(self, player: YTDLSource | ReplaySource) -> None:
+        """Closes a player that was prepared but won't be played after all, and deletes its file unless the current player
+        is using the same one, e.g. because the same track started playing while this was downloading.
+        """
+        player.cleanup()
+        if (player.buffer is None) and (self.player is not None) and (self.player.filepath == player.filepath):
+            return
+        self.delete_player_file(player)
+
+    def delete_player_file(self, player: YTDLSource | ReplaySource) -> None:
+        """Queues a finished player's downloaded file to be deleted, or frees it if it was downloaded into memory.
+        Saved renders and files in the local library are kept.
+        """
+        if player.buffer is not None:
+            log.debug('Freeing %.2f MB file in memory: %s', len(player.buffer) / (1024 * 1024), player.filepath)
+            self.memory_used = max(self.memory_used - len(player.buffer), 0)
+            player.buffer = None
+        elif (not player.rendered) and (player.data.get('extractor') != media.LOCAL):
+            path = player.filepath
+            # Renders and loudness measurements wait their turn for FFmpeg, so they may not have read the file yet
+            if reading := [task for key, task in self.render_tasks.items() if key[0] == player.track_id] + \
+                    ([self.loudness_tasks[player.track_id]] if player.track_id in self.loudness_tasks else []):
+                log.debug('File marked for deletion once it\'s no longer being read: %s', path)
+                asyncio.gather(*reading, return_exceptions=True).add_done_callback(lambda _: self.file_cleaner.delete(path))
+                return
+            log.debug('File marked for deletion: %s', path)
+            self.file_cleaner.delete(path)
+
+    def find_played_track(self, query: str) -> Optional[media.TrackInfo]:
+        """Returns a track that's been played before if it closely matches a plain-text search, favoring the most played one.
+        Only uses the metadata cache, so it's instant and doesn't need the network.
+        """
+        # Scored both ways so a search that's only part of a title doesn't count as a full match
+        candidates = [(max(fuzz.token_sort_ratio(query, row['title']), fuzz.token_sort_ratio(query, f'{row['title']} {row['artist']}')),
+            row['plays'], row) for row in self.metadata_cache.search_tracks(query)]
+        if not candidates:
+            return None
+        score, plays, row = max(candidates, key=lambda candidate: candidate[:2])
+        if score < PLAYED_MATCH_THRESHOLD:
+            log.debug('Closest previously played track only matched by %s%%.', score)
+            return None
+        log.debug('Search matched "%s" by %s%%, played %s time(s) before.', row['title'], score, plays)
+        return media.TrackInfo.from_index(row)
+
+    def channel_bitrate(self) -> Optional[int]:
+        """Returns the bitrate of the connected voice channel in bits per second, or `None` if not connected."""
+        if self.voice_client is None:
+            return None
+        return getattr(self.voice_client.channel, 'bitrate', None)
+
+    def expected_length_frames(self, item: QueueItem, player: YTDLSource | ReplaySource) -> int:
+        """Returns how many frames the given item is expected to last from where its player starts, or `0` if that isn't known."""
+        if not (duration := player.data.get('duration') or item.info.length_seconds):
+            return 0
+        return max(seconds_to_frames((duration - player.elapsed_seconds) / player.effects.speed), 0)
+
+    async def advance_queue(self, ctx: commands.Context, skipping: bool=False, ended: Optional[AudioSource]=None):
         """Attempts to advance forward in the queue, if the bot is clear to do so.
         Set to run whenever the audio player finishes its current item.
+
+        Calls are serialized through `player_lock`, so skips, tracks ending, and new tracks being queued are handled
+        one after another in the order they happened, instead of being dropped.
+
+        @skipping: Advance even if something is currently playing, and don't repeat the current item if looping.
+        @ended: The output that finished, if this was called because playback ended. If it's no longer the current output,
+            the queue was already moved along (usually by a skip) and this call does nothing.
         """
-        if not self.voice_client.is_connected():
-            await self.bot.change_presence(activity=BotPresence.idle())
-            return
+        async with self.player_lock:
+            if (ended is not None) and (ended is not self.output):
+                log.debug('An output that is no longer current has finished; ignoring.')
+                return
+            if isinstance(ended, OpusRecorder) and ended.complete and self.frame_recording:
+                self.save_frame_file(*self.frame_recording, ended.packets)
+
+            if (not self.voice_client) or (not self.voice_client.is_connected()):
+                if (ended is not None) and (self.state == PlayerState.PLAYING) and self.current_item and self.player:
+                    self.resume_point = (ctx, self.elapsed_seconds())
+                    log.info('Voice connection lost; will resume from %s once reconnected.', seconds_to_hms(self.resume_point[1]))
+                self.set_state(PlayerState.IDLE)
+                await self.bot.change_presence(activity=BotPresence.idle())
+                return
+
+            if not (skipping or (ended is not None) or (self.state == PlayerState.IDLE)):
+                log.debug('Player is busy (%s); not advancing.', self.state.name)
+                return
 
-        if (not self.advance_lock) and (skipping or not self.voice_client.is_playing()):
-            log.debug('Locking...')
-            self.advance_lock = True
+            self.set_state(PlayerState.ADVANCING)
             try:
-                if self.player and ((not self.media_queue.is_looping) or (self.media_queue.is_looping and skipping)):
-                    if self.player.filepath not in self.files_to_del:
-                        self.files_to_del.append(self.player.filepath)
-                        log.debug('File marked for deletion: %s', self.player.filepath)
-                    for n, file in enumerate(self.files_to_del):
-                        try:
-                            os.remove(file)
-                            self.files_to_del.pop(n)
-                            log.debug('Removed file: %s', file)
-                        except PermissionError:
-                            log.debug('Permission error prevented removal of file: %s', file)
-                        except FileNotFoundError:
-                            log.debug('File not found: %s', file)
-                self.player = None
+                resume_point, self.resume_point = self.resume_point, None
+                if resume_point and (not skipping) and await self.restart_at(ctx, resume_point[1]):
+                    log.info('Resumed playback from %s.', seconds_to_hms(resume_point[1]))
+                    await self.bot.change_presence(activity=BotPresence.playing(cast(QueueItem, self.current_item), self.media_queue))
+                    return
+
+                if (not self.media_queue.is_looping) or skipping:
+                    self.loop_packets = None
+                    if self.player:
+                        self.delete_player_file(self.player)
 
+                self.add_to_history(ctx, self.current_item, self.player)
                 self.previous_item = self.current_item
                 self.skip_votes_placed.clear()
-                if self.media_queue.is_looping:
-                    log.debug('Looping is enabled, and we %s skipping.', 'ARE' if skipping else 'are NOT')
-                    await self.make_and_start_player(self.media_queue.pop(0) if skipping \
-                        else (self.current_item or self.media_queue.pop(0)), ctx)
-                elif not self.media_queue:
-                    self.voice_client.stop()
-                    await self.bot.change_presence(activity=BotPresence.idle())
-                else:
-                    item_index = 0 if not self.media_queue.roulette_mode else random.randint(0, len(self.media_queue) - 1)
-                    await self.make_and_start_player(self.media_queue.pop(item_index), ctx)
+                log.debug('Looping is %s, and we %s skipping.', 'ON' if self.media_queue.is_looping else 'OFF', 'ARE' if skipping else 'are NOT')
+                while True:
+                    item, player = self.pop_next_item(skipping)
+                    self.player = None
+                    if item is None:
+                        self.voice_client.stop()
+                        self.current_item = None
+                        self.message_refresher.unregister(self.now_playing_msg)
+                        await self.bot.change_presence(activity=BotPresence.idle())
+                        break
+                    if await self.make_and_start_player(item, ctx, player):
+                        break
+                    # Never retry an item that failed, even if looping
+                    skipping = True
+                    self.set_state(PlayerState.ADVANCING)
             finally:
-                # finally statement makes sure we still unlock if an error occurs
-                log.debug('Tasks finished; unlocking...')
-                self.advance_lock = False
-            if self.after_advance_queue:
-                self.after_advance_queue()
-            self.after_advance_queue = None
-        elif self.advance_lock:
-            log.debug('Attempted call while locked; ignoring...')
-
-    async def make_and_start_player(self, item: QueueItem, ctx: commands.Context):
-        """Create a new player from the given `QueueItem` and starts playing audio.
-        Handles matching individual Spotify tracks to YTMusic.
-
-        Use `advance_queue()` to attempt moving the queue along, do not use this function directly.
-        """
-        log.info('Trying to start playing...')
-
-        def skip_after_return() -> None:
-            self.after_advance_queue = lambda: asyncio.run_coroutine_threadsafe(self.advance_queue(ctx, skipping=True), self.bot.loop)
-
-        self.audio_time_elapsed = 0.0
+                # finally statement makes sure we still end up in a sensible state if an error occurs
+                if self.state != PlayerState.PLAYING:
+                    self.set_state(PlayerState.IDLE)
+                self.update_inactivity_timer()
 
-        if item != self.previous_item:
-            if self.now_playing_msg:
-                self.now_playing_msg = await self.now_playing_msg.delete()
+    async def resolve_item(self, item: QueueItem, ctx: commands.Context, prompt: bool=True) -> bool:
+        """Figures out exactly what should be played for an item, prompting the user if needed.
+        Handles matching individual Spotify tracks to YTMusic. Returns whether the item can be played.
 
-            # Start the player with retrieved URL
-            if item.info.source == media.SPOTIFY:
-                log.debug('Spotify source detected, matching to YouTube music if possible...')
+        @prompt: (`True`) Whether the user can be asked anything. If not, returns `False` wherever they would have been,
+            for items that are being prepared in the background.
+        """
+        if item.info.source == media.SPOTIFY:
+            log.debug('Spotify source detected, matching to YouTube music if possible...')
+            if prompt:
                 self.queue_msg = await edit_or_send(ctx, self.queue_msg,
                     embed=embedq('Spotify link detected, searching for a YouTube Music match...'))
-                matches = media.match_ytmusic_track(item.info)
-                if isinstance(matches, list):
-                    if cfg.USE_TOP_MATCH:
-                        matches = matches[0]
+            matches = await match_track(item.info)
+            if isinstance(matches, list):
+                if cfg.USE_TOP_MATCH:
+                    matches = matches[0]
+                elif not prompt:
+                    return False
+                else:
+                    prompt_msg = await ctx.send(embed=embedq('Some close matches were found. Please choose one to queue.',
+                        '\n'.join([EmojiStr.num[n + 1] + f' **{track.title}**\n*{track.artist}*' for n, track in enumerate(matches)])))
+                    choice = await prompt_for_choice(self.bot, ctx,
+                        prompt_msg=prompt_msg, choice_nums=len(matches), result_msg=self.queue_msg)
+                    if isinstance(choice, int) and choice != 0:
+                        item.info = matches[choice - 1]
                     else:
-                        prompt_msg = await ctx.send(embed=embedq('Some close matches were found. Please choose one to queue.',
-                            '\n'.join([EmojiStr.num[n + 1] + f' **{track.title}**\n*{track.artist}*' for n, track in enumerate(matches)])))
-                        choice = await prompt_for_choice(self.bot, ctx,
-                            prompt_msg=prompt_msg, choice_nums=len(matches), result_msg=self.queue_msg)
-                        if isinstance(choice, int) and choice != 0:
-                            item.info = matches[choice - 1]
-                        else:
-                            await self.advance_queue(ctx)
-                            return
-                if isinstance(matches, media.TrackInfo):
-                    item.info = matches
-
-            if (item.info.length_seconds == 0) and (cfg.DURATION_LIMIT_SECONDS != 0):
-                prompt_msg = await ctx.send(embed=embedq(f'The duration of "{item.info.title}" couldn\'t be retrieved, so ' +
-                    'it can\'t be checked against the duration limit. Play anyway?'))
-                if await prompt_for_choice(self.bot, ctx, prompt_msg=prompt_msg, yesno=True) == 0:
-                    skip_after_return()
-                    return
+                        return False
+            if isinstance(matches, media.TrackInfo):
+                item.info = matches
+
+        if (item.info.length_seconds == 0) and (not item.info.is_live) and (cfg.DURATION_LIMIT_SECONDS != 0):
+            if not prompt:
+                return False
+            prompt_msg = await ctx.send(embed=embedq(f'The duration of "{item.info.title}" couldn\'t be retrieved, so ' +
+                'it can\'t be checked against the duration limit. Play anyway?'))
+            if await prompt_for_choice(self.bot, ctx, prompt_msg=prompt_msg, yesno=True) == 0:
+                return False
+        return True
+
+    async def create_player(self, item: QueueItem, ctx: commands.Context) -> Optional[YTDLSource | ReplaySource]:
+        """Downloads an item and opens a player for it. Returns `None` if that wasn't possible.
+        If the item has been played with the current effect preset before, its saved frames or render are used instead of downloading it.
+        """
+        if item.info.source == media.DIRECT:
+            return await self.open_direct_stream(item)
+        if (player := self.open_frame_file(item)) is not None:
+            log.debug('Playing from the frame cache.')
+            return player
+        if (player := self.open_render(item)) is not None:
+            log.debug('Playing saved render with the "%s" effect.', self.effect_preset)
+            self.apply_loudness(player)
+            return player
+
+        if item.info.source == media.LOCAL:
+            log.debug('Playing from the local library.')
+            player = YTDLSource.from_file(item.info.info, Path(item.info.url), effects=self.effects)
+        elif cfg.DOWNLOAD_EARLY_START_MB and ((player := await self.open_cached_stream(item)) is not None):
+            log.debug('Streaming from a cached stream URL while the track downloads.')
+        else:
+            try:
+                log.debug('Creating YTDLSource...')
+                player = await YTDLSource.from_url(item.info.url, loop=self.bot.loop, stream=False, effects=self.effects,
+                    bitrate=self.channel_bitrate(), early_start_bytes=cfg.DOWNLOAD_EARLY_START_MB * 1024 * 1024,
+                    memory_bytes=self.memory_available())
+            except yt_dlp.utils.DownloadError:
+                log.info('Download error occurred; skipping this item...')
+                await ctx.send(embed=embedq('This video is unavailable.', f'URL: {item.info.url}'))
+                return None
+            except FileSizeLimitError as e:
+                log.info('File is over the size limit; skipping this item... (%s)', e)
+                await ctx.send(embed=embedq(f'{EmojiStr.cancel} This file is too big to play, skipping this item.', str(e)))
+                return None
+            self.remember_stream_url(player)
+            if player.buffer is not None:
+                self.memory_used += len(player.buffer)
+
+        if (player.download is None) and (player.buffer is None) and (not player.filepath.is_file()):
+            log.info('Player filepath was not found, skipping...')
+            await ctx.send(embed=embedq('File is missing, skipping this item.',
+                'It may have been moved or deleted from the library.' if item.info.source == media.LOCAL else
+                'The video file likely went over the filesize limit. Check the logs for details.'))
+            return None
+        self.metadata_cache.store_track(player.track_id, title=player.title,
+            url=media.canonical_url(player.data.get('webpage_url') or item.info.url), duration=player.data.get('duration'))
+        self.apply_loudness(player)
+        if player.download is None:
+            self.save_render(player)
+        else:
+            track_id = player.track_id
+            self.download_tasks[track_id] = asyncio.create_task(self.finish_download(player))
+            self.download_tasks[track_id].add_done_callback(lambda _: self.download_tasks.pop(track_id, None))
+        return player
+
+    def memory_available(self) -> int:
+        """Returns how big of a file can be downloaded into memory right now, in bytes. Once `downloads.memory-budget-mb`
+        is used up, this is `0` and everything is downloaded to disk until some of it is freed.
+        """
+        if not cfg.MEMORY_TRACK_MB:
+            return 0
+        return max(min(cfg.MEMORY_TRACK_MB * 1024 * 1024, (cfg.MEMORY_BUDGET_MB * 1024 * 1024) - self.memory_used), 0)
 
+    async def open_direct_stream(self, item: QueueItem) -> Optional[YTDLSource]:
+        """Streams an item that links straight to audio, like an internet radio station, straight into FFmpeg.
+        Nothing is extracted or downloaded; `resolve_item()` already found out everything that's known about it.
+        """
+        data: dict = item.info.info
+        player = await YTDLSource.from_stream_url(data, data['url'], loop=self.bot.loop, effects=self.effects)
+        if isinstance(player.original, JitterBuffer) and player.original.source_ended and (not player.original.fill_level):
+            log.info('Direct link didn\'t play anything, skipping...')
+            player.cleanup()
+            return None
+        self.metadata_cache.store_track(player.track_id, title=player.title, url=media.canonical_url(data['webpage_url']))
+        return player
+
+    async def finish_download(self, player: YTDLSource) -> None:
+        """Waits for the download of a player that started out streaming, then hands the file to whichever players
+        of that track are still around, so looping and seeking can use it. Deletes it if the track is no longer playing.
+        """
         try:
-            log.debug('Creating YTDLSource...')
-            self.player = await YTDLSource.from_url(item.info.url, loop=self.bot.loop, stream=False)
+            path = await player.download # type: ignore
         except yt_dlp.utils.DownloadError:
-            log.info('Download error occurred; skipping this item...')
-            await ctx.send(embed=embedq('This video is unavailable.', f'URL: {item.info.url}'))
-            skip_after_return()
+            log.info('Background download of "%s" failed; it will keep streaming.', player.title)
+            return
+        if not path.is_file():
+            log.info('Background download of "%s" is missing; it likely went over the filesize limit.', player.title)
             return
 
-        if not self.player.filepath.is_file():
-            log.info('Player filepath was not found, skipping...')
-            await ctx.send(embed=embedq('File is missing, skipping this item.',
-                'The video file likely went over the filesize limit. Check the logs for details.'))
-            skip_after_return()
+        in_use = [p for p in (self.player, self.prefetched[1] if self.prefetched else None)
+            if isinstance(p, (YTDLSource, ReplaySource)) and (not p.rendered) and (p.track_id == player.track_id)]
+        if not in_use:
+            log.debug('Background download finished after its track stopped playing.')
+            self.file_cleaner.delete(path)
             return
 
-        self.voice_client.stop()
+        log.debug('Background download finished: %s', path)
+        for p in (player, *in_use):
+            p.filepath = path
+        self.apply_loudness(player)
+        self.save_render(player)
+
+    @staticmethod
+    def stored_track_data(track: sqlite3.Row) -> dict:
+        """Rebuilds the parts of a yt_dlp info dictionary that players need, from what the metadata cache has stored about a track."""
+        extractor, track_id = track['track_id'].split(':', 1)
+        return {'title': track['title'], 'webpage_url': track['url'], 'duration': track['duration'], 'extractor': extractor, 'id': track_id}
+
+    def open_render(self, item: QueueItem) -> Optional[YTDLSource]:
+        """Opens a saved render of an item with the current effect preset applied, if there is one."""
+        if (self.effect_preset == 'none') or (not cfg.EFFECT_RENDER_CACHE):
+            return None
+        if (track := self.metadata_cache.find_track(media.canonical_url(item.info.url))) is None:
+            return None
+        if ((path := self.metadata_cache.get_render(track['track_id'], self.effect_preset)) is None) or (not path.is_file()):
+            return None
+        return YTDLSource.from_file(self.stored_track_data(track), path, effects=self.effects, rendered=True)
+
+    def open_frame_file(self, item: QueueItem) -> Optional[ReplaySource]:
+        """Opens an item's saved frames with the current effect preset applied, if there are any."""
+        if not cfg.FRAME_CACHE:
+            return None
+        if (track := self.metadata_cache.find_track(media.canonical_url(item.info.url))) is None:
+            return None
+        if ((path := self.metadata_cache.get_frame_file(track['track_id'], self.effect_preset)) is None) or (not path.is_file()):
+            return None
+        try:
+            packets = OpusFrameFile(path)
+        except (OSError, ValueError) as e:
+            log.warning('Couldn\'t open frame file, ignoring it: %s', e)
+            return None
+        return ReplaySource(packets, data=self.stored_track_data(track), filepath=path, effects=self.effects, rendered=True)
+
+    def should_save_frames(self, player: YTDLSource | ReplaySource) -> bool:
+        """Whether this play of a track should be recorded to be saved to the frame cache. That's only done once it's been played
+        `frame-cache.min-plays` times, and only if it's playing from the start at the volume it'll always be played at.
+        """
+        if (not cfg.FRAME_CACHE) or (not isinstance(player, YTDLSource)) or player.start_seconds:
+            return False
+        if cfg.GAPLESS_PLAYBACK and (not self.media_queue.is_looping):
+            # Tracks are mixed into each other, so there's no recording only one of them
+            return False
+        if cfg.LOUDNESS_NORMALIZATION and (self.metadata_cache.get_loudness(player.track_id) is None):
+            return False
+        return self.metadata_cache.get_plays(player.track_id) >= cfg.FRAME_CACHE_MIN_PLAYS
+
+    def save_frame_file(self, track_id: str, preset: str, packets: list[bytes]) -> None:
+        """Starts saving the recorded packets of a track that finished playing to the frame cache, in the background."""
+        key = (track_id, preset)
+        if key not in self.frame_tasks:
+            self.frame_tasks[key] = asyncio.create_task(self.write_frames(track_id, preset, packets))
+            self.frame_tasks[key].add_done_callback(lambda _: self.frame_tasks.pop(key, None))
+
+    async def write_frames(self, track_id: str, preset: str, packets: list[bytes]) -> None:
+        """Writes a track's packets to a frame file, and stores it in the metadata cache.
+        Removes the least recently played frame files if that puts them over `frame-cache.size-mb`.
+        """
+        path = self.metadata_cache.frame_file_path(track_id, preset)
+        def write():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_frame_file(path, packets)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write)
+        except OSError as e:
+            log.info('Couldn\'t save frames of %s: %s', track_id, e)
+            return
+
+        self.metadata_cache.store_frame_file(track_id, preset, path)
+        log.debug('Saved %s frames of %s to the frame cache.', len(packets), track_id)
+        if evicted := self.metadata_cache.evict_frame_files(cfg.FRAME_CACHE_SIZE_MB * 1024 * 1024):
+            log.debug('Removing %s least recently played frame file(s) to stay under the size limit.', len(evicted))
+            self.file_cleaner.delete(*evicted)
+
+    def remember_stream_url(self, player: YTDLSource) -> None:
+        """Caches the direct stream URL a player was resolved to, if the URL says when it expires."""
+        if (url := player.data.get('url')) and (expires_at := stream_url_expiry(url)):
+            self.metadata_cache.store_stream_url(player.track_id, media.format_key(self.channel_bitrate()), url, expires_at)
+
+    def cached_stream_url(self, track_id: str, duration: Optional[float]) -> Optional[str]:
+        """Returns a cached stream URL for a track that will keep working long enough to play all of it, if there is one."""
+        return self.metadata_cache.get_stream_url(track_id, media.format_key(self.channel_bitrate()),
+            valid_for=(duration or 0) + STREAM_URL_EXPIRY_MARGIN_SECONDS)
+
+    async def open_cached_stream(self, item: QueueItem) -> Optional[YTDLSource]:
+        """Starts streaming an item from the stream URL it was resolved to before, if it's still good, and starts downloading it
+        from the same URL in the background. This skips extracting it altogether. Returns `None` if there's no usable URL.
+        """
+        if (track := self.metadata_cache.find_track(media.canonical_url(item.info.url))) is None:
+            return None
+        if (stream_url := self.cached_stream_url(track['track_id'], track['duration'])) is None:
+            return None
+
+        player = await YTDLSource.from_stream_url(self.stored_track_data(track) | {'url': stream_url}, stream_url,
+            loop=self.bot.loop, effects=self.effects)
+        if isinstance(player.original, JitterBuffer) and player.original.source_ended and (not player.original.fill_level):
+            log.debug('Cached stream URL didn\'t work; resolving the track again.')
+            player.cleanup()
+            self.metadata_cache.forget_stream_urls(track['track_id'])
+            return None
+        player.download = asyncio.create_task(self.download_cached_stream(item, track['track_id'], stream_url))
+        return player
+
+    async def download_cached_stream(self, item: QueueItem, track_id: str, stream_url: str) -> Path:
+        """Downloads a track straight from the cached stream URL it's playing from, so it isn't extracted again.
+        Falls back to extracting and downloading it as usual if the URL can't be downloaded directly.
+        """
+        stem = track_file_stem(track_id)
+        if (path := await asyncio.get_running_loop().run_in_executor(None, media.download_stream_url, stream_url, stem)) is not None:
+            return path
+        log.debug('Couldn\'t download from the cached stream URL; extracting the track again.')
+        return await YTDLSource.download_url(item.info.url, self.bot.loop, self.channel_bitrate())
+
+    def save_render(self, player: YTDLSource) -> None:
+        """Starts saving a copy of a newly downloaded track with the current effect preset applied, in the background,
+        so the next time it's played with this preset it can be played as-is.
+        """
+        if (self.effect_preset == 'none') or (not cfg.EFFECT_RENDER_CACHE) or player.rendered:
+            return
+        key = (player.track_id, self.effect_preset)
+        if key not in self.render_tasks:
+            self.render_tasks[key] = asyncio.create_task(self.render_with_effects(player, self.effect_preset))
+            self.render_tasks[key].add_done_callback(lambda _: self.render_tasks.pop(key, None))
+
+    async def render_with_effects(self, player: YTDLSource, preset: str) -> None:
+        """Renders a player's downloaded file with an effect preset, and stores the render in the metadata cache.
+        Removes the least recently played renders if that puts them over `effects.cache-size-mb`.
+        """
+        destination = self.metadata_cache.render_path(player.track_id, preset)
+        async with self.ffmpeg_semaphore:
+            if (player.buffer is None) and (not player.filepath.is_file()):
+                log.debug('"%s" was deleted before it could be rendered with the "%s" effect.', player.title, preset)
+                return
+            log.debug('Rendering "%s" with the "%s" effect...', player.title, preset)
+            await asyncio.get_running_loop().run_in_executor(None, lambda: destination.parent.mkdir(parents=True, exist_ok=True))
+            source = player.buffer if player.buffer is not None else player.filepath
+            if not await render_effects(source, destination, EFFECT_PRESETS[preset].ffmpeg_filter()):
+                log.info('Couldn\'t save "%s" with the "%s" effect; it will have to be applied again next time.', player.title, preset)
+                return
+
+        self.metadata_cache.store_render(player.track_id, preset, destination)
+        if evicted := self.metadata_cache.evict_renders(cfg.EFFECT_CACHE_SIZE_MB * 1024 * 1024):
+            log.debug('Removing %s least recently played render(s) to stay under the size limit.', len(evicted))
+            self.file_cleaner.delete(*evicted)
+
+    def apply_loudness(self, player: YTDLSource) -> None:
+        """Applies a track's loudness normalization gain to its player, if the track has been measured before.
+        Otherwise, starts measuring it in the background; the gain is then applied if the player hasn't started yet,
+        and for every play after that.
+        """
+        if not cfg.LOUDNESS_NORMALIZATION:
+            return
+        if (info := self.metadata_cache.get_loudness(player.track_id)) is not None:
+            player.set_gain(info.gain_to(cfg.LOUDNESS_TARGET_LUFS))
+            log.debug('Applied stored loudness gain of %.2f dB.', info.gain_to(cfg.LOUDNESS_TARGET_LUFS))
+        elif (not player.rendered) and (player.track_id not in self.loudness_tasks) and \
+                ((player.buffer is not None) or player.filepath.is_file()):
+            track_id = player.track_id
+            self.loudness_tasks[track_id] = asyncio.create_task(self.analyze_loudness(player))
+            self.loudness_tasks[track_id].add_done_callback(lambda _: self.loudness_tasks.pop(track_id, None))
+
+    async def analyze_loudness(self, player: YTDLSource) -> None:
+        """Measures the loudness of a player's downloaded file, and stores the results in the metadata cache."""
+        async with self.ffmpeg_semaphore:
+            log.debug('Measuring loudness of: %s', player.filepath)
+            info = await measure_loudness(player.buffer if player.buffer is not None else player.filepath)
+        if info is None:
+            log.info('Couldn\'t measure the loudness of "%s"; it will play at the default volume.', player.title)
+            return
+
+        self.metadata_cache.store_loudness(player.track_id, info)
+        log.debug('Measured %.1f LUFS (true peak %.1f dB) for: %s', info.integrated_lufs, info.true_peak_db, player.title)
+        # Changing the volume partway through a track would be noticeable, so this only applies to players that haven't started yet
+        if player.frames_read == 0:
+            player.set_gain(info.gain_to(cfg.LOUDNESS_TARGET_LUFS))
+
+    async def make_and_start_player(self, item: QueueItem, ctx: commands.Context, player: Optional[YTDLSource | ReplaySource]=None) -> bool:
+        """Create a new player from the given `QueueItem` and starts playing audio.
+        Returns whether playback was started; if not, the item should be skipped.
+
+        Use `advance_queue()` to attempt moving the queue along, do not use this function directly.
+
+        @player: A player that was already created for this item, if there is one.
+        """
+        log.info('Trying to start playing...')
+        self.set_state(PlayerState.RESOLVING)
+
+        if item != self.previous_item:
+            if self.now_playing_msg:
+                self.message_refresher.unregister(self.now_playing_msg)
+                self.now_playing_msg = await self.now_playing_msg.delete()
+            if (player is None) and (not await self.resolve_item(item, ctx)):
+                return False
+
+        self.set_state(PlayerState.BUFFERING)
+        if (player is None) and ((player := await self.create_player(item, ctx)) is None):
+            return False
+
+        self.metadata_cache.count_play(player.track_id)
+        if not media.is_discord_attachment(item.info.url):
+            # Attachment links stop working after a while, so there's no point finding them again
+            self.metadata_cache.index_track(player.track_id, source=item.info.source, url=item.info.url, title=item.info.title,
+                artist=item.info.artist, thumbnail=item.info.thumbnail, duration=item.info.length_seconds)
         log.info('Starting audio playback...')
-        self.voice_client.play(self.player, after=lambda e: asyncio.run_coroutine_threadsafe(self.handle_player_stop(ctx), self.bot.loop))
+        self.start_output(ctx, item, player)
         self.current_item = item
+        self.set_state(PlayerState.PLAYING)
 
         if item != self.previous_item:
             # Don't re-send a now playing message if we're just looping this track
             await self.bot.change_presence(activity=BotPresence.playing(item, self.media_queue))
-            self.now_playing_msg = await ctx.send(embed=self.embed_now_playing(show_elapsed=False))
+            await self.send_now_playing(ctx)
 
         if self.queue_msg:
             self.queue_msg = await self.queue_msg.delete(delay=1.0)
+        self.schedule_autoplay(ctx)
+        return True
+
+    def stop_output(self) -> None:
+        """Stops playback right away. The stopped output is let go of first, so it finishing doesn't move the queue along too."""
+        self.output = None
+        self.voice_client.stop()
+
+    async def fade_out_output(self) -> None:
+        """Like `stop_output()`, but fades out whatever is playing first so it isn't cut off mid-waveform.
+        The output is let go of before fading, so the fade ending it doesn't move the queue along or get saved as a
+        complete recording.
+        """
+        output, player = self.output, self.player
+        self.output = None
+        if isinstance(output, GaplessSource):
+            output.clear_next()
+        if (output is not None) and isinstance(player, TransformSource) and self.voice_client.is_playing():
+            fade_frames = seconds_to_frames(STOP_FADE_OUT_SECONDS)
+            player.fade_out(fade_frames)
+            # Frames already transformed before the fade started still have to play out first
+            await asyncio.sleep((fade_frames + player.block_frames) * FRAME_LENGTH_SECONDS)
+        self.stop_output()
+
+    def start_output(self, ctx: commands.Context, item: QueueItem, player: YTDLSource | ReplaySource) -> None:
+        """Stops whatever is playing, and starts playing `player` instead, wrapped in whatever the current settings call for."""
+        self.voice_client.stop()
+        self.player = player
+        self.frame_recording = None
+        save_frames = self.should_save_frames(player)
+        if isinstance(player, ReplaySource):
+            self.output = player
+        elif self.media_queue.is_looping or save_frames:
+            self.output = player
+            max_frames = max(seconds_to_frames(cfg.LOOP_MEMORY_MAX_SECONDS) if self.media_queue.is_looping else 0,
+                seconds_to_frames(FRAME_CACHE_MAX_TRACK_SECONDS) if save_frames else 0)
+            if (not player.start_seconds) and (0 < (length := self.expected_length_frames(item, player)) <= max_frames):
+                # Record this play so the following ones can be replayed from memory or the frame cache;
+                # allow a little slack over the expected length
+                try:
+                    self.output = OpusRecorder(player, length + seconds_to_frames(5))
+                    if save_frames:
+                        self.frame_recording = (player.track_id, self.effect_preset)
+                except OpusNotLoaded:
+                    log.debug('Opus library isn\'t loaded; track won\'t be recorded.')
+        elif cfg.GAPLESS_PLAYBACK:
+            self.output = GaplessSource(player, self.expected_length_frames(item, player),
+                crossfade_frames=seconds_to_frames(cfg.GAPLESS_CROSSFADE_MS / 1000),
+                preload_frames=seconds_to_frames(cfg.GAPLESS_PRELOAD_SECONDS),
+                on_near_end=lambda: asyncio.run_coroutine_threadsafe(self.prefetch_next(ctx), self.bot.loop),
+                on_switch=lambda old, new: asyncio.run_coroutine_threadsafe(self.handle_gapless_switch(ctx, new), self.bot.loop))
+        else:
+            self.output = player
+        output = self.output
+        self.voice_client.play(output, after=lambda e: asyncio.run_coroutine_threadsafe(self.handle_player_stop(ctx, output, e), self.bot.loop))
+        if cfg.STALL_TIMEOUT_SECONDS:
+            self.stall_watchdog.watch(lambda position, stalled_for: self.recover_from_stall(ctx, position, stalled_for))
+
+    async def restart_at(self, ctx: commands.Context, seconds: float) -> bool:
+        """Restarts the current item `seconds` in, reusing what was already downloaded or recorded for it.
+        Only falls back to streaming it again if its file is gone. Returns whether playback restarted.
+
+        Must be called while holding `player_lock`; use `seek_to()` otherwise.
+        """
+        if not (self.current_item and self.player):
+            return False
+        previous_state = self.state
+        self.set_state(PlayerState.BUFFERING)
+
+        if isinstance(self.player, ReplaySource):
+            player = ReplaySource.from_player(self.player, self.player.packets,
+                start_frame=seconds_to_frames(seconds / self.player.effects.speed))
+        elif self.player.buffer is not None:
+            player = YTDLSource.from_memory(self.player.data, self.player.buffer, self.player.filepath, start_seconds=seconds,
+                effects=self.player.effects)
+        elif self.player.filepath.is_file():
+            player = YTDLSource.from_file(self.player.data, self.player.filepath, start_seconds=seconds,
+                effects=self.player.effects, rendered=self.player.rendered)
+        elif self.player.data.get('extractor') == media.DIRECT:
+            log.debug('Reconnecting to direct link.')
+            live = self.player.data['is_live']
+            player = await YTDLSource.from_stream_url(self.player.data, self.player.data['url'], loop=self.bot.loop,
+                start_seconds=0.0 if live else seconds, effects=self.player.effects)
+            if live:
+                # A live stream picks up wherever it is now, but the elapsed time keeps counting from where it was
+                player.start_seconds = seconds
+        elif stream_url := self.cached_stream_url(self.player.track_id, self.player.data.get('duration')):
+            log.debug('Downloaded file is gone, streaming from %s seconds in from the cached stream URL instead.', seconds)
+            player = await YTDLSource.from_stream_url(self.player.data, stream_url, loop=self.bot.loop,
+                start_seconds=seconds, effects=self.player.effects)
+        else:
+            try:
+                log.debug('Downloaded file is gone, streaming from %s seconds in instead.', seconds)
+                player = await YTDLSource.from_url(self.current_item.info.url, loop=self.bot.loop, stream=True,
+                    start_seconds=seconds, effects=self.player.effects, bitrate=self.channel_bitrate())
+                self.remember_stream_url(player)
+            except yt_dlp.utils.DownloadError:
+                log.info('Couldn\'t restart the current item.')
+                self.set_state(previous_state if previous_state in (PlayerState.PLAYING, PlayerState.PAUSED) else PlayerState.ADVANCING)
+                return False
+
+        if isinstance(player, YTDLSource):
+            self.apply_loudness(player)
+            # Starting partway through a waveform would click
+            player.fade_in(seconds_to_frames(SEEK_FADE_IN_SECONDS))
+
+        # The prepared next item was relative to the old position; prepare it again when the time comes
+        self.discard_prefetched(requeue=True)
+        self.start_output(ctx, self.current_item, player)
+        if previous_state == PlayerState.PAUSED:
+            self.voice_client.pause()
+            self.set_state(PlayerState.PAUSED)
+        else:
+            self.set_state(PlayerState.PLAYING)
+        return True
+
+    async def recover_from_stall(self, ctx: commands.Context, position: float, stalled_for: float) -> None:
+        """Restarts the current item where playback stalled. If it was streaming, a fresh stream URL is resolved for it,
+        since an expired URL is the usual cause. If it can't be restarted, it's skipped.
+        """
+        async with self.player_lock:
+            if (self.state != PlayerState.PLAYING) or (not self.player):
+                return
+            stalled = self.player
+            streaming = (stalled.buffer is None) and (not stalled.filepath.is_file())
+            log.warning('Playback of "%s" stalled at %s for %.1f seconds (%s); restarting it...',
+                stalled.title, seconds_to_hms(position), stalled_for, 'streaming' if streaming else 'from file')
+            if isinstance(stalled, YTDLSource) and isinstance(stalled.original, JitterBuffer):
+                log.debug('Stream buffer had %s underrun(s) and %s frame(s) buffered.',
+                    stalled.original.underruns, stalled.original.fill_level)
+
+            if streaming and isinstance(stalled, YTDLSource):
+                # The stream URL may have stopped working early; don't try it again
+                self.metadata_cache.forget_stream_urls(stalled.track_id)
+
+            started = time.monotonic()
+            restarted = await self.restart_at(ctx, position)
+            # A source stuck waiting on a dead connection only lets go once its FFmpeg process is gone;
+            # if it couldn't be restarted, this also ends it, which moves the queue along
+            stalled.cleanup()
+
+        if restarted:
+            log.info('Recovered from stall #%s in %.2f seconds.', self.stall_watchdog.stalls, time.monotonic() - started)
+        else:
+            log.warning('Couldn\'t recover from stall; skipping "%s".', stalled.title)
+            await ctx.send(embed=embedq(f'{EmojiStr.cancel} Playback got stuck and couldn\'t be restarted; skipping this track.'))
+
+    async def seek_to(self, ctx: commands.Context, seconds: float) -> bool:
+        """Moves playback of the current item to `seconds` in. Returns whether that was possible."""
+        async with self.player_lock:
+            if (self.state not in (PlayerState.PLAYING, PlayerState.PAUSED)) \
+                    or (not self.voice_client) or (not self.voice_client.is_connected()):
+                return False
+            log.info('Seeking to %s...', seconds_to_hms(seconds))
+            return await self.restart_at(ctx, seconds)
+
+    async def prefetch_next(self, ctx: commands.Context) -> None:
+        """Prepares the player for the next item in the queue ahead of time, then takes the item out of the queue
+        and hands the player to the gapless output so it can start as soon as the current track ends.
+
+        The item stays in the queue while it's resolved and downloaded, which happens outside of `player_lock`.
+        Items that would need to ask the user something aren't prepared, and are left to be played as usual.
+        """
+        if self.prefetching:
+            return
+        output = self.output
+        def can_prefetch() -> bool:
+            return isinstance(output, GaplessSource) and (self.output is output) and (not self.prefetched) \
+                and (not self.media_queue.is_looping) and (self.state in (PlayerState.PLAYING, PlayerState.PAUSED))
+
+        self.prefetching = True
+        try:
+            while can_prefetch() and self.media_queue:
+                item = self.media_queue[0 if not self.media_queue.roulette_mode else random.randint(0, len(self.media_queue) - 1)]
+                log.info('Preparing the next track for gapless playback...')
+                if not await self.resolve_item(item, ctx, prompt=False):
+                    log.debug('Next item needs to be confirmed by the user; leaving it to be played normally.')
+                    return
+                player = await self.create_player(item, ctx)
+                async with self.player_lock:
+                    index = next((n for n, queued in enumerate(self.media_queue) if queued is item), None)
+                    if player is None:
+                        # create_player() has already said why; it's skipped like it would've been when its turn came
+                        if index is not None:
+                            self.media_queue.pop(index)
+                        continue
+                    if (index is None) or (not can_prefetch()):
+                        log.debug('Queue moved on while the next track was being prepared; discarding it.')
+                        self.release_player(player)
+                        return
+                    self.media_queue.pop(index)
+                    self.prefetched = (item, player)
+                    cast(GaplessSource, output).queue_next(player, self.expected_length_frames(item, player))
+                    return
+        finally:
+            self.prefetching = False
+
+    async def handle_gapless_switch(self, ctx: commands.Context, new: AudioSource) -> None:
+        """Called once a gapless output has moved on to the prefetched player. Does what `advance_queue()` would have
+        done when moving on to the next item, without touching playback itself.
+        """
+        async with self.player_lock:
+            if (not self.prefetched) or (self.prefetched[1] is not new):
+                return
+            item, player = self.prefetched
+            self.prefetched = None
+
+            if self.player:
+                self.delete_player_file(self.player)
+            self.add_to_history(ctx, self.current_item, self.player)
+            self.previous_item = self.current_item
+            self.current_item = item
+            self.player = player
+            self.skip_votes_placed.clear()
+
+            await self.bot.change_presence(activity=BotPresence.playing(item, self.media_queue))
+            await self.send_now_playing(ctx)
+        self.schedule_autoplay(ctx)
 
-    async def handle_player_stop(self, ctx):
-        """Normally just directs to `advance_queue()`, but handles some small additional logic
-        specifically to be used as the `after` argument for a player source. Should not be used alone.
+    async def handle_player_stop(self, ctx: commands.Context, output: AudioSource, error: Optional[Exception]=None):
+        """Used as the `after` argument for a player source, and directs to `advance_queue()` with the output that finished.
+        Should not be used alone.
         """
+        if error:
+            log.error('Player stopped due to an error: %s', error)
         log.debug('Player has finished.')
-        if (self.current_item) and (self.play_history[0] != self.current_item):
-            self.play_history.appendleft(self.current_item)
-        await self.advance_queue(ctx)
+        await self.advance_queue(ctx, ended=output)
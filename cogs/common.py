@@ -36,6 +36,7 @@ class EmojiStr:
     shuffle: str = '🔀'
     inbox: str = '📥'
     outbox: str = '📤'
+    radio: str = '📻'
 
 class SilentCancel(commands.CommandError):
     """Raised to cancel commands where "return" wouldn't work, like the `Voice` cog's `ensure_voice()`"""
@@ -53,6 +54,10 @@ def command_aliases(command: str) -> list[str]:
     """Returns a list of aliases for the given command."""
     return cfg.COMMAND_ALIASES.get(command) or []
 
+def guild_id(ctx: commands.Context) -> int:
+    """Returns the ID of the server a command was used in, or 0 if it was used in direct messages."""
+    return ctx.guild.id if ctx.guild else 0
+
 def command_from_alias(alias: str) -> str:
     """Finds a matching command for the given alias. Returns upon first match."""
     for key, val in itertools.chain(cfg.get('aliases').items(), cfg.get_default('aliases').items()):
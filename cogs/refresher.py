@@ -0,0 +1,95 @@
+"""Keeps messages that show live information, like the "Now playing" message, up to date."""
+
+# Standard imports
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+# External imports
+from discord import Embed, HTTPException, Message, NotFound
+
+log = logging.getLogger('lydian')
+
+# Discord allows 5 message edits per 5 seconds per channel, stay well below that
+MIN_EDIT_INTERVAL_SECONDS: float = 5.0
+# If this many messages have been sent in a channel after a refreshed message, it's assumed nobody is looking at it anymore
+BURIED_AFTER_MESSAGES: int = 10
+
+@dataclass
+class RefreshEntry:
+    """A message registered with a `MessageRefresher`, and how to re-render it."""
+    message: Message
+    render: Callable[[], Embed]
+    is_viewed: Callable[[], bool]
+    messages_since: int = 0
+    last_rendered: dict = field(default_factory=dict)
+
+class MessageRefresher:
+    """Shared scheduler that edits registered messages on an interval.
+
+    Every message is refreshed from one task, which only runs while at least one message is registered.
+    A channel is never edited more than once per `MIN_EDIT_INTERVAL_SECONDS`, and an edit is skipped if the embed
+    hasn't changed, if the message has been buried under newer messages, or if its `is_viewed` callback returns `False`.
+    """
+    def __init__(self, interval: float):
+        """
+        @interval: How often to refresh messages, in seconds. Raised to `MIN_EDIT_INTERVAL_SECONDS` if lower.
+        """
+        self.interval: float = max(interval, MIN_EDIT_INTERVAL_SECONDS)
+        self.entries: dict[int, RefreshEntry] = {}
+        self.last_edit: dict[int, float] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def register(self, message: Message, render: Callable[[], Embed], is_viewed: Callable[[], bool]=lambda: True) -> None:
+        """Starts refreshing `message` with the embed returned by `render`.
+
+        @render: Called on every refresh to build the new embed.
+        @is_viewed: (`lambda: True`) Called before every refresh; the edit is skipped if this returns `False`.
+        """
+        self.entries[message.id] = RefreshEntry(message, render, is_viewed, last_rendered=(message.embeds[0].to_dict() if message.embeds else {}))
+        if (self.task is None) or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def unregister(self, message: Optional[Message]) -> None:
+        """Stops refreshing `message`, if it was registered."""
+        if message:
+            self.entries.pop(message.id, None)
+
+    def note_message(self, message: Message) -> None:
+        """Counts a newly sent message against any registered messages in the same channel."""
+        for entry in self.entries.values():
+            if (entry.message.channel.id == message.channel.id) and (entry.message.id != message.id):
+                entry.messages_since += 1
+
+    async def run(self) -> None:
+        """Refreshes every registered message each interval until there are none left."""
+        log.debug('Message refresher started.')
+        while self.entries:
+            await asyncio.sleep(self.interval)
+            for entry in list(self.entries.values()):
+                await self.refresh(entry)
+        log.debug('No messages left to refresh; message refresher stopped.')
+
+    async def refresh(self, entry: RefreshEntry) -> None:
+        """Edits a single registered message, unless there's no reason to."""
+        channel_id: int = entry.message.channel.id
+        if (entry.messages_since >= BURIED_AFTER_MESSAGES) or (not entry.is_viewed()):
+            return
+        if time.monotonic() - self.last_edit.get(channel_id, 0.0) < MIN_EDIT_INTERVAL_SECONDS:
+            return
+
+        embed = entry.render()
+        if (rendered := embed.to_dict()) == entry.last_rendered:
+            return
+
+        try:
+            await entry.message.edit(embed=embed)
+            entry.last_rendered = rendered
+            self.last_edit[channel_id] = time.monotonic()
+        except NotFound:
+            log.debug('Refreshed message no longer exists; unregistering it.')
+            self.unregister(entry.message)
+        except HTTPException as e:
+            log.debug('Failed to refresh message: %s', e)
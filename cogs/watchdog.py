@@ -0,0 +1,97 @@
+"""Notices when playback has stalled, i.e. the voice client is playing but no new audio is coming out of it."""
+
+# Standard imports
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+log = logging.getLogger('lydian')
+
+class StallWatchdog:
+    """Polls how far playback has gotten, and calls back if it stops moving while it's supposed to be playing.
+
+    A source that's blocked waiting on a dead connection doesn't produce any frames, and one that's buffering produces
+    only silence, which doesn't count towards its position; either way, the position stays put and that's counted as a stall.
+    """
+    def __init__(self, timeout: float, position: Callable[[], float], is_playing: Callable[[], bool], interval: float=1.0):
+        """
+        @timeout: How many seconds the position has to stay the same for to count as a stall.
+        @position: Returns how far into the current track playback is, in seconds.
+        @is_playing: Returns whether playback is supposed to be moving right now; nothing counts as a stall while this is `False`.
+        @interval: (`1.0`) How often to check the position, in seconds.
+        """
+        self.timeout = timeout
+        self.position = position
+        self.is_playing = is_playing
+        self.interval = interval
+
+        self.on_stall: Optional[Callable[[float, float], Awaitable[None]]] = None
+        self.task: Optional[asyncio.Task] = None
+        self.last_position: Optional[float] = None
+        self.last_progress: float = 0.0
+
+        self.stalls: int = 0
+
+    def watch(self, on_stall: Callable[[float, float], Awaitable[None]]) -> None:
+        """Starts watching newly started playback, starting the watchdog task if it isn't running.
+
+        @on_stall: Awaited with the position playback stalled at and how many seconds it's been stuck for.
+            Watching resumes from scratch once it returns.
+        """
+        self.on_stall = on_stall
+        self.reset()
+        if (self.task is None) or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def reset(self) -> None:
+        """Forgets the last known position, so the next check starts counting from there."""
+        self.last_position = None
+        self.last_progress = time.monotonic()
+
+    def cancel(self) -> None:
+        """Stops watching once nothing is playing anymore, without waiting for the watchdog task to end.
+        If this is called from the watchdog task itself, i.e. while recovering from a stall, it ends on its own afterwards.
+        """
+        self.on_stall = None
+        if self.task and (self.task is not asyncio.current_task()):
+            self.task.cancel()
+            self.task = None
+
+    async def stop(self) -> None:
+        """Stops the watchdog task."""
+        self.on_stall = None
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self) -> None:
+        """Checks the position every interval, until watching is cancelled."""
+        log.debug('Stall watchdog started.')
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.on_stall is None:
+                break
+            if not self.is_playing():
+                self.reset()
+                continue
+
+            position = self.position()
+            if position != self.last_position:
+                self.last_position = position
+                self.last_progress = time.monotonic()
+                continue
+
+            if (stalled_for := time.monotonic() - self.last_progress) >= self.timeout:
+                self.stalls += 1
+                try:
+                    await self.on_stall(position, stalled_for)
+                except Exception: # pylint: disable=broad-exception-caught
+                    # The watchdog has to outlive whatever went wrong, or the next stall goes unnoticed
+                    log.exception('Error while recovering from a stall.')
+                self.reset()
+        log.debug('Stall watchdog stopped.')
@@ -0,0 +1,487 @@
+"""Audio sources and helpers for working with the frames sent to Discord voice."""
+
+# Standard imports
+import logging
+import mmap
+import threading
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+
+# External imports
+import numpy as np
+from discord import AudioSource, ClientException
+from discord.opus import Encoder as OpusEncoder
+
+log = logging.getLogger('lydian')
+
+# Each read() from an AudioSource is one 20ms frame
+FRAME_LENGTH_SECONDS: float = OpusEncoder.FRAME_LENGTH / 1000
+FRAME_SIZE: int = OpusEncoder.FRAME_SIZE
+CHANNELS: int = OpusEncoder.CHANNELS
+SAMPLING_RATE: int = OpusEncoder.SAMPLING_RATE
+
+def seconds_to_frames(seconds: float) -> int:
+    """Returns how many 20ms frames fit into the given amount of seconds."""
+    return int(seconds / FRAME_LENGTH_SECONDS)
+
+def crossfade_frame(outgoing: bytes, incoming: bytes, progress: float) -> bytes:
+    """Mixes two PCM frames, fading `outgoing` out and `incoming` in.
+
+    @progress: How far along the crossfade is, from `0.0` (only `outgoing`) to `1.0` (only `incoming`).
+    """
+    incoming = incoming.ljust(len(outgoing), b'\0')
+    mixed = (np.frombuffer(outgoing, dtype=np.int16) * (1.0 - progress)) + (np.frombuffer(incoming, dtype=np.int16) * progress)
+    return np.clip(mixed, -32768, 32767).astype(np.int16).tobytes()
+
+@dataclass(frozen=True)
+class AudioEffects:
+    """Effects to apply to a track. Volume and fades are handled by `TransformSource`; these need FFmpeg's filters instead,
+    as they can't be done one block at a time without keeping filter state across blocks.
+    """
+    bass_db: float = 0.0
+    """How much to boost (or cut, if negative) low frequencies, in dB."""
+    speed: float = 1.0
+    """How fast to play, as a multiplier."""
+    pitch: float = 1.0
+    """How much to raise or lower the pitch, as a multiplier. Setting this to the same as `speed` sounds like speeding up a record."""
+
+    def ffmpeg_filter(self) -> str:
+        """Returns an FFmpeg filter graph applying these effects, or an empty string if there are none."""
+        filters: list[str] = []
+        if self.bass_db:
+            filters.append(f'bass=g={self.bass_db}')
+        if self.pitch != 1.0:
+            # Resampling first makes sure the new rate is relative to 48kHz, whatever the input's rate was
+            filters += [f'aresample={SAMPLING_RATE}', f'asetrate={round(SAMPLING_RATE * self.pitch)}', f'aresample={SAMPLING_RATE}']
+        if (tempo := self.speed / self.pitch) != 1.0:
+            filters.append(f'atempo={tempo}')
+        return ','.join(filters)
+
+# Effects that can be chosen by name with the "effect" command
+EFFECT_PRESETS: dict[str, AudioEffects] = {
+    'none': AudioEffects(),
+    'nightcore': AudioEffects(speed=1.25, pitch=1.25),
+    'slowed': AudioEffects(speed=0.8, pitch=0.8),
+    'bassboost': AudioEffects(bass_db=8.0),
+}
+
+class TransformSource(AudioSource):
+    """Applies volume and fades to a PCM source. Frames are read and transformed in blocks with NumPy instead of one
+    20ms frame at a time, so the cost per frame stays small regardless of how many transforms are being applied.
+
+    Can be used in place of `discord.PCMVolumeTransformer`. Effects that can't be done here are left to FFmpeg;
+    see `AudioEffects`. Volume changes and fades take effect from the next block.
+    """
+    def __init__(self, original: AudioSource, volume: float=1.0, *, block_frames: int=10):
+        """
+        @original: The PCM source to transform.
+        @volume: (`1.0`) Volume multiplier.
+        @block_frames: (`10`) How many frames to read and transform at once.
+        """
+        if original.is_opus():
+            raise ClientException('AudioSource must not be Opus encoded.')
+        self.original = original
+        self.block_frames = block_frames
+        self._volume: float = max(volume, 0.0)
+
+        self.lock = threading.Lock()
+        self.frames: deque[bytes] = deque()
+        self.ended: bool = False
+        # Current fade, if any, counted in samples per channel
+        self.fading_out: bool = False
+        self.fade_length: int = 0
+        self.fade_position: int = 0
+
+    @property
+    def volume(self) -> float:
+        """Volume multiplier, where `1.0` leaves the audio unchanged."""
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float) -> None:
+        self._volume = max(value, 0.0)
+
+    def fade_in(self, frames: int) -> None:
+        """Fades in from silence over the given number of frames."""
+        with self.lock:
+            self.fading_out, self.fade_length, self.fade_position = False, frames * OpusEncoder.SAMPLES_PER_FRAME, 0
+
+    def fade_out(self, frames: int) -> None:
+        """Fades out to silence over the given number of frames, then ends this source."""
+        with self.lock:
+            self.fading_out, self.fade_length, self.fade_position = True, frames * OpusEncoder.SAMPLES_PER_FRAME, 0
+
+    def envelope(self, samples: int) -> np.ndarray | float:
+        """Returns the gain to apply to the next `samples` samples per channel, moving any fade along."""
+        with self.lock:
+            if not self.fade_length:
+                return self._volume
+            ramp = np.arange(self.fade_position, self.fade_position + samples, dtype=np.float32) / self.fade_length
+            ramp = np.clip(ramp, 0.0, 1.0)
+            if self.fading_out:
+                ramp = 1.0 - ramp
+            self.fade_position += samples
+            if self.fade_position >= self.fade_length:
+                if self.fading_out:
+                    self.ended = True
+                self.fade_length = 0
+            return ramp[:, np.newaxis] * self._volume
+
+    def process_block(self) -> None:
+        """Reads the next block of frames from the original source, transforms it, and queues the resulting frames."""
+        chunks: list[bytes] = []
+        while len(chunks) < self.block_frames:
+            frame = self.original.read()
+            if not frame:
+                self.ended = True
+                break
+            chunks.append(frame)
+        if not chunks:
+            return
+
+        samples = np.frombuffer(b''.join(chunks), dtype=np.int16).reshape(-1, CHANNELS)
+        gain = self.envelope(len(samples))
+        if not (isinstance(gain, float) and gain == 1.0):
+            samples = np.clip(samples * gain, -32768, 32767).astype(np.int16)
+        block = samples.tobytes()
+        self.frames.extend(block[i:i + FRAME_SIZE] for i in range(0, len(block), FRAME_SIZE))
+
+    def read(self) -> bytes:
+        if (not self.frames) and (not self.ended):
+            self.process_block()
+        return self.frames.popleft() if self.frames else b''
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        self.original.cleanup()
+
+class JitterBuffer(AudioSource):
+    """Reads ahead from a PCM source on its own thread, keeping up to `capacity_frames` frames ready to play.
+    Meant for sources reading from the network, so a short stall in the connection is absorbed by the frames
+    already buffered instead of being heard.
+
+    If the buffer does run dry before the source has ended, that's counted as an underrun, and silence is played
+    until it's refilled to `preroll_frames` frames again.
+    """
+    def __init__(self, source: AudioSource, capacity_frames: int, preroll_frames: int):
+        """
+        @source: The PCM source to read ahead from.
+        @capacity_frames: The most frames to keep buffered.
+        @preroll_frames: How many frames to buffer before playing, both at the start and after an underrun.
+        """
+        self.source = source
+        self.capacity_frames = max(capacity_frames, 1)
+        self.preroll_frames = min(preroll_frames, self.capacity_frames)
+
+        self.condition = threading.Condition()
+        self.frames: deque[bytes] = deque()
+        self.source_ended: bool = False
+        self.closed: bool = False
+        self.buffering: bool = True
+
+        self.underruns: int = 0
+        """How many times the buffer ran dry while the source was still going."""
+        self.silent_frames: int = 0
+        """How many frames of silence were played while waiting for the buffer to refill."""
+
+        self.thread = threading.Thread(target=self.fill, name='jitter-buffer', daemon=True)
+        self.thread.start()
+
+    @property
+    def fill_level(self) -> int:
+        """How many frames are currently buffered."""
+        return len(self.frames)
+
+    def fill(self) -> None:
+        """Keeps the buffer topped up until the source ends or this is cleaned up. Runs on its own thread."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or (len(self.frames) < self.capacity_frames))
+                if self.closed:
+                    return
+            try:
+                frame = self.source.read()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                # Reading from a source that's being cleaned up can fail in all sorts of ways
+                if not self.closed:
+                    log.warning('Buffered source stopped with an error: %s', e)
+                frame = b''
+            with self.condition:
+                if not frame:
+                    self.source_ended = True
+                    self.condition.notify_all()
+                    return
+                self.frames.append(frame)
+                if self.buffering and (len(self.frames) >= self.preroll_frames):
+                    self.buffering = False
+                self.condition.notify_all()
+
+    def wait_for_preroll(self, timeout: Optional[float]=None) -> bool:
+        """Blocks until enough frames are buffered to start playing, or the source has ended.
+        Returns `False` if `timeout` seconds passed first.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.source_ended or (not self.buffering), timeout)
+
+    def read(self) -> bytes:
+        with self.condition:
+            if self.buffering and (not self.source_ended):
+                self.silent_frames += 1
+                return bytes(FRAME_SIZE)
+            if self.frames:
+                frame = self.frames.popleft()
+                self.condition.notify_all()
+                return frame
+            if self.source_ended:
+                return b''
+            self.underruns += 1
+            self.buffering = True
+            self.silent_frames += 1
+            log.debug('Buffered source ran dry (underrun #%s); refilling.', self.underruns)
+            return bytes(FRAME_SIZE)
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        log.debug('Buffered source closed with %s underrun(s), %.2f seconds of silence.',
+            self.underruns, self.silent_frames * FRAME_LENGTH_SECONDS)
+        self.source.cleanup()
+
+class GaplessSource(AudioSource):
+    """Plays PCM sources back to back as one continuous source, switching between them on a frame boundary.
+
+    The source to play next is handed over with `queue_next()`, ideally a little while before the current one ends so
+    that its decoder is already running by the time it's needed. If nothing has been queued when the current source runs out,
+    this source ends as well.
+
+    Callbacks are called from the audio player's thread, not the event loop.
+    """
+    def __init__(self, first: AudioSource, length_frames: int=0, *,
+            crossfade_frames: int=0,
+            preload_frames: int=0,
+            on_near_end: Optional[Callable[[], None]]=None,
+            on_switch: Optional[Callable[[AudioSource, AudioSource], None]]=None):
+        """
+        @first: The source to start with.
+        @length_frames: (`0`) How many frames `first` is expected to last. `0` if unknown, in which case `on_near_end` isn't called for it.
+        @crossfade_frames: (`0`) How many frames at the end of each source to mix with the start of the next one.
+        @preload_frames: (`0`) How many frames before the expected end of a source to call `on_near_end`.
+        @on_near_end: Called once per source when it's close to ending; a good time to `queue_next()`.
+        @on_switch: Called with the old and new source right after switching to the next one.
+        """
+        self.current: AudioSource = first
+        self.current_length: int = length_frames
+        self.current_frames: int = 0
+        self.next: Optional[AudioSource] = None
+        self.next_length: int = 0
+
+        self.crossfade_frames = crossfade_frames
+        self.preload_frames = preload_frames
+        self.on_near_end = on_near_end
+        self.on_switch = on_switch
+
+        self.lock = threading.Lock()
+        self.lookahead: deque[bytes] = deque()
+        self.current_ended: bool = False
+        self.fading_out: deque[bytes] = deque()
+        self.fade_length: int = 0
+        self.near_end_called: bool = False
+
+    def queue_next(self, source: AudioSource, length_frames: int=0) -> None:
+        """Sets the source to switch to once the current one ends."""
+        with self.lock:
+            self.next = source
+            self.next_length = length_frames
+
+    def clear_next(self) -> Optional[AudioSource]:
+        """Un-queues the next source and returns it, if there was one. Cleaning it up is left to the caller."""
+        with self.lock:
+            source, self.next = self.next, None
+            return source
+
+    def read(self) -> bytes:
+        # Keep enough frames read ahead to know when the last `crossfade_frames` frames have been reached
+        while (not self.current_ended) and (len(self.lookahead) <= self.crossfade_frames):
+            frame = self.current.read()
+            if not frame:
+                self.current_ended = True
+                break
+            self.lookahead.append(frame)
+            self.current_frames += 1
+
+        if (not self.near_end_called) and self.on_near_end and self.current_length \
+                and (self.current_frames >= self.current_length - self.preload_frames):
+            self.near_end_called = True
+            self.on_near_end()
+
+        if self.current_ended:
+            self.switch()
+
+        if self.fading_out:
+            progress = 1.0 - (len(self.fading_out) / (self.fade_length + 1))
+            outgoing = self.fading_out.popleft()
+            return crossfade_frame(outgoing, self.lookahead.popleft() if self.lookahead else b'', progress)
+
+        return self.lookahead.popleft() if self.lookahead else b''
+
+    def switch(self) -> bool:
+        """Moves on to the next source if one is queued, keeping what's left of the current one to fade out.
+        Returns whether a switch happened.
+        """
+        with self.lock:
+            if self.next is None:
+                return False
+            old, self.current, self.next = self.current, self.next, None
+            self.current_length, self.next_length = self.next_length, 0
+
+        self.fading_out = self.lookahead
+        self.fade_length = len(self.fading_out)
+        self.lookahead = deque()
+        self.current_ended = False
+        self.current_frames = 0
+        self.near_end_called = False
+        old.cleanup()
+
+        # Pull in the start of the new source to mix with what's left of the old one
+        while (not self.current_ended) and (len(self.lookahead) <= max(self.fade_length, self.crossfade_frames)):
+            frame = self.current.read()
+            if not frame:
+                self.current_ended = True
+                break
+            self.lookahead.append(frame)
+            self.current_frames += 1
+
+        if self.on_switch:
+            self.on_switch(old, self.current)
+        return True
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        # Only the current source is cleaned up here; a queued source was created by someone else, who can still use it
+        self.current.cleanup()
+
+class OpusRecorder(AudioSource):
+    """Encodes a PCM source to Opus, keeping every encoded packet so the audio can be replayed later without decoding it again.
+
+    Encoding here instead of in the voice client costs the same, so the only overhead is memory. Once more than `max_frames`
+    frames have been read the recording is dropped, and `complete` will never become `True`.
+    """
+    def __init__(self, source: AudioSource, max_frames: int):
+        """
+        @source: A PCM source to record.
+        @max_frames: The most frames to keep before giving up on the recording.
+        """
+        self.source = source
+        self.max_frames = max_frames
+        self.encoder = OpusEncoder()
+        self.packets: list[bytes] = []
+        self.complete: bool = False
+        self.overflowed: bool = False
+
+    def read(self) -> bytes:
+        frame = self.source.read()
+        if not frame:
+            self.complete = not self.overflowed
+            return b''
+
+        packet = self.encoder.encode(frame, OpusEncoder.SAMPLES_PER_FRAME)
+        if not self.overflowed:
+            if len(self.packets) < self.max_frames:
+                self.packets.append(packet)
+            else:
+                self.overflowed = True
+                self.packets = []
+        return packet
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        self.source.cleanup()
+
+class OpusReplaySource(AudioSource):
+    """Plays Opus packets that have already been encoded, like the ones kept by an `OpusRecorder` or saved to an `OpusFrameFile`."""
+    def __init__(self, packets: Sequence[bytes], start_frame: int=0):
+        """
+        @packets: One Opus packet per frame.
+        @start_frame: (`0`) Which packet to start playing from.
+        """
+        self.packets = packets
+        self.frames_read: int = start_frame
+
+    def read(self) -> bytes:
+        if self.frames_read >= len(self.packets):
+            return b''
+        packet = self.packets[self.frames_read]
+        self.frames_read += 1
+        return packet
+
+    @property
+    def elapsed_seconds(self) -> float:
+        """How much audio has been sent to the voice client so far."""
+        return self.frames_read * FRAME_LENGTH_SECONDS
+
+    def is_opus(self) -> bool:
+        return True
+
+# Written at the start of every frame file, so that anything else is never mistaken for one
+FRAME_FILE_MAGIC: bytes = b'LYDFRM1\n'
+
+def write_frame_file(path: Path, packets: Sequence[bytes]) -> None:
+    """Saves Opus packets to a frame file, each one prefixed with its length as a 2-byte little-endian integer.
+    Writes to a temporary file first, so `path` never holds a partial file. Blocking; meant to be run in an executor.
+    """
+    partial = path.with_name(path.name + '.part')
+    with open(partial, 'wb') as f:
+        f.write(FRAME_FILE_MAGIC)
+        for packet in packets:
+            f.write(len(packet).to_bytes(2, 'little'))
+            f.write(packet)
+    partial.replace(path)
+
+class OpusFrameFile(Sequence[bytes]):
+    """The Opus packets in a frame file written by `write_frame_file()`, read through a memory map.
+    Only the packets that are actually played are read from disk, and playing them takes no decoding or encoding at all.
+
+    The file stays open until this is garbage collected, so that every `OpusReplaySource` sharing it can keep using it.
+    """
+    def __init__(self, path: Path):
+        """
+        @path: The frame file to read. Raises `ValueError` if it isn't a complete frame file.
+        """
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(FRAME_FILE_MAGIC)] != FRAME_FILE_MAGIC:
+            self.map.close()
+            raise ValueError(f'Not a frame file: {path}')
+
+        # Where each packet's length prefix is, so any packet can be found without reading the ones before it
+        self.offsets: array = array('Q')
+        position = len(FRAME_FILE_MAGIC)
+        while position + 2 <= len(self.map):
+            self.offsets.append(position)
+            position += 2 + int.from_bytes(self.map[position:position + 2], 'little')
+        if position != len(self.map):
+            self.map.close()
+            raise ValueError(f'Frame file is incomplete: {path}')
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, index: int) -> bytes: # type: ignore[override]
+        position = self.offsets[index]
+        length = int.from_bytes(self.map[position:position + 2], 'little')
+        return self.map[position + 2:position + 2 + length]
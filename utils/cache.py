@@ -0,0 +1,355 @@
+"""Keeps information about tracks that have been played in an SQLite database, so it survives restarts."""
+
+# Standard imports
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+# Local imports
+from utils.ffmpeg import LoudnessInfo
+
+log = logging.getLogger('lydian')
+
+DEFAULT_CACHE_PATH: Path = Path('lydian.db')
+RENDER_DIRECTORY: Path = Path('renders')
+FRAME_DIRECTORY: Path = Path('frames')
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id        TEXT PRIMARY KEY,
+    title           TEXT,
+    url             TEXT,
+    duration        REAL,
+    loudness_lufs   REAL,
+    true_peak_db    REAL,
+    loudness_range  REAL,
+    updated_at      REAL
+);
+CREATE INDEX IF NOT EXISTS tracks_url ON tracks (url);
+
+CREATE TABLE IF NOT EXISTS renders (
+    track_id    TEXT NOT NULL,
+    preset      TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    last_used   REAL NOT NULL,
+    PRIMARY KEY (track_id, preset)
+);
+
+CREATE TABLE IF NOT EXISTS frame_files (
+    track_id    TEXT NOT NULL,
+    preset      TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    last_used   REAL NOT NULL,
+    PRIMARY KEY (track_id, preset)
+);
+
+CREATE TABLE IF NOT EXISTS play_counts (
+    track_id    TEXT PRIMARY KEY,
+    plays       INTEGER NOT NULL
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS track_search USING fts5 (
+    title, artist,
+    track_id UNINDEXED, source UNINDEXED, url UNINDEXED, thumbnail UNINDEXED, duration UNINDEXED
+);
+
+CREATE TABLE IF NOT EXISTS play_history (
+    guild_id    INTEGER NOT NULL,
+    user_id     INTEGER NOT NULL,
+    track_id    TEXT NOT NULL,
+    source      TEXT NOT NULL,
+    url         TEXT NOT NULL,
+    title       TEXT NOT NULL,
+    artist      TEXT NOT NULL,
+    thumbnail   TEXT NOT NULL,
+    duration    REAL,
+    played_at   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS play_history_guild ON play_history (guild_id, played_at);
+CREATE INDEX IF NOT EXISTS play_history_user ON play_history (guild_id, user_id, played_at);
+CREATE INDEX IF NOT EXISTS play_history_track ON play_history (guild_id, track_id);
+
+CREATE TABLE IF NOT EXISTS stream_urls (
+    track_id    TEXT NOT NULL,
+    format_key  TEXT NOT NULL,
+    url         TEXT NOT NULL,
+    expires_at  REAL NOT NULL,
+    PRIMARY KEY (track_id, format_key)
+);
+"""
+
+def search_expression(query: str) -> Optional[str]:
+    """Turns a plain-text search into an FTS5 query matching every word in it, with the last word allowed to be unfinished.
+    Returns `None` if there's nothing to search for.
+    """
+    if not (words := re.findall(r'\w+', query)):
+        return None
+    return ' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+
+def track_file_stem(track_id: str) -> str:
+    """Returns a name to save a track's files under, without an extension, that's safe to use as a file name on any system.
+
+    IDs are normally just letters, numbers, and dashes, but local library tracks are identified by their whole path.
+    Anything that can't go in a file name is replaced, and then a short hash of the ID is added so different IDs can't end up
+    with the same name.
+    """
+    # The separator matches the one used for downloaded files, since colons aren't allowed in Windows file names
+    extractor, _, name = track_id.partition(':')
+    if (safe := re.sub(r'[^\w.-]', '_', name)) != name:
+        safe = f'{safe[-60:]}-{hashlib.sha1(track_id.encode()).hexdigest()[:12]}'
+    return f'{extractor}-#-{safe}'
+
+def stream_url_expiry(url: str) -> Optional[float]:
+    """Returns when a direct media URL stops working, as a Unix timestamp, if the URL says so itself.
+    YouTube's (googlevideo.com) URLs carry this in their `expire` parameter. Returns `None` if it can't be told.
+    """
+    try:
+        return float(parse_qs(urlparse(url).query)['expire'][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+class MetadataCache:
+    """Stores information about tracks, keyed by a track ID made of the extractor's name and the track's ID on it,
+    e.g. `youtube:dQw4w9WgXcQ`.
+
+    Every query is a small lookup or write on a local file, so they're run directly rather than through an executor.
+    The connection is shared between threads, guarded by a lock.
+    """
+    def __init__(self, path: Path=DEFAULT_CACHE_PATH):
+        """
+        @path: (`lydian.db`) Where to keep the database. Created if it doesn't exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+        log.debug('Metadata cache opened: %s', path)
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        with self.lock:
+            self.connection.close()
+
+    def store_track(self, track_id: str, *, title: Optional[str]=None, url: Optional[str]=None, duration: Optional[float]=None) -> None:
+        """Stores basic information about a track, keeping anything already known about it that isn't given here."""
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO tracks (track_id, title, url, duration, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (track_id) DO UPDATE SET
+                    title = COALESCE(excluded.title, title),
+                    url = COALESCE(excluded.url, url),
+                    duration = COALESCE(excluded.duration, duration),
+                    updated_at = excluded.updated_at
+                """, (track_id, title, url, duration, time.time()))
+
+    def find_track(self, url: str) -> Optional[sqlite3.Row]:
+        """Returns what's stored about the track at `url`, or `None` if it's never been played.
+        URLs are compared as-is, so they should be stored and looked up in the form `media.canonical_url()` gives.
+        """
+        with self.lock:
+            return self.connection.execute('SELECT * FROM tracks WHERE url = ?', (url,)).fetchone()
+
+    def get_loudness(self, track_id: str) -> Optional[LoudnessInfo]:
+        """Returns the stored loudness measurements for a track, or `None` if it hasn't been measured."""
+        with self.lock:
+            row = self.connection.execute('SELECT loudness_lufs, true_peak_db, loudness_range FROM tracks WHERE track_id = ?',
+                (track_id,)).fetchone()
+        if (row is None) or (row['loudness_lufs'] is None):
+            return None
+        return LoudnessInfo(row['loudness_lufs'], row['true_peak_db'], row['loudness_range'])
+
+    def store_loudness(self, track_id: str, info: LoudnessInfo) -> None:
+        """Stores loudness measurements for a track."""
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO tracks (track_id, loudness_lufs, true_peak_db, loudness_range, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (track_id) DO UPDATE SET
+                    loudness_lufs = excluded.loudness_lufs,
+                    true_peak_db = excluded.true_peak_db,
+                    loudness_range = excluded.loudness_range,
+                    updated_at = excluded.updated_at
+                """, (track_id, info.integrated_lufs, info.true_peak_db, info.loudness_range, time.time()))
+
+    @staticmethod
+    def render_path(track_id: str, preset: str) -> Path:
+        """Returns where a track rendered with an effect preset should be saved."""
+        return RENDER_DIRECTORY / f'{track_file_stem(track_id)}-#-{preset}.opus'
+
+    @staticmethod
+    def frame_file_path(track_id: str, preset: str) -> Path:
+        """Returns where a track's encoded frames, played with an effect preset, should be saved."""
+        return FRAME_DIRECTORY / f'{track_file_stem(track_id)}-#-{preset}.frames'
+
+    def get_render(self, track_id: str, preset: str) -> Optional[Path]:
+        """Returns the path to a track rendered with an effect preset, if one was saved, and marks it as recently used."""
+        return self.get_saved_file('renders', track_id, preset)
+
+    def store_render(self, track_id: str, preset: str, path: Path) -> None:
+        """Records a newly saved render of a track with an effect preset."""
+        self.store_saved_file('renders', track_id, preset, path)
+
+    def evict_renders(self, max_bytes: int) -> list[Path]:
+        """Forgets the least recently used renders until the rest take up at most `max_bytes`.
+        Returns the paths of the forgotten renders, which the caller is responsible for deleting.
+        """
+        return self.evict_saved_files('renders', max_bytes)
+
+    def get_frame_file(self, track_id: str, preset: str) -> Optional[Path]:
+        """Returns the path to a track's saved frames with an effect preset, if they were saved, and marks them as recently used."""
+        return self.get_saved_file('frame_files', track_id, preset)
+
+    def store_frame_file(self, track_id: str, preset: str, path: Path) -> None:
+        """Records a newly saved frame file of a track with an effect preset."""
+        self.store_saved_file('frame_files', track_id, preset, path)
+
+    def evict_frame_files(self, max_bytes: int) -> list[Path]:
+        """Forgets the least recently used frame files until the rest take up at most `max_bytes`.
+        Returns the paths of the forgotten files, which the caller is responsible for deleting.
+        """
+        return self.evict_saved_files('frame_files', max_bytes)
+
+    def get_saved_file(self, table: str, track_id: str, preset: str) -> Optional[Path]:
+        """Returns the path of a file saved for a track and effect preset in `table`, and marks it as recently used.
+
+        @table: Either `renders` or `frame_files`, which are laid out the same way. Never user input, as it's put into the query as-is.
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute(f'SELECT path FROM {table} WHERE track_id = ? AND preset = ?', (track_id, preset)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(f'UPDATE {table} SET last_used = ? WHERE track_id = ? AND preset = ?', (time.time(), track_id, preset))
+        return Path(row['path'])
+
+    def store_saved_file(self, table: str, track_id: str, preset: str, path: Path) -> None:
+        """Records a file saved for a track and effect preset in `table`."""
+        with self.lock, self.connection:
+            self.connection.execute(f"""
+                INSERT OR REPLACE INTO {table} (track_id, preset, path, size, last_used) VALUES (?, ?, ?, ?, ?)
+                """, (track_id, preset, str(path), path.stat().st_size, time.time()))
+
+    def evict_saved_files(self, table: str, max_bytes: int) -> list[Path]:
+        """Forgets the least recently used files in `table` until the rest take up at most `max_bytes`, and returns their paths."""
+        evicted: list[Path] = []
+        with self.lock, self.connection:
+            total: int = self.connection.execute(f'SELECT COALESCE(SUM(size), 0) FROM {table}').fetchone()[0]
+            for row in self.connection.execute(f'SELECT track_id, preset, path, size FROM {table} ORDER BY last_used').fetchall():
+                if total <= max_bytes:
+                    break
+                self.connection.execute(f'DELETE FROM {table} WHERE track_id = ? AND preset = ?', (row['track_id'], row['preset']))
+                evicted.append(Path(row['path']))
+                total -= row['size']
+        return evicted
+
+    def count_play(self, track_id: str) -> int:
+        """Counts a play of a track, and returns how many times it's been played in total."""
+        with self.lock, self.connection:
+            return self.connection.execute("""
+                INSERT INTO play_counts (track_id, plays) VALUES (?, 1)
+                ON CONFLICT (track_id) DO UPDATE SET plays = plays + 1
+                RETURNING plays
+                """, (track_id,)).fetchone()['plays']
+
+    def get_plays(self, track_id: str) -> int:
+        """Returns how many times a track has been played."""
+        with self.lock:
+            row = self.connection.execute('SELECT plays FROM play_counts WHERE track_id = ?', (track_id,)).fetchone()
+        return row['plays'] if row else 0
+
+    def index_track(self, track_id: str, *, source: str, url: str, title: str, artist: str, thumbnail: str, duration: float) -> None:
+        """Adds a played track to the search index, or updates it, so searching for it again can find it without the network.
+
+        @source: The `MediaSource` it was queued as, after matching, so it can be queued the same way again.
+        @url: The URL it was queued with.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM track_search WHERE track_id = ?', (track_id,))
+            self.connection.execute("""
+                INSERT INTO track_search (title, artist, track_id, source, url, thumbnail, duration) VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (title, artist, track_id, source, url, thumbnail, duration))
+
+    def search_tracks(self, query: str, limit: int=5) -> list[sqlite3.Row]:
+        """Returns played tracks whose title and artist contain every word of a plain-text search, best match first,
+        along with how many times each has been played.
+        """
+        if (expression := search_expression(query)) is None:
+            return []
+        with self.lock:
+            return self.connection.execute("""
+                SELECT track_search.*, COALESCE(play_counts.plays, 0) AS plays
+                FROM track_search LEFT JOIN play_counts ON play_counts.track_id = track_search.track_id
+                WHERE track_search MATCH ? ORDER BY bm25(track_search) LIMIT ?
+                """, (expression, limit)).fetchall()
+
+    def add_history(self, guild_id: int, user_id: int, track_id: str, *, source: str, url: str, title: str, artist: str,
+            thumbnail: str, duration: float, keep: int) -> None:
+        """Records a finished play of a track in a server's play history, then forgets that server's oldest plays beyond
+        the most recent `keep`, so the history doesn't grow forever.
+
+        @user_id: Who queued the track.
+        @source: The `MediaSource` it was queued as, so it can be queued the same way again.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO play_history (guild_id, user_id, track_id, source, url, title, artist, thumbnail, duration, played_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (guild_id, user_id, track_id, source, url, title, artist, thumbnail, duration, time.time()))
+            self.connection.execute("""
+                DELETE FROM play_history WHERE guild_id = ? AND played_at < (
+                    SELECT played_at FROM play_history WHERE guild_id = ? ORDER BY played_at DESC LIMIT 1 OFFSET ?
+                )
+                """, (guild_id, guild_id, keep - 1))
+
+    def get_history(self, guild_id: int, limit: int, user_id: Optional[int]=None) -> list[sqlite3.Row]:
+        """Returns a server's most recent plays, newest first, optionally only those of tracks queued by one user."""
+        with self.lock:
+            if user_id is None:
+                return self.connection.execute('SELECT * FROM play_history WHERE guild_id = ? ORDER BY played_at DESC LIMIT ?',
+                    (guild_id, limit)).fetchall()
+            return self.connection.execute(
+                'SELECT * FROM play_history WHERE guild_id = ? AND user_id = ? ORDER BY played_at DESC LIMIT ?',
+                (guild_id, user_id, limit)).fetchall()
+
+    def top_tracks(self, guild_id: int, limit: int, user_id: Optional[int]=None) -> list[sqlite3.Row]:
+        """Returns the tracks played the most in a server's history, most played first, optionally only counting plays
+        of tracks queued by one user. Each row is the track's latest play, along with how many times it was played as `plays`.
+        """
+        # With MAX() in the query, SQLite takes the other columns from the row that had the maximum, i.e. the latest play
+        with self.lock:
+            return self.connection.execute("""
+                SELECT *, COUNT(*) AS plays, MAX(played_at) AS last_played FROM play_history
+                WHERE guild_id = ? AND (? IS NULL OR user_id = ?)
+                GROUP BY track_id ORDER BY plays DESC, last_played DESC LIMIT ?
+                """, (guild_id, user_id, user_id, limit)).fetchall()
+
+    def get_stream_url(self, track_id: str, format_key: str, valid_for: float=0.0) -> Optional[str]:
+        """Returns a direct stream URL that a track was resolved to before, if it's going to keep working for at least
+        another `valid_for` seconds.
+
+        @format_key: Identifies how the format was picked, since different voice channels can call for different formats.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT url FROM stream_urls WHERE track_id = ? AND format_key = ? AND expires_at > ?',
+                (track_id, format_key, time.time() + valid_for)).fetchone()
+        return row['url'] if row else None
+
+    def store_stream_url(self, track_id: str, format_key: str, url: str, expires_at: float) -> None:
+        """Stores a direct stream URL a track was resolved to, and forgets any that have expired."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM stream_urls WHERE expires_at <= ?', (time.time(),))
+            self.connection.execute('INSERT OR REPLACE INTO stream_urls (track_id, format_key, url, expires_at) VALUES (?, ?, ?, ?)',
+                (track_id, format_key, url, expires_at))
+
+    def forget_stream_urls(self, track_id: str) -> None:
+        """Forgets every stream URL stored for a track, e.g. because one stopped working early."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM stream_urls WHERE track_id = ?', (track_id,))
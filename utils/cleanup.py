@@ -0,0 +1,127 @@
+"""Deletes downloaded media files in the background, keeping file I/O off of the event loop."""
+
+# Standard imports
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+log = logging.getLogger('lydian')
+
+def remove_files(paths: list[Path]) -> list[tuple[Path, int, Optional[Exception]]]:
+    """Removes each file in `paths`. Blocking; meant to be run in an executor.
+
+    Returns a tuple for every path of the path itself, how many bytes were freed by removing it, and the exception
+    that prevented removing it, if any. Files that were already gone count as removed, having freed 0 bytes.
+    """
+    results: list[tuple[Path, int, Optional[Exception]]] = []
+    for path in paths:
+        try:
+            size = path.stat().st_size
+            os.remove(path)
+            results.append((path, size, None))
+        except FileNotFoundError:
+            results.append((path, 0, None))
+        except OSError as e:
+            results.append((path, 0, e))
+    return results
+
+class FileCleaner:
+    """Background worker that deletes files in batches using the default executor.
+
+    Files that can't be removed yet — usually because FFmpeg or Windows still has them open — are put back in line
+    after a delay that doubles on each attempt, and are given up on after `max_attempts`.
+    """
+    def __init__(self, batch_size: int=100, max_attempts: int=5, retry_delay: float=2.0):
+        """
+        @batch_size: (`100`) Maximum number of files to remove per trip to the executor.
+        @max_attempts: (`5`) How many times to try removing a file before giving up on it.
+        @retry_delay: (`2.0`) Seconds to wait before the first retry; doubled for each one after that.
+        """
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self.queue: asyncio.Queue[tuple[Path, int]] = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        self.pending_retries: set[asyncio.TimerHandle] = set()
+
+        self.files_removed: int = 0
+        self.bytes_reclaimed: int = 0
+
+    def start(self) -> None:
+        """Starts the worker task, if it isn't already running."""
+        if (self.task is None) or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stops the worker task. Anything still waiting to be deleted is left alone."""
+        for handle in self.pending_retries:
+            handle.cancel()
+        self.pending_retries.clear()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def delete(self, *paths: Path) -> None:
+        """Queues files to be deleted."""
+        for path in paths:
+            self.queue.put_nowait((Path(path), 0))
+
+    async def sweep(self, directory: Path, extensions: list[str]) -> None:
+        """Queues every file in `directory` that has one of the given extensions to be deleted.
+        Used on startup to clear out anything left behind by a previous run.
+        """
+        def find_files() -> list[Path]:
+            with os.scandir(directory) as entries:
+                return [Path(entry.path) for entry in entries if entry.is_file() and (Path(entry.name).suffix in extensions)]
+
+        files = await asyncio.get_running_loop().run_in_executor(None, find_files)
+        log.info('Found %s leftover media file(s) to remove.', len(files))
+        self.delete(*files)
+
+    def retry_later(self, path: Path, attempts: int) -> None:
+        """Puts a file back into the queue after waiting, or gives up on it if it's been tried enough times."""
+        if attempts >= self.max_attempts:
+            log.warning('Giving up on removing file after %s attempts: %s', attempts, path)
+            return
+
+        def requeue():
+            self.pending_retries.discard(handle)
+            self.queue.put_nowait((path, attempts))
+
+        handle = asyncio.get_running_loop().call_later(self.retry_delay * (2 ** (attempts - 1)), requeue)
+        self.pending_retries.add(handle)
+
+    async def run(self) -> None:
+        """Waits for files to be queued, and removes them in batches."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: list[tuple[Path, int]] = [await self.queue.get()]
+            while (len(batch) < self.batch_size) and (not self.queue.empty()):
+                batch.append(self.queue.get_nowait())
+
+            attempts: dict[Path, int] = dict(batch)
+            results = await loop.run_in_executor(None, remove_files, list(attempts))
+
+            removed: int = 0
+            reclaimed: int = 0
+            for path, size, error in results:
+                if error is None:
+                    removed += 1
+                    reclaimed += size
+                    log.debug('Removed file: %s', path)
+                else:
+                    log.debug('Couldn\'t remove file yet (%s): %s', error.__class__.__name__, path)
+                    self.retry_later(path, attempts[path] + 1)
+
+            self.files_removed += removed
+            self.bytes_reclaimed += reclaimed
+            if removed:
+                log.info('Removed %s file(s), reclaiming %.2f MB (%.2f MB total).',
+                    removed, reclaimed / (1024 * 1024), self.bytes_reclaimed / (1024 * 1024))
@@ -94,6 +94,7 @@ DEV_PREFIX              : str       = check_type('prefixes.developer', str)
 COMMAND_PREFIX          : str       = PUBLIC_PREFIX if PUBLIC else DEV_PREFIX
 EMBED_COLOR             : int       = int(get('embed-color'), 16) # A ValueError here means this isn't a valid hex code
 INACTIVITY_TIMEOUT_MINS : int       = check_type('inactivity-timeout', int)
+STALL_TIMEOUT_SECONDS   : int       = check_type('stall-timeout', int)
 CLEANUP_EXTENSIONS      : list[str] = check_type('auto-remove', list)
 DISABLED_COMMANDS       : list[str] = check_type('command-blacklist', list)
 
@@ -138,7 +139,11 @@ DISABLE_LOG_COLORS : bool           = check_type('logging-options.colors.no-colo
 LOG_TRACEBACKS     : bool           = check_type('logging-options.log-full-tracebacks', bool)
 
 SHOW_USERS_IN_QUEUE  : bool = check_type('show-users-in-queue', bool)
-MAX_HISTORY_LENGTH   : int  = max(check_type('play-history-max', int), 20)
+NOW_PLAYING_REFRESH_SECONDS : int = check_type('now-playing.refresh-interval', int)
+MAX_HISTORY_LENGTH   : int  = min(check_type('play-history-max', int), 20)
+STORED_HISTORY_LENGTH: int  = check_type('play-history-stored', int)
+if STORED_HISTORY_LENGTH < 1:
+    raise ValueError(f'Config key "play-history-stored" must be at least 1 (got {STORED_HISTORY_LENGTH})')
 ALLOW_MEDIALISTS     : bool = check_type('allow-playlists-albums', bool)
 MAX_PLAYLIST_LENGTH  : int  = check_type('playlist-track-limit', int)
 MAX_ALBUM_LENGTH     : int  = check_type('album-track-limit', int)
@@ -148,6 +153,7 @@ if FORCE_MATCH_PROMPT:
     log.warning('Config key "force-match-prompt" is turned on, which may cause problems if this was unintentional.')
 
 USE_TOP_MATCH          : bool = check_type('use-top-match', bool)
+SEARCH_PLAY_HISTORY    : bool = check_type('search-play-history', bool)
 DURATION_LIMIT_HOURS   : int  = check_type('duration-limit', int)
 DURATION_LIMIT_SECONDS : int  = DURATION_LIMIT_HOURS * 60 * 60
 
@@ -163,4 +169,51 @@ if SKIP_VOTES_PERCENTAGE > 100:
 
 MAX_FILE_SIZE: int = check_type('maximum-file-size', int)
 
+DOWNLOAD_CONNECTIONS    : int = check_type('downloads.connections', int)
+DOWNLOAD_EARLY_START_MB : int = check_type('downloads.early-start-mb', int)
+STREAM_BUFFER_SECONDS   : int = check_type('downloads.stream-buffer-seconds', int)
+STREAM_PREROLL_SECONDS  : int = check_type('downloads.stream-preroll-seconds', int)
+MEMORY_TRACK_MB         : int = check_type('downloads.memory-track-mb', int)
+MEMORY_BUDGET_MB        : int = check_type('downloads.memory-budget-mb', int)
+if DOWNLOAD_CONNECTIONS < 1:
+    raise ValueError(f'Config key "downloads.connections" must be at least 1 (got {DOWNLOAD_CONNECTIONS})')
+
+AUDIO_FORMAT_MATCH_BITRATE : bool      = check_type('audio-format.match-channel-bitrate', bool)
+AUDIO_FORMAT_FALLBACKS     : list[str] = check_type('audio-format.fallbacks', list)
+
+GAPLESS_PLAYBACK        : bool = check_type('gapless-playback.enabled', bool)
+GAPLESS_PRELOAD_SECONDS : int  = check_type('gapless-playback.preload-seconds', int)
+GAPLESS_CROSSFADE_MS    : int  = check_type('gapless-playback.crossfade-ms', int)
+
+LOOP_MEMORY_MAX_SECONDS: int = check_type('loop-memory-limit', int)
+
+LOUDNESS_NORMALIZATION : bool = check_type('loudness-normalization.enabled', bool)
+LOUDNESS_TARGET_LUFS   : int  = check_type('loudness-normalization.target-lufs', int)
+
+EFFECT_RENDER_CACHE  : bool = check_type('effects.cache-renders', bool)
+EFFECT_CACHE_SIZE_MB : int  = check_type('effects.cache-size-mb', int)
+
+FRAME_CACHE           : bool = check_type('frame-cache.enabled', bool)
+FRAME_CACHE_MIN_PLAYS : int  = check_type('frame-cache.min-plays', int)
+FRAME_CACHE_SIZE_MB   : int  = check_type('frame-cache.size-mb', int)
+
+LIBRARY_DIRECTORY  : str       = check_type('local-library.directory', str)
+LIBRARY_EXTENSIONS : list[str] = check_type('local-library.extensions', list)
+
+AUTOPLAY_ENABLED   : bool = check_type('autoplay.enabled', bool)
+AUTOPLAY_POOL_SIZE : int  = check_type('autoplay.pool-size', int)
+if AUTOPLAY_POOL_SIZE < 1:
+    raise ValueError(f'Config key "autoplay.pool-size" must be at least 1 (got {AUTOPLAY_POOL_SIZE})')
+
+SAVED_PLAYLIST_LIMIT     : int  = check_type('saved-playlists.track-limit', int)
+PLAYLIST_WARM_CACHE      : bool = check_type('saved-playlists.warm-cache', bool)
+PLAYLIST_WARM_FROM_HOUR  : int  = check_type('saved-playlists.warm-from-hour', int)
+PLAYLIST_WARM_UNTIL_HOUR : int  = check_type('saved-playlists.warm-until-hour', int)
+if not 0 <= PLAYLIST_WARM_FROM_HOUR <= 23:
+    raise ValueError(f'Config key "saved-playlists.warm-from-hour" must be from 0 to 23 (got {PLAYLIST_WARM_FROM_HOUR})')
+if not 0 <= PLAYLIST_WARM_UNTIL_HOUR <= 23:
+    raise ValueError(f'Config key "saved-playlists.warm-until-hour" must be from 0 to 23 (got {PLAYLIST_WARM_UNTIL_HOUR})')
+if PLAYLIST_WARM_CACHE and not FRAME_CACHE:
+    log.warning('Config key "saved-playlists.warm-cache" is turned on, but does nothing without "frame-cache.enabled".')
+
 log.info('No critical issues with configuration.')
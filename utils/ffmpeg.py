@@ -0,0 +1,147 @@
+"""Runs FFmpeg directly for work that happens outside of playback, like analyzing downloaded files."""
+
+# Standard imports
+import asyncio
+import json
+import logging
+import math
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+log = logging.getLogger('lydian')
+
+FFMPEG_EXECUTABLE: str = 'ffmpeg'
+FFPROBE_EXECUTABLE: str = 'ffprobe'
+# Remote files only have their headers read by FFprobe, which shouldn't take long
+PROBE_TIMEOUT_SECONDS: int = 15
+
+@dataclass
+class LoudnessInfo:
+    """Results of an EBU R128 loudness measurement."""
+    integrated_lufs: float
+    true_peak_db: float
+    loudness_range: float
+
+    def gain_to(self, target_lufs: float, peak_ceiling_db: float=-1.0) -> float:
+        """Returns the gain in dB that brings this audio to `target_lufs`, reduced if needed to keep its true peak
+        under `peak_ceiling_db`.
+        """
+        return min(target_lufs - self.integrated_lufs, peak_ceiling_db - self.true_peak_db)
+
+@dataclass
+class ProbeInfo:
+    """What FFprobe could tell about a media file without decoding it. Tags that aren't set are empty strings."""
+    duration: float
+    title: str
+    artist: str
+    album: str
+
+def input_args(source: Path | bytes) -> tuple[str, Optional[bytes]]:
+    """Returns what to pass to FFmpeg's `-i` for `source`, and what to write to its stdin, if anything.
+    Media that's been downloaded into memory is piped in instead of being read from a file.
+    """
+    if isinstance(source, bytes):
+        return 'pipe:0', source
+    return str(source), None
+
+async def measure_loudness(source: Path | bytes) -> Optional[LoudnessInfo]:
+    """Measures the loudness of a media file, or media in memory, with FFmpeg's `loudnorm` filter.
+    This decodes the whole thing as fast as possible without playing anything, in a separate process.
+    Returns `None` if it couldn't be measured.
+    """
+    path, stdin = input_args(source)
+    try:
+        process = await asyncio.create_subprocess_exec(FFMPEG_EXECUTABLE, '-hide_banner', '-nostats',
+            '-i', path, '-vn', '-af', 'loudnorm=print_format=json', '-f', 'null', '-',
+            stdin=asyncio.subprocess.PIPE if stdin else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        log.warning('Couldn\'t run FFmpeg to measure loudness: %s', e)
+        return None
+
+    _, stderr = await process.communicate(stdin)
+    output = stderr.decode(errors='replace')
+    if process.returncode != 0:
+        log.debug('FFmpeg exited with code %s while measuring loudness of: %s', process.returncode, path)
+        return None
+
+    # loudnorm prints its measurements as a JSON object near the end of the output, followed only by FFmpeg's summary
+    if not (blocks := re.findall(r'\{[^{}]*\}', output)):
+        log.debug('No loudness measurements found in FFmpeg\'s output for: %s', path)
+        return None
+    try:
+        results = json.loads(blocks[-1])
+        info = LoudnessInfo(float(results['input_i']), float(results['input_tp']), float(results['input_lra']))
+    except (json.JSONDecodeError, KeyError, ValueError):
+        log.debug('Couldn\'t parse loudness measurements for: %s', path)
+        return None
+
+    # Silence measures as -inf, which can't be normalized
+    if not (math.isfinite(info.integrated_lufs) and math.isfinite(info.true_peak_db)):
+        return None
+    return info
+
+async def render_effects(source: Path | bytes, destination: Path, filter_graph: str) -> bool:
+    """Saves a copy of `source`, a file or media in memory, to `destination` with an FFmpeg filter graph applied, encoded as Opus.
+    Renders to a temporary file first, so `destination` never ends up holding a partial render. Returns whether it succeeded.
+    """
+    partial = destination.with_name(destination.name + '.part')
+    path, stdin = input_args(source)
+    try:
+        process = await asyncio.create_subprocess_exec(FFMPEG_EXECUTABLE, '-hide_banner', '-nostats', '-y',
+            '-i', path, '-vn', '-af', filter_graph, '-c:a', 'libopus', '-b:a', '128k', '-f', 'opus', str(partial),
+            stdin=asyncio.subprocess.PIPE if stdin else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        log.warning('Couldn\'t run FFmpeg to render effects: %s', e)
+        return False
+
+    _, stderr = await process.communicate(stdin)
+    if process.returncode != 0:
+        log.debug('FFmpeg exited with code %s while rendering effects for %s: %s',
+            process.returncode, path, stderr.decode(errors='replace').strip().splitlines()[-1:])
+        partial.unlink(missing_ok=True)
+        return False
+    partial.replace(destination)
+    return True
+
+async def probe_media(source: Path | str) -> Optional[ProbeInfo]:
+    """Reads the duration and tags of a media file or URL with FFprobe, which only reads as much of it as it needs to.
+    Returns `None` if it couldn't be probed, or has no audio.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(FFPROBE_EXECUTABLE, '-v', 'error', '-select_streams', 'a:0',
+            '-show_entries', 'format=duration:format_tags:stream=codec_type:stream_tags',
+            '-of', 'json', str(source),
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        log.warning('Couldn\'t run FFprobe: %s', e)
+        return None
+
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), PROBE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        process.kill()
+        log.debug('FFprobe timed out while probing: %s', source)
+        return None
+    if process.returncode != 0:
+        log.debug('FFprobe exited with code %s while probing %s: %s',
+            process.returncode, source, stderr.decode(errors='replace').strip().splitlines()[-1:])
+        return None
+
+    try:
+        results = json.loads(stdout)
+    except json.JSONDecodeError:
+        log.debug('Couldn\'t parse FFprobe\'s output for: %s', source)
+        return None
+    if not results.get('streams'):
+        return None
+    # Ogg files keep their tags on the stream rather than the container; tag names are case-insensitive
+    tags = {key.lower(): value for key, value in (results['streams'][0].get('tags', {}) | results.get('format', {}).get('tags', {})).items()}
+    try:
+        duration = float(results.get('format', {}).get('duration', 0))
+    except ValueError:
+        duration = 0.0
+    return ProbeInfo(duration, tags.get('title', ''), tags.get('artist', ''), tags.get('album', ''))
@@ -0,0 +1,165 @@
+"""Indexes a folder of music files on this machine, so it can be searched and played without going through the network."""
+
+# Standard imports
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+# Local imports
+from utils.cache import DEFAULT_CACHE_PATH, search_expression
+from utils.ffmpeg import ProbeInfo, probe_media
+
+log = logging.getLogger('lydian')
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS library_files (
+    path        TEXT PRIMARY KEY,
+    mtime       REAL NOT NULL,
+    size        INTEGER NOT NULL,
+    title       TEXT NOT NULL,
+    artist      TEXT NOT NULL,
+    album       TEXT NOT NULL,
+    duration    REAL
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS library_search USING fts5 (
+    title, artist, album, content='library_files', content_rowid='rowid'
+);
+
+CREATE TRIGGER IF NOT EXISTS library_files_insert AFTER INSERT ON library_files BEGIN
+    INSERT INTO library_search (rowid, title, artist, album) VALUES (new.rowid, new.title, new.artist, new.album);
+END;
+CREATE TRIGGER IF NOT EXISTS library_files_delete AFTER DELETE ON library_files BEGIN
+    INSERT INTO library_search (library_search, rowid, title, artist, album) VALUES ('delete', old.rowid, old.title, old.artist, old.album);
+END;
+CREATE TRIGGER IF NOT EXISTS library_files_update AFTER UPDATE ON library_files BEGIN
+    INSERT INTO library_search (library_search, rowid, title, artist, album) VALUES ('delete', old.rowid, old.title, old.artist, old.album);
+    INSERT INTO library_search (rowid, title, artist, album) VALUES (new.rowid, new.title, new.artist, new.album);
+END;
+"""
+
+# How many files to read tags from at once while scanning, and how many to write to the index at a time
+PROBE_CONCURRENCY: int = 4
+SCAN_BATCH_SIZE: int = 100
+
+class LibraryIndex:
+    """Keeps the path, modification time, and tags of every music file under `root` in an SQLite database, along with
+    a full-text index of their titles, artists, and albums.
+
+    Scanning only reads tags from files that are new or changed since the last scan, so rescanning a large, mostly
+    unchanged library mostly costs a walk over its folders. The connection is shared between threads, guarded by a lock.
+    """
+    def __init__(self, root: Path, extensions: list[str], path: Path=DEFAULT_CACHE_PATH):
+        """
+        @root: The folder to index, including its subfolders.
+        @extensions: Which kinds of files to include, e.g. `.mp3`.
+        @path: (`lydian.db`) Where to keep the index. Created if it doesn't exist.
+        """
+        self.root = root
+        self.extensions = {extension.lower() for extension in extensions}
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+        log.debug('Library index opened: %s', path)
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM library_files').fetchone()[0]
+
+    def find_files(self) -> dict[str, tuple[float, int]]:
+        """Returns the modification time and size of every file under `root` with one of the included extensions, by path.
+        Blocking; meant to be run in an executor.
+        """
+        found: dict[str, tuple[float, int]] = {}
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() not in self.extensions:
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (stat.st_mtime, stat.st_size)
+        return found
+
+    def tags_from_path(self, path: str) -> tuple[str, str, str]:
+        """Guesses a file's title, artist, and album from where it is, for files without tags.
+        Goes by the common `artist/album/track` layout; anything that isn't there is left empty.
+        """
+        parts = Path(path).relative_to(self.root).parts
+        album = parts[-2] if len(parts) >= 2 else ''
+        artist = parts[-3] if len(parts) >= 3 else ''
+        return Path(path).stem, artist, album
+
+    async def scan(self) -> tuple[int, int]:
+        """Brings the index up to date with what's under `root`. Returns how many files were added or updated, and how many were removed."""
+        if not self.root.is_dir():
+            log.warning('Library folder doesn\'t exist: %s', self.root)
+            return 0, 0
+
+        found = await asyncio.get_running_loop().run_in_executor(None, self.find_files)
+        with self.lock:
+            known = {row['path']: (row['mtime'], row['size']) for row in self.connection.execute('SELECT path, mtime, size FROM library_files')}
+        changed = [path for path, stat in found.items() if known.get(path) != stat]
+        removed = [path for path in known if path not in found]
+        log.info('Scanning library: %s file(s) found, %s new or changed, %s removed.', len(found), len(changed), len(removed))
+
+        semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+        async def probe(path: str) -> tuple[str, Optional[ProbeInfo]]:
+            async with semaphore:
+                return path, await probe_media(path)
+
+        for start in range(0, len(changed), SCAN_BATCH_SIZE):
+            results = await asyncio.gather(*(probe(path) for path in changed[start:start + SCAN_BATCH_SIZE]))
+            self.store_files([(path, *found[path], info) for path, info in results])
+        self.forget_files(removed)
+        return len(changed), len(removed)
+
+    def store_files(self, files: list[tuple[str, float, int, Optional[ProbeInfo]]]) -> None:
+        """Adds or updates files in the index, given each one's path, modification time, size, and what FFprobe read from it."""
+        rows = []
+        for path, mtime, size, info in files:
+            title, artist, album = self.tags_from_path(path)
+            if info is not None:
+                title, artist, album = (info.title or title), (info.artist or artist), (info.album or album)
+            rows.append((path, mtime, size, title, artist, album, info.duration if info else None))
+        with self.lock, self.connection:
+            # An upsert rather than a replace, so the search index is kept in step by the update trigger
+            self.connection.executemany("""
+                INSERT INTO library_files (path, mtime, size, title, artist, album, duration) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    mtime = excluded.mtime,
+                    size = excluded.size,
+                    title = excluded.title,
+                    artist = excluded.artist,
+                    album = excluded.album,
+                    duration = excluded.duration
+                """, rows)
+
+    def forget_files(self, paths: list[str]) -> None:
+        """Removes files from the index."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM library_files WHERE path = ?', [(path,) for path in paths])
+
+    def search(self, query: str, limit: int=5) -> list[sqlite3.Row]:
+        """Returns the files whose title, artist, or album best match a plain-text search, best match first."""
+        if (expression := search_expression(query)) is None:
+            return []
+        with self.lock:
+            return self.connection.execute("""
+                SELECT library_files.* FROM library_search JOIN library_files ON library_files.rowid = library_search.rowid
+                WHERE library_search MATCH ? ORDER BY bm25(library_search) LIMIT ?
+                """, (expression, limit)).fetchall()
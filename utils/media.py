@@ -5,10 +5,13 @@ standardized results from various sources."""
 import json
 import logging
 import re
-from typing import Any, Literal, Optional, Self, TypedDict, cast
+from pathlib import Path, PurePosixPath
+from urllib.parse import parse_qs, unquote, urlparse
+from typing import Any, Callable, Iterator, Literal, Mapping, Optional, Self, TypedDict, cast
 
 # External imports
 import pytube
+import requests
 from benedict import benedict
 from fuzzywuzzy import fuzz
 from sclib import SoundcloudAPI
@@ -21,7 +24,8 @@ from ytmusicapi import YTMusic
 
 # Local imports
 import utils.configuration as cfg
-from utils.miscutil import seconds_to_hms
+from utils.ffmpeg import ProbeInfo
+from utils.miscutil import hms_to_seconds, seconds_to_hms
 from utils.palette import Palette
 
 log = logging.getLogger('lydian')
@@ -43,6 +47,8 @@ YOUTUBE    = MediaSource('youtube')
 SPOTIFY    = MediaSource('spotify')
 SOUNDCLOUD = MediaSource('soundcloud')
 OTHER      = MediaSource('other') # Uses yt_dlp's extract_info(), should have basic common attributes
+DIRECT     = MediaSource('direct') # A link straight to audio, like an internet radio station; played without yt_dlp
+LOCAL      = MediaSource('local') # A file in the local library, see `utils/library.py`
 
 #region EXCEPTIONS
 class MediaError(Exception):
@@ -75,6 +81,8 @@ class MediaInfo:
         self.is_track: bool = False
         self.is_album: bool = False
         self.is_playlist: bool = False
+        # Live streams have no length, and can't be seeked in
+        self.is_live: bool = False
 
         self.url: str = ''
         self.title: str = ''
@@ -146,6 +154,12 @@ class MediaInfo:
                 raise ValueError(f'Invalid yt_result_origin received: {yt_info_origin}')
         elif source == OTHER:
             self._process_generic()
+        elif source == DIRECT:
+            self._process_generic()
+            self.is_live = cast(bool, self.info['is_live'])
+        elif source == LOCAL:
+            self._process_generic()
+            self.album_name = cast(str, self.info['album'])
         else:
             raise NotImplementedError(f'MediaInfo has no implementation for source: {source}')
 
@@ -261,6 +275,53 @@ class TrackInfo(MediaInfo):
         """Creates a new `TrackInfo` object from a SoundCloud URL."""
         return cls(SOUNDCLOUD, sc.resolve(url))
 
+    @classmethod
+    def from_direct_url(cls, url: str) -> Optional[Self]:
+        """Creates a new `TrackInfo` object from a URL that links straight to audio, or returns `None` if it doesn't.
+        See `probe_direct_url()`.
+        """
+        if (info := probe_direct_url(url)) is None:
+            return None
+        return cls(DIRECT, info)
+
+    @classmethod
+    def from_probe(cls, url: str, probe: ProbeInfo) -> Self:
+        """Creates a new `TrackInfo` object from a URL that links straight to an audio file, like a Discord attachment,
+        using what FFprobe read from it.
+        """
+        return cls(DIRECT, direct_info(url, url, title=probe.title, artist=probe.artist, duration=probe.duration))
+
+    @classmethod
+    def from_index(cls, row: Mapping[str, Any]) -> Self:
+        """Creates a new `TrackInfo` object for a track that's been played before, as returned by `MetadataCache.search_tracks()`,
+        without going through the network. Tracks are rebuilt as the source they were played from, where that matters for playing them.
+        """
+        if row['source'] == LOCAL:
+            return cls.from_library({'path': row['url'], 'title': row['title'], 'artist': row['artist'], 'album': '',
+                'duration': row['duration']})
+        if row['source'] == DIRECT:
+            return cls(DIRECT, direct_info(row['url'], row['url'], title=row['title'], artist=row['artist'],
+                duration=row['duration'] or 0, is_live=not row['duration']))
+        info = {'webpage_url': row['url'], 'title': row['title'], 'uploader': row['artist'], 'duration': row['duration'],
+            'thumbnails': [{'url': row['thumbnail']}]}
+        if row['source'] == YOUTUBE:
+            return cls(YOUTUBE, info, yt_info_origin='ytdl')
+        return cls(OTHER, info)
+
+    @classmethod
+    def from_library(cls, row: Mapping[str, Any]) -> Self:
+        """Creates a new `TrackInfo` object from a file in the local library, as returned by `LibraryIndex.search()`."""
+        return cls(LOCAL, {
+            'extractor': LOCAL,
+            'id': row['path'],
+            'url': row['path'],
+            'webpage_url': row['path'],
+            'title': row['title'],
+            'uploader': row['artist'],
+            'album': row['album'],
+            'duration': row['duration'] or 0,
+        })
+
 class AlbumInfo(MediaInfo):
     """Specific parsing for album data."""
     def __init__(self, source: MediaSource, info: Any, yt_info_origin: Optional[Literal['pytube', 'ytmusic', 'ytdl']] = None):
@@ -393,7 +454,7 @@ ffmpeg_options = {
 
 # Configure youtube dl
 ytdl_format_options = {
-    'format': 'bestaudio/best',
+    'format': '/'.join(cfg.AUDIO_FORMAT_FALLBACKS),
     'outtmpl': '%(extractor)s-#-%(id)s-#-%(title)s.%(ext)s',
     'restrictfilenames': True,
     'noplaylist': True,
@@ -405,10 +466,14 @@ ytdl_format_options = {
     'default_search': 'auto',
     'extract_flat': True,
     'max_filesize': cfg.MAX_FILE_SIZE * 1024 * 1024,
+    # Only applies to formats that are split into fragments, like HLS and DASH
+    'concurrent_fragment_downloads': cfg.DOWNLOAD_CONNECTIONS,
     'source_address': '0.0.0.0', # bind to ipv4 since ipv6 addresses cause issues sometimes
 }
 
 ytdl = YoutubeDL(ytdl_format_options)
+# Instances that pick formats to suit a voice channel's bitrate, keyed by that bitrate in kbps
+ytdl_by_bitrate: dict[int, YoutubeDL] = {}
 
 # Connect to youtube music API
 ytmusic = YTMusic()
@@ -547,6 +612,219 @@ def compare_media(reference: MediaInfo, compared: MediaInfo,
     }
     return int((sum(v for k, v in match_results.items()) / len(match_results)) * 100), match_results
 
+#region FORMAT SELECTION
+def format_bitrate(fmt: dict) -> float:
+    """Returns a yt_dlp format's audio bitrate in kbps, or 0 if it isn't known."""
+    return fmt.get('abr') or fmt.get('tbr') or 0
+
+def select_audio_format(formats: list[dict], target_kbps: int) -> Optional[dict]:
+    """Picks the audio-only format with the lowest bitrate that's still at least `target_kbps`, preferring Opus.
+    Anything above the voice channel's bitrate is thrown away when Discord re-encodes it, so there's no use downloading it.
+
+    If no audio-only format reaches `target_kbps`, the one with the highest bitrate is picked instead.
+    Returns `None` if there are no audio-only formats at all.
+    """
+    audio_only = [fmt for fmt in formats if (fmt.get('vcodec') == 'none') and (fmt.get('acodec') not in (None, 'none'))]
+    if not audio_only:
+        return None
+    opus = [fmt for fmt in audio_only if fmt.get('acodec') == 'opus']
+    for candidates in (opus, audio_only):
+        if enough := [fmt for fmt in candidates if format_bitrate(fmt) >= target_kbps]:
+            return min(enough, key=format_bitrate)
+    return max(audio_only, key=format_bitrate)
+
+def bitrate_format_selector(target_kbps: int) -> Callable[[dict], Iterator[dict]]:
+    """Returns a yt_dlp format selector built around `select_audio_format()`, which falls back to the
+    `audio-format.fallbacks` config selectors when there's no audio-only format to pick from.
+    """
+    fallback = ytdl.build_format_selector(ytdl_format_options['format'])
+    def selector(ctx: dict) -> Iterator[dict]:
+        if (chosen := select_audio_format(ctx['formats'], target_kbps)) is not None:
+            log.debug('Selected format %s (%s, %s kbps) for a %s kbps channel.',
+                chosen.get('format_id'), chosen.get('acodec'), format_bitrate(chosen), target_kbps)
+            yield chosen
+        else:
+            yield from fallback(ctx)
+    return selector
+
+def ytdl_for_bitrate(bitrate: Optional[int]) -> YoutubeDL:
+    """Returns a YoutubeDL instance that picks formats to suit a voice channel `bitrate`, given in bits per second.
+    Returns the default instance if `bitrate` is `None`, or if matching the channel bitrate is disabled.
+    """
+    if (bitrate is None) or (not cfg.AUDIO_FORMAT_MATCH_BITRATE):
+        return ytdl
+    target_kbps = bitrate // 1000
+    if target_kbps not in ytdl_by_bitrate:
+        ytdl_by_bitrate[target_kbps] = YoutubeDL(ytdl_format_options | {'format': bitrate_format_selector(target_kbps)})
+    return ytdl_by_bitrate[target_kbps]
+
+def download_to_memory(info: dict, max_bytes: int) -> Optional[bytes]:
+    """Downloads the format chosen in an extracted track's `info` into memory, rather than to a file.
+    Blocking; meant to be run in an executor.
+
+    Returns `None` if this can't be done, in which case it should be downloaded to disk as usual. That's the case if the format
+    is split into fragments, if it turns out to be bigger than `max_bytes`, or if the download fails.
+    """
+    if info.get('protocol') not in ('http', 'https'):
+        return None
+    try:
+        with requests.get(info['url'], headers=info.get('http_headers'), stream=True, timeout=10) as response:
+            response.raise_for_status()
+            if int(response.headers.get('Content-Length', 0)) > max_bytes:
+                return None
+            buffer = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                buffer += chunk
+                if len(buffer) > max_bytes:
+                    return None
+            return bytes(buffer)
+    except requests.RequestException as e:
+        log.debug('Couldn\'t download into memory: %s', e)
+        return None
+
+# Stream URLs are downloaded in ranges of this size, like yt_dlp does, since some hosts throttle requests for a whole file
+STREAM_DOWNLOAD_CHUNK_BYTES: int = 10 * 1024 * 1024
+# File extensions for the content types stream URLs are downloaded as
+STREAM_CONTENT_EXTENSIONS: dict[str, str] = {
+    'audio/webm': '.webm', 'video/webm': '.webm', 'audio/mp4': '.m4a', 'video/mp4': '.mp4', 'audio/mpeg': '.mp3', 'audio/ogg': '.ogg'
+}
+
+def download_stream_url(url: str, stem: str) -> Optional[Path]:
+    """Downloads a direct stream URL that a track was already resolved to, without extracting it again.
+    Blocking; meant to be run in an executor.
+
+    @stem: What to name the file, without an extension; that's picked from the content type it's sent as.
+
+    Returns where it was saved, or `None` if this can't be done. That's the case if it isn't sent as a known kind of audio or video
+    (e.g. a playlist of fragments), or if the download fails.
+    """
+    part: Optional[Path] = None
+    try:
+        start, total = 0, None
+        with requests.Session() as session:
+            while (total is None) or (start < total):
+                headers = {'Range': f'bytes={start}-{start + STREAM_DOWNLOAD_CHUNK_BYTES - 1}'}
+                with session.get(url, headers=headers, stream=True, timeout=10) as response:
+                    response.raise_for_status()
+                    if part is None:
+                        if (extension := STREAM_CONTENT_EXTENSIONS.get(response.headers.get('Content-Type', '').split(';')[0])) is None:
+                            return None
+                        part = Path(f'{stem}{extension}.part')
+                        part.unlink(missing_ok=True)
+                    received = 0
+                    with open(part, 'ab') as file:
+                        for chunk in response.iter_content(64 * 1024):
+                            file.write(chunk)
+                            received += len(chunk)
+                    start += received
+                    # A server that ignores ranges sends the whole file at once
+                    content_range = response.headers.get('Content-Range', '')
+                    total = int(content_range.split('/')[-1]) if (response.status_code == 206) and content_range[-1:].isdigit() else start
+                    if not received:
+                        raise OSError(f'Stream ended early, at {start} of {total} bytes')
+        path = cast(Path, part).with_suffix('')
+        cast(Path, part).replace(path)
+        return path
+    except (requests.RequestException, OSError) as e:
+        log.debug('Couldn\'t download stream URL: %s', e)
+        if part is not None:
+            part.unlink(missing_ok=True)
+        return None
+
+def format_key(bitrate: Optional[int]) -> str:
+    """Returns a key identifying which formats `ytdl_for_bitrate()` picks for `bitrate`, for caching what was picked."""
+    if (bitrate is None) or (not cfg.AUDIO_FORMAT_MATCH_BITRATE):
+        return 'default'
+    return f'{bitrate // 1000}k'
+#endregion
+
+#region DIRECT URLS
+# Content types that are audio, but list other URLs to play rather than being playable themselves; yt_dlp handles these
+PLAYLIST_CONTENT_TYPES: tuple[str, ...] = ('audio/x-mpegurl', 'audio/mpegurl', 'audio/x-scpls')
+DIRECT_PROBE_TIMEOUT_SECONDS: int = 5
+
+def direct_url_headers(url: str) -> Optional[tuple[str, requests.structures.CaseInsensitiveDict]]:
+    """Returns where `url` ends up after redirects, and the headers it responds with, without downloading anything.
+    Returns `None` if it can't be reached.
+    """
+    try:
+        with requests.head(url, allow_redirects=True, timeout=DIRECT_PROBE_TIMEOUT_SECONDS) as response:
+            if response.ok:
+                return response.url, response.headers
+        # Icecast and Shoutcast servers often don't answer HEAD requests; a GET that's closed after the headers tells the same thing
+        with requests.get(url, stream=True, timeout=DIRECT_PROBE_TIMEOUT_SECONDS) as response:
+            if response.ok:
+                return response.url, response.headers
+    except requests.RequestException as e:
+        log.debug('Couldn\'t probe URL: %s', e)
+    return None
+
+def probe_direct_url(url: str) -> Optional[dict]:
+    """Checks whether `url` links straight to audio, such as an audio file or an Icecast/Shoutcast radio stream,
+    going by the content type it responds with. Blocking; makes at most two requests, and downloads nothing.
+
+    Returns a dictionary from `direct_info()`, with only what's known from the headers, or `None` if it isn't a direct link to audio.
+    Streams that announce themselves with `icy-` headers, or that don't say how long they are, are marked as live.
+    """
+    if not url.startswith(('http://', 'https://')):
+        return None
+    if (result := direct_url_headers(url)) is None:
+        return None
+    final_url, headers = result
+
+    content_type = headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if not (content_type.startswith('audio/') or (content_type == 'application/ogg')) or (content_type in PLAYLIST_CONTENT_TYPES):
+        return None
+
+    is_live = any(key.lower().startswith('icy-') for key in headers) or ('Content-Length' not in headers)
+    log.debug('URL is a direct link to %s audio (%s).', 'live' if is_live else 'file', content_type)
+    return direct_info(url, final_url, title=headers.get('icy-name', ''), artist=headers.get('icy-description', ''), is_live=is_live)
+
+def direct_info(url: str, stream_url: str, *, title: str='', artist: str='', duration: float=0, is_live: bool=False) -> dict:
+    """Returns a dictionary describing a direct link to audio, laid out like the ones from `yt_dlp.YoutubeDL.extract_info()`.
+
+    @url: The link as it was given, which identifies the track.
+    @stream_url: Where the audio can actually be read from, after following redirects.
+    @title: (`''`) Falls back to the file's name in `url`, if there is one.
+    """
+    filename = unquote(PurePosixPath(urlparse(url).path).name)
+    return {
+        'extractor': DIRECT,
+        'id': url,
+        'url': stream_url,
+        'webpage_url': url,
+        'title': title or filename or url,
+        'uploader': artist,
+        'duration': duration,
+        'is_live': is_live,
+    }
+
+def is_discord_attachment(url: str) -> bool:
+    """Whether `url` links to a file uploaded to Discord."""
+    return bool(re.match(r"https://(?:cdn\.discordapp\.com|media\.discordapp\.net)/(?:attachments|ephemeral-attachments)/", url))
+#endregion
+
+#region MEDIA LISTS
+def media_list_from_url(url: str) -> PlaylistInfo | AlbumInfo:
+    """Retrieves the playlist or album at `url` from whichever source it's on.
+    Raises `MediaError` if it's on Spotify, and Spotify is unavailable or couldn't retrieve it.
+    """
+    if url.startswith('https://open.spotify.com/') and not sp:
+        raise MediaError('Spotify functionality is unavailable')
+    if re.findall(r"https://(?:music\.|www\.|)youtube\.com/playlist\?list=", url):
+        # Convert to a normal YouTube playlist URL because dealing with YTMusic playlists/albums are a hassle
+        return PlaylistInfo.from_ytdl(url.replace('music.', 'www.'))
+    if url.startswith('https://open.spotify.com/album/'):
+        return AlbumInfo.from_spotify_url(url)
+    if url.startswith('https://open.spotify.com/playlist/'):
+        return PlaylistInfo.from_spotify_url(url)
+    if re.findall(r"https://soundcloud\.com/\w+/sets/", url):
+        return soundcloud_set(url)
+    if re.findall(r"https://\w+\.bandcamp\.com/album/", url):
+        return AlbumInfo.from_other(url)
+    return PlaylistInfo.from_other(url)
+#endregion
+
 #region SOUNDCLOUD
 def soundcloud_set(url: str) -> PlaylistInfo | AlbumInfo:
     """Retrieves a SoundCloud set and returns either a PlaylistInfo or AlbumInfo where applicable."""
@@ -728,4 +1006,40 @@ def match_ytmusic_track(src_info: TrackInfo) -> TrackInfo | list[TrackInfo]:
 
     log.info('No confident matches were found. Returning the closest ones...')
     return track_choices
+
+def youtube_video_id(url: str) -> Optional[str]:
+    """Returns the video ID from a YouTube or YouTube Music video URL, or `None` if it isn't one."""
+    parsed = urlparse(url)
+    if parsed.hostname == 'youtu.be':
+        return parsed.path.lstrip('/') or None
+    if (parsed.hostname or '').endswith('youtube.com') and (parsed.path == '/watch'):
+        return parse_qs(parsed.query).get('v', [None])[0]
+    return None
+
+def canonical_url(url: str) -> str:
+    """Returns a form of `url` that's the same for every link to the same media, for telling when two requests are for the same thing.
+
+    YouTube and YouTube Music links are reduced to their video ID, and Spotify links lose their query, which only tracks who shared them.
+    Other links are left as they are, since their query can matter, e.g. for Discord attachments.
+    """
+    if video_id := youtube_video_id(url):
+        return f'https://www.youtube.com/watch?v={video_id}'
+    parsed = urlparse(url)
+    if parsed.hostname == 'open.spotify.com':
+        return parsed._replace(query='', fragment='').geturl()
+    return url
+
+def related_ytmusic_tracks(video_id: str, limit: int=10) -> list[TrackInfo]:
+    """Returns tracks related to a YouTube video, in the order YouTube Music's radio for it would play them.
+    The video itself is left out, as are results without a known length.
+    """
+    log.debug('Getting tracks related to: %s', video_id)
+    related: list[TrackInfo] = []
+    for track in ytmusic.get_watch_playlist(videoId=video_id, limit=limit, radio=True)['tracks']:
+        if (track.get('videoId') in (None, video_id)) or (not track.get('length')):
+            continue
+        # Watch playlist tracks are laid out a little differently from search results, which TrackInfo expects
+        related.append(TrackInfo(YOUTUBE, track | {'duration_seconds': hms_to_seconds(track['length']),
+            'thumbnails': track.get('thumbnail') or []}, yt_info_origin='ytmusic'))
+    return related
 #endregion YTMUSIC
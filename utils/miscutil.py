@@ -63,6 +63,18 @@ def seconds_to_hms(seconds: int | float, format_zero: bool = True) -> str | None
     stamp[0] = str(int(stamp[0]))
     return ':'.join(stamp)
 
+def hms_to_seconds(stamp: str) -> int:
+    """Returns the amount of seconds in a timestamp formatted as H:MM:SS, M:SS, or as just a number of seconds.
+    Raises `ValueError` if it isn't in any of those formats.
+    """
+    parts: list[str] = stamp.split(':')
+    if (len(parts) > 3) or (not all(part.isdigit() for part in parts)):
+        raise ValueError(f'Invalid timestamp: {stamp}')
+    seconds: int = 0
+    for part in parts:
+        seconds = (seconds * 60) + int(part)
+    return seconds
+
 def time_func(func: Callable, printout: bool=True) -> float:
     """Times the execution of a callable, prints out the result if allowed, and returns the result of the called function
 
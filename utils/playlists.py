@@ -0,0 +1,113 @@
+"""Keeps playlists that servers have saved, already matched and resolved, so queueing them again doesn't need the network."""
+
+# Standard imports
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+# Local imports
+from utils.cache import DEFAULT_CACHE_PATH
+from utils.media import TrackInfo
+
+log = logging.getLogger('lydian')
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS saved_playlists (
+    guild_id    INTEGER NOT NULL,
+    name        TEXT NOT NULL,
+    url         TEXT NOT NULL,
+    saved_by    INTEGER NOT NULL,
+    updated_at  REAL NOT NULL,
+    PRIMARY KEY (guild_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS saved_playlist_tracks (
+    guild_id    INTEGER NOT NULL,
+    name        TEXT NOT NULL,
+    position    INTEGER NOT NULL,
+    origin_url  TEXT NOT NULL,
+    source      TEXT NOT NULL,
+    url         TEXT NOT NULL,
+    title       TEXT NOT NULL,
+    artist      TEXT NOT NULL,
+    thumbnail   TEXT NOT NULL,
+    duration    REAL,
+    PRIMARY KEY (guild_id, name, position)
+);
+"""
+
+class SavedPlaylists:
+    """Stores each server's saved playlists by name, along with every track in them as it was resolved to be played,
+    e.g. a Spotify track as the YouTube Music track it was matched to.
+
+    Each track also keeps the URL it had in the original playlist, so refreshing a playlist only has to resolve tracks
+    that weren't in it before. The connection is shared between threads, guarded by a lock.
+    """
+    def __init__(self, path: Path=DEFAULT_CACHE_PATH):
+        """
+        @path: (`lydian.db`) Where to keep the playlists. Created if it doesn't exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+        log.debug('Saved playlists opened: %s', path)
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        with self.lock:
+            self.connection.close()
+
+    def save(self, guild_id: int, name: str, url: str, saved_by: int, tracks: list[tuple[str, TrackInfo]]) -> None:
+        """Saves a playlist under `name`, replacing any playlist the server already saved with that name.
+
+        @url: The URL of the original playlist, which it's refreshed from.
+        @saved_by: Who saved it.
+        @tracks: Every track in the playlist in order, as it should be played, along with its URL in the original playlist.
+        """
+        rows = [(guild_id, name, n, origin_url, track.source, track.url, track.title, track.artist, track.thumbnail or '',
+            track.length_seconds) for n, (origin_url, track) in enumerate(tracks)]
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM saved_playlist_tracks WHERE guild_id = ? AND name = ?', (guild_id, name))
+            self.connection.execute('INSERT OR REPLACE INTO saved_playlists (guild_id, name, url, saved_by, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (guild_id, name, url, saved_by, time.time()))
+            self.connection.executemany("""
+                INSERT INTO saved_playlist_tracks (guild_id, name, position, origin_url, source, url, title, artist, thumbnail, duration)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+
+    def get(self, guild_id: int, name: str) -> Optional[sqlite3.Row]:
+        """Returns a saved playlist's URL, who saved it, and when it was last updated, or `None` if there's no such playlist."""
+        with self.lock:
+            return self.connection.execute('SELECT * FROM saved_playlists WHERE guild_id = ? AND name = ?', (guild_id, name)).fetchone()
+
+    def tracks(self, guild_id: int, name: str) -> list[sqlite3.Row]:
+        """Returns the tracks of a saved playlist in order, in the form `TrackInfo.from_index()` takes."""
+        with self.lock:
+            return self.connection.execute('SELECT * FROM saved_playlist_tracks WHERE guild_id = ? AND name = ? ORDER BY position',
+                (guild_id, name)).fetchall()
+
+    def list_playlists(self, guild_id: int) -> list[sqlite3.Row]:
+        """Returns every playlist a server has saved, by name, along with how many tracks are in each as `tracks`."""
+        with self.lock:
+            return self.connection.execute("""
+                SELECT saved_playlists.*, COUNT(saved_playlist_tracks.position) AS tracks FROM saved_playlists
+                LEFT JOIN saved_playlist_tracks USING (guild_id, name)
+                WHERE guild_id = ? GROUP BY name ORDER BY name
+                """, (guild_id,)).fetchall()
+
+    def delete(self, guild_id: int, name: str) -> bool:
+        """Deletes a saved playlist. Returns whether there was one to delete."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM saved_playlist_tracks WHERE guild_id = ? AND name = ?', (guild_id, name))
+            return self.connection.execute('DELETE FROM saved_playlists WHERE guild_id = ? AND name = ?', (guild_id, name)).rowcount > 0
+
+    def all_tracks(self) -> list[sqlite3.Row]:
+        """Returns every distinct track across every server's saved playlists, for warming the cache with."""
+        with self.lock:
+            return self.connection.execute('SELECT * FROM saved_playlist_tracks GROUP BY url ORDER BY guild_id, name, position').fetchall()
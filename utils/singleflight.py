@@ -0,0 +1,53 @@
+"""Lets concurrent requests for the same thing share one call to get it, instead of each making their own."""
+
+# Standard imports
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, TypeVar
+
+log = logging.getLogger('lydian')
+
+T = TypeVar('T')
+
+class SingleFlight:
+    """Keeps track of calls that are still in progress by key. Anything that asks for a key while its call is in progress
+    waits for that call and gets the same result, or the same exception, rather than starting another one.
+
+    Nothing is kept once a call finishes; the next request for its key starts a new one.
+    """
+    def __init__(self, name: str):
+        """
+        @name: What's being shared, for logging.
+        """
+        self.name = name
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+        self.calls_shared: int = 0
+
+    def __len__(self) -> int:
+        return len(self.in_flight)
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """Returns the result of `func()`, or of the call already in progress for `key` if there is one.
+
+        Cancelling one caller doesn't cancel the call for anyone else waiting on it.
+        """
+        if (future := self.in_flight.get(key)) is None:
+            future = asyncio.ensure_future(func())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self.finished(key, done))
+        else:
+            self.calls_shared += 1
+            log.debug('Sharing %s already in progress: %s', self.name, key)
+        return await asyncio.shield(future)
+
+    def finished(self, key: Hashable, future: asyncio.Future) -> None:
+        """Forgets a call once it's done, so the next request for its key starts a new one."""
+        self.in_flight.pop(key, None)
+        if not future.cancelled():
+            # Marks the exception as retrieved, in case every caller was cancelled before it was raised
+            future.exception()
+
+    async def run_in_executor(self, key: Hashable, func: Callable[..., T], *args: Any) -> T:
+        """Like `run()`, but for a blocking function, which is run in the default executor with `args`."""
+        return await self.run(key, lambda: asyncio.get_running_loop().run_in_executor(None, func, *args))